@@ -0,0 +1,130 @@
+#End to end load benchmark: replays a mix of roll, slot, load_character and add_character through the real
+#handlers with fake_discord standing in for Discord, on a scratch database, and reports throughput and latency.
+#Commands are started on a fixed schedule (open loop), so a stall shows up in the latency of everything queued behind it.
+#Usage: python bench_load.py [commands, default 20000] [commands per second, default 2000] [users, default 200]
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+
+#main reads these at import, point it at a scratch directory before importing it
+scratch = tempfile.TemporaryDirectory()
+os.environ["DB_PATH"] = os.path.join(scratch.name, "bench.db")
+os.environ["SNAPSHOT_PATH"] = os.path.join(scratch.name, "bench.snapshot")
+os.environ["LOG_PATH"] = os.path.join(scratch.name, "bench.log")
+
+import main
+from main import DnD_Char, init_db, persist_characters, update_max_id
+from bench_memory import synthetic_row
+from fake_discord import FakeInteraction, run_command
+
+#(command, share of the traffic)
+MIX = [("roll", 0.5), ("slot", 0.2), ("load_character", 0.15), ("add_character", 0.15)]
+DICE = ["1d20", "1d20+5", "2d6+3", "4d6", "8d6", "1d8-1"]
+
+#same JSON in and out as play_machine in slot_machine.cpp, used when the compiled library isn't available
+class SlotMachineStandIn:
+  machines = {
+    "basic": {"👾": (2.0, 3), "💀": (0.75, 10), "💅": (1.0, 7)},
+    "complex": {"❤️": (1.0, 9), "🌑": (2.0, 4), "🐝": (2.5, 3), "🍋": (0.5, 8), "☄️": (4.0, 2), "☔️": (5.0, 1)},
+    "default": {"👾": (1.5, 3), "💀": (0.5, 5), "💅": (1.0, 4)}
+  }
+  def play_machine(self, input_json):
+    request = json.loads(input_json)
+    machine = self.machines.get(request["type"], self.machines["default"])
+    wager = request.get("wager", 1.0)
+    symbols = random.choices(list(machine), weights = [freq for _, freq in machine.values()], k = 3)
+    multiplier = machine[symbols[0]][0] if len(set(symbols)) == 1 else 0.0
+    return json.dumps({"symbols": symbols, "multiplier": multiplier, "wager": wager, "payout": multiplier * wager}).encode("utf-8")
+
+#users 1..users with a few characters each
+def seed(users, per_user = 3):
+  init_db()
+  rng = random.Random(1)
+  chars = []
+  for user_id in range(1, users + 1):
+    for _ in range(per_user):
+      row = synthetic_row(rng, len(chars) + 1)
+      row["owner"] = user_id
+      chars.append(DnD_Char(**row))
+  persist_characters(chars)
+  update_max_id()
+  return len(chars)
+
+#plays the user in load_character: picks one of the characters offered, which is what
+#CharacterDropdown.callback does with the user's choice
+def pick_character(view):
+  if isinstance(view, main.CharacterSelect):
+    view.selected_id = random.choice(view.characters)[0]
+    view.stop()
+
+def make_command(name, user_id):
+  interaction = FakeInteraction(user_id, guild_id = 1, channel_id = 1, chooser = pick_character)
+  if name == "roll":
+    return run_command(main.roll, interaction, dice = random.choice(DICE))
+  if name == "slot":
+    return run_command(main.slot, interaction, machine_type = random.choice(main.MACHINE_TYPES), wager = float(random.randint(1, 20)))
+  if name == "load_character":
+    return run_command(main.load_character, interaction)
+  stats = {f"{stat}_stat": random.randint(8, 18) for stat in ("str", "dex", "con", "int", "wis", "cha")}
+  return run_command(main.add_character, interaction, name = f"Draft {user_id}", race = "elf", max_hp = 30, current_hp = 30,
+                     ac = 14, ms = 30, background = "sage", xp = 0, **stats)
+
+def percentile(values, q):
+  return values[min(len(values) - 1, int(q * len(values)))]
+
+def report_line(label, latencies, errors):
+  latencies.sort()
+  return (f"{label}: {len(latencies)} calls, p50 {percentile(latencies, 0.5) * 1000:.2f} ms, "
+          f"p99 {percentile(latencies, 0.99) * 1000:.2f} ms, max {latencies[-1] * 1000:.2f} ms, {errors} errors")
+
+async def run(total, rate, users):
+  names = [name for name, _ in MIX]
+  weights = [share for _, share in MIX]
+  latencies = {name: [] for name in names}
+  errors = Counter()
+  async def one(name, user_id, due):
+    try:
+      await make_command(name, user_id)
+    except Exception as e:
+      errors[name] += 1
+      if errors[name] == 1:
+        print(f"{name} failed: {e!r}")
+    #from when the command was due, so time spent waiting behind a slow one counts
+    latencies[name].append(time.perf_counter() - due)
+  tasks = []
+  start = time.perf_counter()
+  for i in range(total):
+    due = start + i / rate
+    delay = due - time.perf_counter()
+    if delay > 0.001:
+      await asyncio.sleep(delay)
+    tasks.append(asyncio.create_task(one(random.choices(names, weights)[0], random.randint(1, users), due)))
+  await asyncio.gather(*tasks)
+  return time.perf_counter() - start, latencies, errors
+
+if __name__ == "__main__":
+  total = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+  rate = float(sys.argv[2]) if len(sys.argv) > 2 else 2000
+  users = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+  random.seed(1)
+  try:
+    main.get_slot_lib()
+  except OSError:
+    print("slot_machine library not found, using the Python stand-in")
+    main.slot_lib = SlotMachineStandIn()
+  print(f"Seeded {seed(users)} characters for {users} users")
+  elapsed, latencies, errors = asyncio.run(run(total, rate, users))
+  print(f"{total} commands in {elapsed:.2f}s: {total / elapsed:.0f} commands/s (target {rate:g}/s)")
+  for name, values in latencies.items():
+    if values:
+      print("  " + report_line(name, values, errors[name]))
+  print("  " + report_line("all", [v for values in latencies.values() for v in values], sum(errors.values())))
+  print("Storage during the run:")
+  for line in main.histogram_lines(main.storage_seconds):
+    print("  " + line)
+  scratch.cleanup()
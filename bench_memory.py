@@ -0,0 +1,111 @@
+#Memory benchmark for cached characters: the old dict and list layout against the compact DnD_Char core
+#Usage: python bench_memory.py [number of characters, default 100000]
+import gc
+import json
+import random
+import sys
+import time
+import tracemalloc
+
+from main import DnD_Char, class_dice, skill_abilities
+
+RACES = ["human", "elf", "dwarf", "halfling", "gnome", "half-orc", "tiefling", "dragonborn"]
+BACKGROUNDS = ["acolyte", "criminal", "folk hero", "noble", "sage", "soldier", "urchin"]
+LANGUAGES = ["common", "elvish", "dwarvish", "draconic", "infernal", "thieves cant"]
+FEATS = ["alert", "lucky", "sharpshooter", "war caster", "tough", "resilient"]
+SPELLS = ["fire bolt", "mage hand", "shield", "magic missile", "cure wounds", "healing word", "misty step", "fireball", "counterspell", "haste"]
+
+#The layout DnD_Char used before the numeric core, every field in its own object
+class DictChar:
+  __slots__ = (
+  "name", "owner", "race", "background", "classes", "subclasses", "hit_dice", "xp",
+  "abilities", "spell_slots", "spells", "stats", "languages", "equipment", "points",
+  "feats", "hp", "ac", "ms", "exhaustion", "proficiencies", "Id", "notes", "version"
+  )
+  def __init__(self, owner, name, race, background, classes, hit_dice, stats, hp, ac, Id, xp = 0,
+               subclasses = None, abilities = None, notes = None, spells = None, spell_slots = None,
+               points = None, ms = 30, languages = None, equipment = None, feats = None,
+               exhaustion = 0, proficiencies = None, version = 0):
+    self.name = name
+    self.owner = owner
+    self.race = race
+    self.background = background
+    self.classes = classes
+    self.subclasses = subclasses or {}
+    self.hit_dice = hit_dice
+    self.xp = xp
+    self.notes = notes or []
+    self.abilities = abilities or []
+    self.spell_slots = spell_slots or {}
+    self.spells = spells or {}
+    self.stats = stats
+    self.languages = languages or []
+    self.equipment = equipment or {}
+    self.points = points or {}
+    self.feats = feats or []
+    self.hp = hp
+    self.ac = ac
+    self.ms = ms
+    self.exhaustion = exhaustion
+    self.proficiencies = proficiencies or {}
+    self.Id = Id
+    self.version = version
+
+#a synthetic character with a couple of classes, spells, slots and proficiencies
+def synthetic_row(rng, char_id):
+  classes = dict.fromkeys(rng.sample(sorted(class_dice), rng.randint(1, 2)), 0)
+  for cls in classes:
+    classes[cls] = rng.randint(1, 10)
+  level = sum(classes.values())
+  hit_dice = {}
+  for cls, lvl in classes.items():
+    hit_dice.setdefault(str(class_dice[cls]), [0, 0])
+    hit_dice[str(class_dice[cls])][0] += lvl
+    hit_dice[str(class_dice[cls])][1] += lvl
+  max_hp = 8 + 6 * level
+  slots = {str(lvl): [rng.randint(0, 4), 4] for lvl in range(1, min(level // 2, 9) + 1)}
+  return {
+    "owner": rng.randint(1, 10**17),
+    "name": f"Character {char_id}",
+    "race": rng.choice(RACES),
+    "background": rng.choice(BACKGROUNDS),
+    "classes": classes,
+    "hit_dice": hit_dice,
+    "stats": {stat: rng.randint(8, 18) for stat in ("str", "dex", "con", "int", "wis", "cha")},
+    "hp": [rng.randint(0, max_hp), max_hp],
+    "ac": rng.randint(10, 20),
+    "Id": char_id,
+    "xp": rng.randint(0, 100000),
+    "spells": {"known": {"cantrip": rng.sample(SPELLS[:3], 2), "1": rng.sample(SPELLS[2:6], 2)}, "prepared": {}},
+    "spell_slots": slots,
+    "points": {"sorcery points": [2, 4]},
+    "languages": rng.sample(LANGUAGES, 2),
+    "equipment": {"gold": rng.randint(0, 500), "dagger": 1},
+    "feats": rng.sample(FEATS, 1),
+    "proficiencies": {skill: rng.randint(1, 2) for skill in rng.sample(sorted(skill_abilities), 4)}
+  }
+
+#builds count characters as if loaded from the database (fresh strings each time) and returns bytes held
+def measure(cls, count, seed = 1):
+  rng = random.Random(seed)
+  gc.collect()
+  tracemalloc.start()
+  start_mem = tracemalloc.get_traced_memory()[0]
+  start = time.perf_counter()
+  chars = [cls(**json.loads(json.dumps(synthetic_row(rng, i)))) for i in range(count)]
+  elapsed = time.perf_counter() - start
+  gc.collect()
+  held = tracemalloc.get_traced_memory()[0] - start_mem
+  tracemalloc.stop()
+  del chars
+  return held, elapsed
+
+if __name__ == "__main__":
+  count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+  results = {}
+  for label, cls in (("dict layout (before)", DictChar), ("compact core (after)", DnD_Char)):
+    held, elapsed = measure(cls, count)
+    results[label] = held
+    print(f"{label}: {held / 2**20:.1f} MiB for {count} characters, {held / count:.0f} bytes each, built in {elapsed:.2f}s")
+  before, after = results.values()
+  print(f"Saved {(before - after) / 2**20:.1f} MiB ({100 * (before - after) / before:.0f}%)")
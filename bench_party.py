@@ -0,0 +1,54 @@
+#Benchmark for bulk party operations on a 50 member party: one write per character against one transaction
+#Usage: python bench_party.py [party size, default 50] [rounds, default 20]
+import os
+import random
+import sqlite3 as lite
+import sys
+import tempfile
+import time
+
+from main import DnD_Char, Party, init_db, persist_characters
+from bench_memory import synthetic_row
+
+#a long rest, an xp split and a fireball, each character written on its own like the single character commands do
+def per_character(chars, db):
+  conn = lite.connect(db)
+  try:
+    for char in chars:
+      char.long_rest()
+      char.to_db(conn)
+    for char in chars:
+      char.add_xp(1000 // len(chars))
+      char.to_db(conn)
+    for char in chars:
+      char.change_hp(-8)
+      char.to_db(conn)
+  finally:
+    conn.close()
+
+#the same session through Party, persisted once per operation
+def batched(party, chars, db):
+  party.long_rest(chars)
+  persist_characters(chars, db)
+  party.split_xp(chars, 1000)
+  persist_characters(chars, db)
+  party.aoe_damage(chars, 8, saved = {chars[0].Id})
+  persist_characters(chars, db)
+
+if __name__ == "__main__":
+  size = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+  rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+  with tempfile.TemporaryDirectory() as tmp:
+    db = os.path.join(tmp, "bench.db")
+    init_db(db)
+    rng = random.Random(1)
+    chars = [DnD_Char(**synthetic_row(rng, i)) for i in range(1, size + 1)]
+    persist_characters(chars, db)
+    party = Party(1, 1, "bench", 1, [char.Id for char in chars])
+    for label, run in (("per character writes", lambda: per_character(chars, db)),
+                       ("batched party ops", lambda: batched(party, chars, db))):
+      start = time.perf_counter()
+      for _ in range(rounds):
+        run()
+      elapsed = (time.perf_counter() - start) / rounds
+      print(f"{label}: {elapsed * 1000:.1f} ms per session (rest + xp + aoe) for {size} characters")
@@ -0,0 +1,141 @@
+#Storage benchmark at 1k, 10k and 100k characters: bulk insert, single saves, loads (from_db and pull_character_from_db),
+#a full cache push, a users table rebuild and the database file size.
+#Each run is written to a JSON file named after the git revision, so runs of different versions can be compared.
+#Usage: python bench_storage.py [sizes, default 1000,10000,100000] [output file, default bench_results/storage_<revision>.json]
+import datetime
+import json
+import os
+import platform
+import random
+import sqlite3 as lite
+import subprocess
+import sys
+import tempfile
+import time
+
+from main import (DnD_Cache, DnD_Char, TimedConnection, init_db, persist_characters, pull_character_from_db,
+                  push_dnd_cache_to_db, update_users_table)
+from bench_memory import synthetic_row
+
+#characters saved or loaded one at a time at each size, the rest of the table is there for the indexes to work against
+SAMPLE = 1000
+#characters per transaction for the bulk insert
+BATCH = 1000
+
+#synthetic characters (multiclassing, spells, slots, proficiencies) with about three per player
+def make_characters(count, seed = 1):
+  rng = random.Random(seed)
+  chars = []
+  for char_id in range(1, count + 1):
+    row = synthetic_row(rng, char_id)
+    row["owner"] = rng.randint(1, max(1, count // 3))
+    chars.append(DnD_Char(**row))
+  return chars
+
+def latency_stats(samples):
+  samples.sort()
+  pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))] * 1000
+  return {
+    "count": len(samples),
+    "mean_ms": sum(samples) / len(samples) * 1000,
+    "p50_ms": pick(0.5),
+    "p99_ms": pick(0.99),
+    "max_ms": samples[-1] * 1000
+  }
+
+#runs func once per item and returns latency_stats for the calls
+def time_each(func, items):
+  samples = []
+  for item in items:
+    start = time.perf_counter()
+    func(item)
+    samples.append(time.perf_counter() - start)
+  return latency_stats(samples)
+
+def time_once(func):
+  start = time.perf_counter()
+  func()
+  return time.perf_counter() - start
+
+def connect(db):
+  conn = lite.connect(db, factory = TimedConnection)
+  conn.row_factory = lite.Row
+  return conn
+
+def bench_size(count, directory):
+  db = os.path.join(directory, f"storage_{count}.db")
+  init_db(db)
+  chars = make_characters(count)
+  sample = random.Random(2).sample(chars, min(SAMPLE, count))
+  result = {"characters": count}
+
+  seconds = time_once(lambda: [persist_characters(chars[i:i + BATCH], db) for i in range(0, count, BATCH)])
+  result["insert"] = {"seconds": seconds, "rows_per_second": count / seconds, "batch": BATCH}
+
+  conn = connect(db)
+  try:
+    #one character saved and committed on its own, like a command that changes a character
+    result["save_one"] = time_each(lambda char: char.to_db(conn), sample)
+    result["from_db"] = time_each(lambda char: DnD_Char.from_db(conn, char.Id), sample)
+  finally:
+    conn.close()
+  #opens its own connection every call, the way the commands load characters
+  result["pull_character_from_db"] = time_each(lambda char: pull_character_from_db(char.Id, db), sample)
+
+  cache = DnD_Cache()
+  for char in chars:
+    cache.add_char(char)
+  pushed = []
+  seconds = time_once(lambda: pushed.extend(push_dnd_cache_to_db(cache, db)))
+  if len(pushed) != count:
+    raise RuntimeError(f"push wrote {len(pushed)} of {count} characters, see the log")
+  result["full_push"] = {"seconds": seconds, "rows_per_second": count / seconds}
+
+  #the push cleared the cache, refill it and rebuild the already populated users table on its own
+  for char in chars:
+    cache.add_char(char)
+  conn = connect(db)
+  try:
+    result["users_table_rebuild"] = {"seconds": time_once(lambda: update_users_table(cache, conn))}
+  finally:
+    conn.close()
+
+  size = sum(os.path.getsize(path) for path in (db, db + "-wal") if os.path.exists(path))
+  result["file_bytes"] = size
+  result["bytes_per_character"] = size / count
+  return result
+
+def git_revision():
+  try:
+    return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output = True, text = True,
+                          check = True, cwd = os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return "unknown"
+
+if __name__ == "__main__":
+  sizes = [int(size) for size in sys.argv[1].split(",")] if len(sys.argv) > 1 else [1000, 10000, 100000]
+  revision = git_revision()
+  out_path = sys.argv[2] if len(sys.argv) > 2 else os.path.join("bench_results", f"storage_{revision}.json")
+  run = {
+    "benchmark": "storage",
+    "revision": revision,
+    "date": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec = "seconds"),
+    "python": platform.python_version(),
+    "sqlite": lite.sqlite_version,
+    "platform": platform.platform(),
+    "sample": SAMPLE,
+    "results": []
+  }
+  with tempfile.TemporaryDirectory() as tmp:
+    for count in sizes:
+      result = bench_size(count, tmp)
+      run["results"].append(result)
+      print(f"{count} characters: insert {result['insert']['rows_per_second']:.0f} rows/s, "
+            f"save one p50 {result['save_one']['p50_ms']:.2f} ms, from_db p50 {result['from_db']['p50_ms']:.2f} ms, "
+            f"pull p50 {result['pull_character_from_db']['p50_ms']:.2f} ms, push {result['full_push']['seconds']:.2f}s, "
+            f"users rebuild {result['users_table_rebuild']['seconds']:.2f}s, {result['file_bytes'] / 2**20:.1f} MiB")
+  if os.path.dirname(out_path):
+    os.makedirs(os.path.dirname(out_path), exist_ok = True)
+  with open(out_path, "w") as f:
+    json.dump(run, f, indent = 2)
+  print(f"Results written to {out_path}")
@@ -0,0 +1,102 @@
+#Offline stand-in for the parts of discord.Interaction the command handlers use, so a command can run
+#without a gateway connection: bench_load.py drives it, and it is handy for trying a handler locally.
+#Usage:
+#  interaction = FakeInteraction(user_id)
+#  await run_command(main.roll, interaction, dice = "2d6")
+#  interaction.messages[-1].content
+import asyncio
+import itertools
+import time
+
+#mirrors what discord would refuse: answering an interaction twice, or a followup before any response
+class FakeInteractionError(Exception):
+  pass
+
+#a message the handler sent, with when it was sent (perf_counter) for latency numbers
+class FakeMessage:
+  __slots__ = ("content", "embed", "view", "ephemeral", "sent_at")
+  def __init__(self, content = None, embed = None, view = None, ephemeral = False):
+    self.content = content
+    self.embed = embed
+    self.view = view
+    self.ephemeral = ephemeral
+    self.sent_at = time.perf_counter()
+  def __repr__(self):
+    return f"<FakeMessage {self.content!r}>"
+
+class FakeUser:
+  __slots__ = ("id", "name")
+  def __init__(self, user_id: int, name: str = None):
+    self.id = user_id
+    self.name = name or f"user{user_id}"
+  @property
+  def mention(self):
+    return f"<@{self.id}>"
+  @property
+  def display_name(self):
+    return self.name
+
+class FakeResponse:
+  def __init__(self, interaction):
+    self.interaction = interaction
+    self.responded = False
+  def is_done(self):
+    return self.responded
+  def _respond(self):
+    if self.responded:
+      raise FakeInteractionError("This interaction has already been responded to before")
+    self.responded = True
+    self.interaction.responded_at = time.perf_counter()
+  async def send_message(self, content = None, *, embed = None, view = None, ephemeral = False, **kwargs):
+    self._respond()
+    self.interaction.post(FakeMessage(content, embed, view, ephemeral))
+  async def defer(self, *, ephemeral = False, thinking = False):
+    self._respond()
+  async def edit_message(self, *, content = None, embed = None, view = None, **kwargs):
+    self._respond()
+    self.interaction.post(FakeMessage(content, embed, view))
+  async def send_modal(self, modal):
+    self._respond()
+    self.interaction.modal = modal
+
+class FakeFollowup:
+  def __init__(self, interaction):
+    self.interaction = interaction
+  async def send(self, content = None, *, embed = None, view = None, ephemeral = False, **kwargs):
+    if not self.interaction.response.responded:
+      raise FakeInteractionError("Unknown Webhook: followup sent before the interaction was responded to")
+    self.interaction.post(FakeMessage(content, embed, view, ephemeral))
+
+#One slash command invocation. Messages the handler sends collect in messages.
+#chooser, if given, is called with every view sent with a message and plays the user's part (picking
+#from a select menu, pressing a button) so handlers that wait on a view can finish
+class FakeInteraction:
+  ids = itertools.count(1)
+  def __init__(self, user_id: int, guild_id: int = None, channel_id: int = None, chooser = None):
+    self.id = next(self.ids)
+    self.user = FakeUser(user_id)
+    self.guild_id = guild_id
+    self.channel_id = channel_id
+    self.command = None
+    self.chooser = chooser
+    self.response = FakeResponse(self)
+    self.followup = FakeFollowup(self)
+    self.messages = []
+    self.modal = None
+    self.created_at = time.perf_counter()
+    self.responded_at = None
+  def post(self, message: FakeMessage):
+    self.messages.append(message)
+    if message.view is not None and self.chooser is not None:
+      #after the send returns, like a user clicking once the message shows up
+      asyncio.get_running_loop().call_soon(self.chooser, message.view)
+  async def edit_original_response(self, *, content = None, embed = None, view = None, **kwargs):
+    if not self.response.responded:
+      raise FakeInteractionError("Unknown Webhook: nothing to edit before the interaction was responded to")
+    self.post(FakeMessage(content, embed, view))
+
+#runs an app command's handler the way the command tree would, minus option parsing and checks
+async def run_command(command, interaction: FakeInteraction, **options):
+  interaction.command = command
+  await command.callback(interaction, **options)
+  return interaction
@@ -1,25 +1,314 @@
+import array
+import asyncio
+import atexit
+import bisect
+import contextlib
+import csv
+import heapq
 import discord
 from discord.ext import commands
 from discord import app_commands, Interaction, ui
+from collections import namedtuple
+from collections.abc import Mapping, MutableMapping, Sequence
+from concurrent.futures import ProcessPoolExecutor
 from typing import List
 import random
 import ctypes
+import functools
+import hashlib
+import http.server
+import io
 import json
+import mmap
 from dotenv import load_dotenv
 import os
 import re
 import sqlite3 as lite
+import struct
 import sys
 import threading
 import time
+import traceback
 import logging
+import logging.handlers
+import queue
+#process start, for the startup to ready time logged in on_ready
+process_start = time.perf_counter()
 
+#Startup timing report, turned on with STARTUP_PROFILE=1 in the environment.
+#Phases are timed with perf_counter from process start and logged together by report
+class StartupProfile:
+  def __init__(self, enabled: bool):
+    self.enabled = enabled
+    self.lock = threading.Lock()
+    self.phases = [] #[(name, started at, seconds)], started at is relative to process start
+    self.last_mark = process_start
+  @contextlib.contextmanager
+  def phase(self, name):
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      end = time.perf_counter()
+      with self.lock:
+        self.phases.append((name, start - process_start, end - start))
+  def mark(self, name):
+    #for module level code: times everything since the previous mark
+    now = time.perf_counter()
+    with self.lock:
+      self.phases.append((name, self.last_mark - process_start, now - self.last_mark))
+      self.last_mark = now
+  def report(self, title = "Startup profile"):
+    #logs and forgets the phases recorded so far
+    with self.lock:
+      phases, self.phases = self.phases, []
+    if not self.enabled or not phases:
+      return
+    lines = [f"  {name:<24} {seconds * 1000:8.1f} ms  (at {started * 1000:.1f} ms)" for name, started, seconds in phases]
+    logging.info(f"{title}:\n" + "\n".join(lines))
+
+startup_profile = StartupProfile(os.getenv("STARTUP_PROFILE", "") not in ("", "0"))
+#numpy is only needed for the encounter simulator
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+startup_profile.mark("optional imports")
 load_dotenv()
-logging.basicConfig(level = logging.INFO,
-                    format = '[%(levelname)s] %(asctime)s - %(message)s',
-                    handlers = [logging.FileHandler("bot.log"), logging.StreamHandler()]
-                   )
-db_path = os.path.join(os.path.dirname(__file__),"characters.db")
+
+#one JSON object per line for the log file, turned on with LOG_FORMAT=json
+class JsonLineFormatter(logging.Formatter):
+  def format(self, record):
+    return json.dumps({
+      "time": self.formatTime(record),
+      "level": record.levelname,
+      "thread": record.threadName,
+      "message": record.getMessage()
+    })
+
+#Logging calls only put the record on a queue. A QueueListener thread does the file and console
+#writes, so a burst of log lines never adds disk I/O to the event loop or a command.
+#The file (LOG_PATH, default bot.log) rotates at LOG_MAX_BYTES (default 5 MB), keeping LOG_BACKUPS old files (default 5)
+def setup_logging(path = "bot.log"):
+  text_format = logging.Formatter('[%(levelname)s] %(asctime)s - %(message)s')
+  #delay = True leaves the log file closed until the first record is written
+  file_handler = logging.handlers.RotatingFileHandler(path, maxBytes = int(os.getenv("LOG_MAX_BYTES", 5 * 1024 * 1024)),
+                                                      backupCount = int(os.getenv("LOG_BACKUPS", 5)),
+                                                      encoding = "utf-8", delay = True)
+  file_handler.setFormatter(JsonLineFormatter() if os.getenv("LOG_FORMAT", "").lower() == "json" else text_format)
+  stream_handler = logging.StreamHandler()
+  stream_handler.setFormatter(text_format)
+  log_queue = queue.SimpleQueue()
+  queue_handler = logging.handlers.QueueHandler(log_queue)
+  #the queued record carries the bare message (and traceback), the listener's handlers add the rest
+  queue_handler.setFormatter(logging.Formatter("%(message)s"))
+  logging.basicConfig(level = logging.INFO, handlers = [queue_handler])
+  listener = logging.handlers.QueueListener(log_queue, file_handler, stream_handler, respect_handler_level = True)
+  listener.start()
+  #stop drains whatever is still queued, so the last lines before exit make it to the file
+  atexit.register(listener.stop)
+  return listener
+
+log_listener = setup_logging(os.getenv("LOG_PATH", "bot.log"))
+startup_profile.mark("environment and logging")
+
+#Metrics, served in Prometheus text format on 127.0.0.1:METRICS_PORT (default 9108, 0 turns it off) and by /stats.
+#Families hand out one child per label values; callers keep the child, so recording a sample
+#is a bisect and a couple of additions, well under a microsecond. Samples are not locked: two threads
+#recording at the same instant can very rarely lose one, which a latency histogram can live with
+latency_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+  __slots__ = ("buckets", "counts", "total", "count")
+  def __init__(self, buckets = latency_buckets):
+    self.buckets = buckets
+    self.counts = [0] * (len(buckets) + 1) #last one is +Inf
+    self.total = 0.0
+    self.count = 0
+  def observe(self, value):
+    self.counts[bisect.bisect_left(self.buckets, value)] += 1
+    self.total += value
+    self.count += 1
+  def quantile(self, q):
+    #upper bound of the bucket the q-th sample falls in, good enough for a summary
+    counts = list(self.counts)
+    count = sum(counts)
+    seen = 0
+    for i, n in enumerate(counts):
+      seen += n
+      if count and seen >= q * count:
+        return self.buckets[i] if i < len(self.buckets) else float("inf")
+    return 0.0
+
+class Counter:
+  __slots__ = ("value",)
+  def __init__(self):
+    self.value = 0
+  def inc(self, amount = 1):
+    self.value += amount
+
+#a value that goes up and down, ie commands in flight
+class Gauge(Counter):
+  __slots__ = ()
+  def dec(self, amount = 1):
+    self.value -= amount
+
+#A named metric with label names, ie command_seconds with ("command", "kind")
+class MetricFamily:
+  def __init__(self, name, help, kind, label_names, make):
+    self.name = name
+    self.help = help
+    self.kind = kind #histogram, counter or gauge
+    self.label_names = label_names
+    self.make = make
+    self.lock = threading.Lock()
+    self.children = {} #Format {label values tuple: Histogram, Counter or Gauge}
+  def labels(self, *values):
+    child = self.children.get(values)
+    if child is None:
+      with self.lock:
+        child = self.children.setdefault(values, self.make())
+    return child
+  def items(self):
+    with self.lock:
+      return list(self.children.items())
+
+class Metrics:
+  def __init__(self):
+    self.families = []
+  def histogram(self, name, help, *label_names):
+    family = MetricFamily(name, help, "histogram", label_names, Histogram)
+    self.families.append(family)
+    return family
+  def counter(self, name, help, *label_names):
+    family = MetricFamily(name, help, "counter", label_names, Counter)
+    self.families.append(family)
+    return family
+  def gauge(self, name, help, *label_names):
+    family = MetricFamily(name, help, "gauge", label_names, Gauge)
+    self.families.append(family)
+    return family
+  def render(self):
+    #Prometheus text exposition format
+    lines = []
+    for family in self.families:
+      lines.append(f"# HELP {family.name} {family.help}")
+      lines.append(f"# TYPE {family.name} {family.kind}")
+      for values, child in sorted(family.items()):
+        labels = ",".join(f'{name}="{value}"' for name, value in zip(family.label_names, values))
+        if family.kind != "histogram":
+          lines.append(f"{family.name}{{{labels}}} {child.value}")
+          continue
+        counts, total = list(child.counts), child.total
+        count = sum(counts)
+        sep = "," if labels else ""
+        cumulative = 0
+        for bound, n in zip(list(child.buckets) + ["+Inf"], counts):
+          cumulative += n
+          lines.append(f'{family.name}_bucket{{{labels}{sep}le="{bound}"}} {cumulative}')
+        lines.append(f"{family.name}_sum{{{labels}}} {total}")
+        lines.append(f"{family.name}_count{{{labels}}} {count}")
+    return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+command_seconds = metrics.histogram("dnd_command_seconds", "App command and autocomplete handling time", "command", "kind")
+command_errors = metrics.counter("dnd_command_errors_total", "App commands that raised", "command")
+storage_seconds = metrics.histogram("dnd_storage_seconds", "Time spent in each storage function", "function")
+query_seconds = metrics.histogram("dnd_query_seconds", "Time per sqlite statement by statement kind and table", "query")
+push_rows = metrics.counter("dnd_push_rows_total", "Characters written by cache pushes")
+cache_events = metrics.counter("dnd_cache_events_total", "Cache lookups and evictions", "cache", "event")
+slot_engine_seconds = metrics.histogram("dnd_slot_engine_seconds", "Time per call into the slot machine library")
+loop_lag_seconds = metrics.histogram("dnd_loop_lag_seconds", "How late the event loop ran the watchdog heartbeat")
+loop_stalls = metrics.counter("dnd_loop_stalls_total", "Event loop stalls past the watchdog threshold, by the function that was running", "function")
+scheduler_wait_seconds = metrics.histogram("dnd_scheduler_wait_seconds", "Time app commands waited for a free slot", "priority")
+scheduler_rejections = metrics.counter("dnd_scheduler_rejections_total", "App commands turned away by the scheduler", "reason", "priority")
+scheduler_running = metrics.gauge("dnd_scheduler_running", "App commands holding a scheduler slot", "priority")
+
+#times every call of a function into storage_seconds, labelled with the function's name
+def timed(func):
+  histogram = storage_seconds.labels(func.__qualname__)
+  @functools.wraps(func)
+  def wrapper(*args, **kwargs):
+    start = time.perf_counter()
+    try:
+      return func(*args, **kwargs)
+    finally:
+      histogram.observe(time.perf_counter() - start)
+  return wrapper
+
+#"SELECT dnd_characters", "INSERT character_resources"... one label per statement text, worked out once
+query_labels = {}
+query_table = re.compile(r"\b(?:FROM|INTO|UPDATE|TABLE(?: IF NOT EXISTS)?|ON)\s+(\w+)", re.IGNORECASE)
+def query_label(sql):
+  label = query_labels.get(sql)
+  if label is None:
+    match = query_table.search(sql)
+    label = f"{sql.split(None, 1)[0].upper()} {match.group(1) if match else ''}".strip()
+    #statements are literals so this stays small, the cap is only a guard
+    if len(query_labels) < 512:
+      query_labels[sql] = label
+  return query_seconds.labels(label)
+
+#sqlite connection that times every statement, pass factory = TimedConnection to lite.connect
+class TimedCursor(lite.Cursor):
+  def execute(self, sql, parameters = ()):
+    start = time.perf_counter()
+    try:
+      return super().execute(sql, parameters)
+    finally:
+      query_label(sql).observe(time.perf_counter() - start)
+  def executemany(self, sql, parameters):
+    start = time.perf_counter()
+    try:
+      return super().executemany(sql, parameters)
+    finally:
+      query_label(sql).observe(time.perf_counter() - start)
+
+class TimedConnection(lite.Connection):
+  def cursor(self, factory = TimedCursor):
+    return super().cursor(factory)
+  def execute(self, sql, parameters = ()):
+    return self.cursor().execute(sql, parameters)
+  def executemany(self, sql, parameters):
+    return self.cursor().executemany(sql, parameters)
+
+#serves metrics.render() at /metrics
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+  def do_GET(self):
+    if self.path.split("?")[0] != "/metrics":
+      self.send_error(404)
+      return
+    body = metrics.render().encode("utf-8")
+    self.send_response(200)
+    self.send_header("Content-Type", "text/plain; version=0.0.4")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+  def log_message(self, format, *args):
+    #scrapes every few seconds would drown out bot.log
+    pass
+
+def start_metrics_server(port = int(os.getenv("METRICS_PORT", "9108"))):
+  if not port:
+    return None
+  try:
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+  except OSError as e:
+    logging.error(f"Could not start metrics endpoint on port {port}: {e}")
+    return None
+  thread = threading.Thread(target = server.serve_forever, daemon = True)
+  thread.start()
+  logging.info(f"Serving metrics on http://127.0.0.1:{port}/metrics")
+  return server
+#DB_PATH and SNAPSHOT_PATH point the bot at other files, ie a scratch database for bench_load.py
+db_path = os.getenv("DB_PATH", os.path.join(os.path.dirname(__file__),"characters.db"))
+#bundled spell reference, see SpellCatalog
+spells_path = os.path.join(os.path.dirname(__file__),"spells.json")
+#fingerprint of the last command tree synced to discord, see sync_command_tree
+tree_hash_path = os.path.join(os.path.dirname(__file__),"command_tree.hash")
+#snapshot of the character cache, used to warm the cache back up after a restart
+snapshot_path = os.getenv("SNAPSHOT_PATH", os.path.join(os.path.dirname(__file__),"characters.snapshot"))
 #need to store maximum ID from database on initialization in a local object
 max_id = 0
 max_id_lock = threading.Lock()
@@ -31,21 +320,13 @@ def get_next_id():
     val = max_id
   return val
 
-def init_max_id_from_db(db = db_path):
+#a block of count new ids taken in one go, for bulk imports
+def allocate_ids(count: int):
   global max_id
-  try:
-    conn = lite.connect(db)
-    cursor = conn.cursor()
-    cursor.execute("SELECT MAX(id) FROM dnd_characters")
-    row = cursor.fetchone()
-    max_id = (row[0] or 0) + 1
-  except Exception as e:
-    logging.error(f"Failed to initialize max_id from database: {e}")
-  finally:
-    conn.close()
-
-#initialize cache
-dnd_cache = DnD_Cache()
+  with max_id_lock:
+    first = max_id + 1
+    max_id += count
+  return range(first, first + count)
 
 #These are the levels each class gets its subclass
 subclass_levels = {
@@ -81,6 +362,368 @@ class_dice = {
   "wizard": 6
 }
 
+#{die: [current, max]} hit dice for a {class: level} dict, all of them unspent
+def hit_dice_for(classes: dict):
+  hit_dice = {}
+  for cls, lvl in classes.items():
+    die = class_dice[cls]
+    hit_dice.setdefault(die, [0, 0])
+    hit_dice[die][0] += lvl
+    hit_dice[die][1] += lvl
+  return hit_dice
+
+#Ability score each skill rolls with
+skill_abilities = {
+  "acrobatics": "dex",
+  "animal handling": "wis",
+  "arcana": "int",
+  "athletics": "str",
+  "deception": "cha",
+  "history": "int",
+  "insight": "wis",
+  "intimidation": "cha",
+  "investigation": "int",
+  "medicine": "wis",
+  "nature": "int",
+  "perception": "wis",
+  "performance": "cha",
+  "persuasion": "cha",
+  "religion": "int",
+  "sleight of hand": "dex",
+  "stealth": "dex",
+  "survival": "wis"
+}
+
+#Short stat names as used in DnD_Char.stats with their full names
+ability_names = {
+  "str": "strength",
+  "dex": "dexterity",
+  "con": "constitution",
+  "int": "intelligence",
+  "wis": "wisdom",
+  "cha": "charisma"
+}
+
+#Points that come back on a short rest, with the class and level that gives the short rest recovery
+#Everything else (and every resource on a long rest) only comes back on a long rest
+short_rest_resources = {
+  "action surge": {"fighter": 2},
+  "second wind": {"fighter": 1},
+  "superiority dice": {"fighter": 3},
+  "ki points": {"monk": 2},
+  "ki": {"monk": 2},
+  "channel divinity": {"cleric": 2, "paladin": 3},
+  "bardic inspiration": {"bard": 5},
+  "wild shape": {"druid": 2},
+  "pact slots": {"warlock": 1}
+}
+
+#Classes with their own spell slots. Warlock slots come back on a short rest, but only when
+#warlock is the character's sole spellcasting class, as the slots can't be told apart otherwise
+spellcasting_classes = {"artificer", "bard", "cleric", "druid", "paladin", "ranger", "sorcerer", "warlock", "wizard"}
+
+#Every check a character can roll: abilities ("dex"), saves ("dex save") and skills ("stealth")
+check_names = list(ability_names) + [f"{stat} save" for stat in ability_names] + list(skill_abilities)
+
+#Fixed layout of the numeric core every DnD_Char keeps in one array instead of separate dicts and lists
+core_stats = tuple(ability_names) #ability scores sit at 0-5 in this order
+CORE_HP = 6 #current, max
+CORE_AC = 8
+CORE_MS = 9
+CORE_XP = 10
+CORE_EXHAUSTION = 11
+CORE_SLOTS = 12 #current, max for spell slot levels 1-9
+CORE_SIZE = CORE_SLOTS + 18
+NO_SLOT = -1 #max value for a slot level the character does not have
+stat_index = {stat: i for i, stat in enumerate(core_stats)}
+
+#Strings repeated across characters (races, classes, spell names...) are interned so
+#thousands of cached characters share one copy. Returns new containers
+def intern_strings(obj):
+  if isinstance(obj, str):
+    return sys.intern(obj)
+  if isinstance(obj, dict):
+    return {intern_strings(key): intern_strings(val) for key, val in obj.items()}
+  if isinstance(obj, list):
+    return [intern_strings(val) for val in obj]
+  return obj
+
+#[current, max] view into a core array, stands in for the two item lists used for hp and slots
+class CorePair(Sequence):
+  __slots__ = ("core", "base")
+  def __init__(self, core, base):
+    self.core = core
+    self.base = base
+  def __len__(self):
+    return 2
+  def __getitem__(self, i):
+    return self.core[self.base + range(2)[i]]
+  def __setitem__(self, i, val):
+    self.core[self.base + range(2)[i]] = val
+  def __eq__(self, other):
+    return isinstance(other, (list, tuple, CorePair)) and list(self) == list(other)
+  def __repr__(self):
+    return repr(list(self))
+
+#ability scores view, behaves like the old {"str": 10,...} dict
+class StatBlock(MutableMapping):
+  __slots__ = ("core",)
+  def __init__(self, core):
+    self.core = core
+  def __getitem__(self, key):
+    return self.core[stat_index[key]]
+  def __setitem__(self, key, val):
+    self.core[stat_index[key]] = val
+  def __delitem__(self, key):
+    raise TypeError("Ability scores can not be removed")
+  def __iter__(self):
+    return iter(core_stats)
+  def __len__(self):
+    return len(core_stats)
+  def __repr__(self):
+    return repr(dict(self))
+
+#spell slots view, behaves like the old {"level": [current, max],...} dict
+class SpellSlotTable(MutableMapping):
+  __slots__ = ("core",)
+  def __init__(self, core):
+    self.core = core
+  def _index(self, level):
+    try:
+      level = int(level)
+    except (TypeError, ValueError):
+      raise KeyError(level)
+    if not 1 <= level <= 9:
+      raise KeyError(level)
+    return CORE_SLOTS + 2 * (level - 1)
+  def __getitem__(self, level):
+    i = self._index(level)
+    if self.core[i + 1] == NO_SLOT:
+      raise KeyError(level)
+    return CorePair(self.core, i)
+  def __setitem__(self, level, val):
+    i = self._index(level)
+    self.core[i], self.core[i + 1] = val
+  def __delitem__(self, level):
+    i = self._index(level)
+    if self.core[i + 1] == NO_SLOT:
+      raise KeyError(level)
+    self.core[i], self.core[i + 1] = 0, NO_SLOT
+  def __iter__(self):
+    for level in range(1, 10):
+      if self.core[CORE_SLOTS + 2 * level - 1] != NO_SLOT:
+        yield str(level)
+  def __len__(self):
+    return sum(1 for _ in self)
+  def to_dict(self):
+    return {level: list(pair) for level, pair in self.items()}
+  def __repr__(self):
+    return repr(self.to_dict())
+
+#Weapons from the player's handbook, used to seed the weapons table
+#(name, damage dice, damage type, category, ranged, properties)
+weapon_seed = [
+  ("club", "1d4", "bludgeoning", "simple", 0, ["light"]),
+  ("dagger", "1d4", "piercing", "simple", 0, ["finesse", "light", "thrown"]),
+  ("greatclub", "1d8", "bludgeoning", "simple", 0, ["two-handed"]),
+  ("handaxe", "1d6", "slashing", "simple", 0, ["light", "thrown"]),
+  ("javelin", "1d6", "piercing", "simple", 0, ["thrown"]),
+  ("light hammer", "1d4", "bludgeoning", "simple", 0, ["light", "thrown"]),
+  ("mace", "1d6", "bludgeoning", "simple", 0, []),
+  ("quarterstaff", "1d6", "bludgeoning", "simple", 0, ["versatile (1d8)"]),
+  ("sickle", "1d4", "slashing", "simple", 0, ["light"]),
+  ("spear", "1d6", "piercing", "simple", 0, ["thrown", "versatile (1d8)"]),
+  ("light crossbow", "1d8", "piercing", "simple", 1, ["ammunition", "loading", "two-handed"]),
+  ("dart", "1d4", "piercing", "simple", 1, ["finesse", "thrown"]),
+  ("shortbow", "1d6", "piercing", "simple", 1, ["ammunition", "two-handed"]),
+  ("sling", "1d4", "bludgeoning", "simple", 1, ["ammunition"]),
+  ("battleaxe", "1d8", "slashing", "martial", 0, ["versatile (1d10)"]),
+  ("flail", "1d8", "bludgeoning", "martial", 0, []),
+  ("glaive", "1d10", "slashing", "martial", 0, ["heavy", "reach", "two-handed"]),
+  ("greataxe", "1d12", "slashing", "martial", 0, ["heavy", "two-handed"]),
+  ("greatsword", "2d6", "slashing", "martial", 0, ["heavy", "two-handed"]),
+  ("halberd", "1d10", "slashing", "martial", 0, ["heavy", "reach", "two-handed"]),
+  ("lance", "1d12", "piercing", "martial", 0, ["reach", "special"]),
+  ("longsword", "1d8", "slashing", "martial", 0, ["versatile (1d10)"]),
+  ("maul", "2d6", "bludgeoning", "martial", 0, ["heavy", "two-handed"]),
+  ("morningstar", "1d8", "piercing", "martial", 0, []),
+  ("pike", "1d10", "piercing", "martial", 0, ["heavy", "reach", "two-handed"]),
+  ("rapier", "1d8", "piercing", "martial", 0, ["finesse"]),
+  ("scimitar", "1d6", "slashing", "martial", 0, ["finesse", "light"]),
+  ("shortsword", "1d6", "piercing", "martial", 0, ["finesse", "light"]),
+  ("trident", "1d6", "piercing", "martial", 0, ["thrown", "versatile (1d8)"]),
+  ("war pick", "1d8", "piercing", "martial", 0, []),
+  ("warhammer", "1d8", "bludgeoning", "martial", 0, ["versatile (1d10)"]),
+  ("whip", "1d4", "slashing", "martial", 0, ["finesse", "reach"]),
+  ("blowgun", "1d1", "piercing", "martial", 1, ["ammunition", "loading"]),
+  ("hand crossbow", "1d6", "piercing", "martial", 1, ["ammunition", "light", "loading"]),
+  ("heavy crossbow", "1d10", "piercing", "martial", 1, ["ammunition", "heavy", "loading", "two-handed"]),
+  ("longbow", "1d8", "piercing", "martial", 1, ["ammunition", "heavy", "two-handed"])
+]
+
+#A weapons table row with its damage dice already parsed
+Weapon = namedtuple("Weapon", ["name", "count", "sides", "damage_type", "category", "ranged", "properties"])
+#A character's attack with one weapon: d20 + to_hit to hit, count d sides + damage_mod damage
+CompiledAttack = namedtuple("CompiledAttack", ["to_hit", "count", "sides", "damage_mod"])
+
+#Every weapon in the weapons table, loaded once. Every word start of every name is kept in a
+#sorted list so autocomplete is a binary search ("cross" finds "light crossbow") and never touches the database
+class WeaponCatalog:
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.weapons = {} #Format {name: Weapon}
+    self.prefixes = [] #sorted [(name from a word start, name),...]
+    self.loaded = False
+  @timed
+  def load(self, db = db_path):
+    conn = lite.connect(db, factory = TimedConnection)
+    try:
+      rows = conn.execute("SELECT name, damage, damage_type, category, ranged, properties FROM weapons").fetchall()
+    finally:
+      conn.close()
+    weapons = {}
+    prefixes = []
+    for name, damage, damage_type, category, ranged, properties in rows:
+      count, sides = (int(part) for part in damage.split("d"))
+      weapons[name] = Weapon(name, count, sides, damage_type, category, bool(ranged), tuple(json.loads(properties)))
+      prefixes.extend((name[m.start():], name) for m in re.finditer(r"\b\w", name))
+    prefixes.sort()
+    with self.lock:
+      self.weapons = weapons
+      self.prefixes = prefixes
+      self.loaded = True
+    logging.info(f"Loaded {len(weapons)} weapons.")
+  def ensure_loaded(self):
+    if not self.loaded:
+      self.load()
+  def get(self, name):
+    self.ensure_loaded()
+    return self.weapons.get(name.strip().lower())
+  def search(self, prefix, limit = 25):
+    self.ensure_loaded()
+    prefix = prefix.strip().lower()
+    prefixes = self.prefixes
+    found = []
+    i = bisect.bisect_left(prefixes, (prefix,))
+    while i < len(prefixes) and prefixes[i][0].startswith(prefix) and len(found) < limit:
+      if prefixes[i][1] not in found:
+        found.append(prefixes[i][1])
+      i += 1
+    return found
+
+weapon_catalog = WeaponCatalog()
+
+#A spell from the bundled reference
+SpellInfo = namedtuple("SpellInfo", ["name", "level", "school", "casting_time", "range", "components", "duration", "concentration", "classes", "summary"])
+
+#trigrams of a lower case string, padded so word starts weigh more
+def trigrams(text):
+  padded = f"  {text} "
+  return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+#The bundled spell list (common spells from the player's handbook and a few supplements, not every spell there is), loaded once into a trigram index for autocomplete and typo tolerant lookups.
+#Postings are uint16 arrays and indexing stops at budget bytes so the index can never outgrow its budget
+class SpellCatalog:
+  def __init__(self, path = spells_path, budget = 1 << 20):
+    self.path = path
+    self.budget = budget
+    self.lock = threading.Lock()
+    self.spells = [] #SpellInfo sorted by name, the position is the spell's id in the index
+    self.names = [] #sorted names, for prefix search and exact lookups
+    self.index = {} #Format {trigram: array of spell ids}
+    self.gram_counts = array.array("H")
+    self.size = 0 #approximate bytes held by the index
+    self.loaded = False
+  def load(self):
+    with open(self.path, encoding = "utf-8") as f:
+      entries = sorted(json.load(f), key = lambda e: e["name"])
+    spells = []
+    index = {}
+    gram_counts = array.array("H")
+    size = 0
+    for entry in entries:
+      name = sys.intern(entry["name"].lower())
+      grams = trigrams(name)
+      spell = SpellInfo(name, entry["level"], sys.intern(entry["school"]), sys.intern(entry["casting_time"]),
+                        sys.intern(entry["range"]), sys.intern(entry["components"]), sys.intern(entry["duration"]),
+                        entry["concentration"], tuple(sys.intern(c) for c in entry["classes"]), entry["summary"])
+      cost = sys.getsizeof(spell) + sys.getsizeof(spell.summary) + 2 * len(grams)
+      if size + cost > self.budget or len(spells) >= 0xFFFF:
+        logging.warning(f"Spell index budget of {self.budget} bytes reached, {len(entries) - len(spells)} spells left out.")
+        break
+      spell_id = len(spells)
+      for gram in grams:
+        postings = index.get(gram)
+        if postings is None:
+          postings = index[gram] = array.array("H")
+          cost += sys.getsizeof(postings) + sys.getsizeof(gram)
+        postings.append(spell_id)
+      spells.append(spell)
+      gram_counts.append(len(grams))
+      size += cost
+    with self.lock:
+      self.spells = spells
+      self.names = [spell.name for spell in spells]
+      self.index = index
+      self.gram_counts = gram_counts
+      self.size = size
+      self.loaded = True
+    logging.info(f"Loaded {len(spells)} spells into a {size // 1024} KiB index.")
+  def ensure_loaded(self):
+    if not self.loaded:
+      self.load()
+  def get(self, name):
+    self.ensure_loaded()
+    name = name.strip().lower()
+    i = bisect.bisect_left(self.names, name)
+    if i < len(self.names) and self.names[i] == name:
+      return self.spells[i]
+    return None
+  def search(self, query, limit = 25):
+    #names starting with the query first, then the closest trigram matches for typos
+    self.ensure_loaded()
+    query = query.strip().lower()
+    names = self.names
+    i = bisect.bisect_left(names, query)
+    found = []
+    while i < len(names) and names[i].startswith(query) and len(found) < limit:
+      found.append(names[i])
+      i += 1
+    if len(found) < limit and query:
+      grams = trigrams(query)
+      shared = {}
+      for gram in grams:
+        for spell_id in self.index.get(gram, ()):
+          shared[spell_id] = shared.get(spell_id, 0) + 1
+      #jaccard similarity of the trigram sets
+      scored = sorted(((hits / (len(grams) + self.gram_counts[spell_id] - hits), spell_id) for spell_id, hits in shared.items()), reverse = True)
+      for score, spell_id in scored:
+        if score < 0.2 or len(found) >= limit:
+          break
+        if names[spell_id] not in found:
+          found.append(names[spell_id])
+    return found
+
+spell_catalog = SpellCatalog()
+
+#for DnD_Char methods that change the character: bumps its version so anything keyed on
+#(character id, version), like rendered sheets, knows to rebuild. A method that returns False
+#changed nothing (ie a spend the character couldn't afford) and leaves the version alone.
+#The bump comes after the change, so a sheet rendered in between is rebuilt rather than kept stale.
+#Only the outermost call bumps, so level_up calling add_new_subclass is still one change
+def bumps_version(method):
+  @functools.wraps(method)
+  def wrapper(self, *args, **kwargs):
+    self._changing += 1
+    try:
+      result = method(self, *args, **kwargs)
+    finally:
+      self._changing -= 1
+    if result is not False and self._changing == 0:
+      self.version += 1
+    return result
+  return wrapper
+
 #Create classes for caching
 #DnD_Char is a class that contains a single dungeons and dragons 5e character
 #User is a class that contains a User that may contain none or amny characters
@@ -89,10 +732,18 @@ class DnD_Char:
   #stats should be a dictionary with int, cha, wis, str, con, dex as keys
   #classes is the starting class str
   #race, name, background are strings
+  #stats, hp, ac, ms, xp, exhaustion and spell slots live in _core, see CORE_* above
   __slots__ = (
+  "name", "owner", "race", "background", "classes", "subclasses", "hit_dice",
+  "abilities", "spells", "languages", "equipment", "points",
+  "feats", "proficiencies", "Id", "notes", "version",
+  "_core", "_checks", "_attacks", "_changing"
+  )
+  #constructor arguments, in the order they are stored in snapshots
+  fields = (
   "name", "owner", "race", "background", "classes", "subclasses", "hit_dice", "xp",
   "abilities", "spell_slots", "spells", "stats", "languages", "equipment", "points",
-  "feats", "hp", "ac", "ms", "exhaustion", "proficiencies", "Id", "notes"
+  "feats", "hp", "ac", "ms", "exhaustion", "proficiencies", "Id", "notes", "version"
   )
   def __init__(self, 
                owner: int,
@@ -117,61 +768,142 @@ class DnD_Char:
                equipment: dict = None,
                feats: list = None,
                exhaustion: int = 0,
-               proficiencies: dict = None):
+               proficiencies: dict = None,
+               version: int = 0):
+    self._core = array.array("i", bytes(4 * CORE_SIZE))
     self.name = name
     self.owner = owner
-    self.race = race
-    self.background = background
-    self.classes = classes 
-    self.subclasses = subclasses or {}
+    self.race = intern_strings(race)
+    self.background = intern_strings(background)
+    self.classes = intern_strings(classes)
+    self.subclasses = intern_strings(subclasses or {})
     self.hit_dice = hit_dice
     self.xp = xp
     self.notes = notes or []
-    self.abilities = abilities or []
+    self.abilities = intern_strings(abilities or [])
     self.spell_slots = spell_slots or {} #type: [current, max]
-    self.spells = spells or {} #prepared or known, depending on class {"known": {level: [spells]}, "prepared": {level: [spells]}}
+    self.spells = intern_strings(spells or {}) #prepared or known, depending on class {"known": {level: [spells]}, "prepared": {level: [spells]}}
     self.stats = stats
-    self.languages = languages or []
-    self.equipment = equipment or {}
-    self.points = points or {} #contains things like sorcery points etc - type: [current, max]
-    self.feats = feats or []
+    self.languages = intern_strings(languages or [])
+    self.equipment = intern_strings(equipment or {})
+    self.points = intern_strings(points or {}) #contains things like sorcery points etc - type: [current, max]
+    self.feats = intern_strings(feats or [])
     self.hp = hp #[current, max]
     self.ac = ac
     self.ms = ms
     self.exhaustion = exhaustion
-    self.proficiencies = proficiencies or {}
+    self.proficiencies = intern_strings(proficiencies or {})
     self.Id = Id #placeholder, will be overwritten with next integer for database table
+    self.version = version #bumped by every change and every database write. Used to spot stale snapshots and sheets
+    self._checks = None #derived check bonuses, see check_bonuses
+    self._attacks = None #compiled weapon attacks, see attack_roll
+    self._changing = 0 #depth of bumps_version methods running, see bumps_version
   def __repr__(self):
     return f"<DnD_Char {self.name} (ID {self.Id}), Level {self.get_level()}>"
+  #views and accessors over the numeric core
+  @property
+  def stats(self):
+    return StatBlock(self._core)
+  @stats.setter
+  def stats(self, new):
+    #a misspelt stat would otherwise be dropped and the real one left at 10
+    unknown = set(new) - set(core_stats)
+    if unknown:
+      raise ValueError(f"Unknown ability scores: {', '.join(sorted(map(str, unknown)))}")
+    for i, stat in enumerate(core_stats):
+      self._core[i] = new.get(stat, 10)
+  @property
+  def hp(self):
+    return CorePair(self._core, CORE_HP)
+  @hp.setter
+  def hp(self, new):
+    self._core[CORE_HP], self._core[CORE_HP + 1] = new
+  @property
+  def spell_slots(self):
+    return SpellSlotTable(self._core)
+  @spell_slots.setter
+  def spell_slots(self, new):
+    for level in range(1, 10):
+      i = CORE_SLOTS + 2 * (level - 1)
+      self._core[i], self._core[i + 1] = new.get(str(level), new.get(level, (0, NO_SLOT)))
+  @property
+  def ac(self):
+    return self._core[CORE_AC]
+  @ac.setter
+  def ac(self, val):
+    self._core[CORE_AC] = val
+  @property
+  def ms(self):
+    return self._core[CORE_MS]
+  @ms.setter
+  def ms(self, val):
+    self._core[CORE_MS] = val
+  @property
+  def xp(self):
+    return self._core[CORE_XP]
+  @xp.setter
+  def xp(self, val):
+    self._core[CORE_XP] = val
+  @property
+  def exhaustion(self):
+    return self._core[CORE_EXHAUSTION]
+  @exhaustion.setter
+  def exhaustion(self, val):
+    self._core[CORE_EXHAUSTION] = val
+  @bumps_version
+  def rename(self, name):
+    self.name = name
+  @bumps_version
   def add_lang(self, lang):
     self.languages.append(lang)
+  @bumps_version
   def add_ability(self, ability):
     self.abilities.append(ability)
+  @bumps_version
   def remove_ability(self, ability):
     self.abilities.remove(ability)
+  @bumps_version
   def remove_lang(self, lang):
     self.languages.remove(lang)
+  @bumps_version
   def update_stats(self, new):
     for key, val in new.items():
       self.stats[key] = val
+    self._clear_derived()
+  @bumps_version
+  def set_proficiency(self, name, level):
+    #level 1 for proficient, 2 for expertise, 0 to remove
+    name = name.strip().lower()
+    if level:
+      self.proficiencies[name] = level
+    else:
+      self.proficiencies.pop(name, None)
+    self._clear_derived()
+  @bumps_version
   def add_equip(self, thing, amount):
     if thing not in self.equipment:
       self.equipment[thing] = amount
     else:
       self.equipment[thing] += amount
+  @bumps_version
   def add_xp(self, amount):
     self.xp += amount
+  @bumps_version
   def add_feat(self, feat):
     self.feats.append(feat)
+  @bumps_version
   def change_ms(self, new):
     self.ms = new
   def get_modifier(self, stat_name):
     return (self.stats.get(stat_name, 10) - 10) // 2
+  @bumps_version
   def add_new_subclass(self, class_to_add: str, subclass: str):
     if class_to_add in self.classes and class_to_add not in self.subclasses:
       self.subclasses[class_to_add] = subclass
+  @bumps_version
   def level_up(self, new_class: str, hp_roll: int, subclass: str = None, stat_change = False, stats: dict = None, feat_add = False, feats: list = None, learn_spells = False, new_spells: dict = None):
     #stats is a dictionary of stats that are changing and an amount change
+    self._clear_derived()
     if stat_change:
       for key, val in stats.items():
         self.stats[key] += val
@@ -196,19 +928,66 @@ class DnD_Char:
     hp_gain = max(1, hp_roll + ((self.stats["con"] - 10) // 2))
     self.hp[1] += hp_gain
     self.hp[0] += hp_gain
+  @bumps_version
   def use_points(self, type, val):
-    if self.points[type][0] >= val:
-      self.points[type][0] -= val
+    #returns False rather than spending what the character doesn't have
+    points = self.points.get(type)
+    if points is None or val < 1 or points[0] < val:
+      return False
+    points[0] -= val
+    return True
+  @bumps_version
   def change_max_points(self, type, val):
     if type in self.points:
       self.points[type][1] = val
     else:
       self.points[type] = [val, val]
+  @bumps_version
   def cast_spell(self, level):
-    if level in self.spell_slots and self.spell_slots[level][0] > 0:
-      self.spell_slots[level][0] -= 1
+    slots = self.spell_slots.get(level)
+    if slots is None or slots[0] < 1:
+      return False
+    slots[0] -= 1
+    return True
+  def resources(self):
+    #every spendable resource as (kind, name, [current, max]), spell slots first
+    for level, pair in self.spell_slots.items():
+      yield "slot", level, pair
+    for name, pair in self.points.items():
+      yield "points", name, pair
+  def resource(self, key):
+    #key is "slot 3" for level 3 spell slots or the name of a points type, returns (kind, name, [current, max]) or None
+    match = re.fullmatch(r"slot ([1-9])", key)
+    if match:
+      pair = self.spell_slots.get(match.group(1))
+      return None if pair is None else ("slot", match.group(1), pair)
+    pair = self.points.get(key)
+    return None if pair is None else ("points", key, pair)
+  def recharge(self, kind, name):
+    #"short" or "long", the rest a resource comes back on for this character
+    if kind == "slot":
+      casters = spellcasting_classes.intersection(self.classes)
+      return "short" if casters == {"warlock"} else "long"
+    levels = short_rest_resources.get(name.lower().replace("_", " "), {})
+    return "short" if any(self.classes.get(cls, 0) >= lvl for cls, lvl in levels.items()) else "long"
+  @bumps_version
+  def restore_resource(self, kind, name, amount = None):
+    #amount None restores it to max, returns the current value before the change
+    pair = self.spell_slots[name] if kind == "slot" else self.points[name]
+    before = pair[0]
+    pair[0] = pair[1] if amount is None else min(pair[1], pair[0] + max(amount, 0))
+    return before
+  def short_rest(self):
+    #returns (kind, name, current before) for every resource that came back
+    restored = []
+    for kind, name, pair in self.resources():
+      if pair[0] < pair[1] and self.recharge(kind, name) == "short":
+        restored.append((kind, name, self.restore_resource(kind, name)))
+    return restored
+  @bumps_version
   def add_exhaustion(self, decrease = False):
     self.exhaustion = max(0, self.exhaustion - 1) if decrease else self.exhaustion + 1
+  @bumps_version
   def learn_spell(self, level, spell):
     if "known" not in self.spells:
       self.spells["known"] = {}
@@ -216,6 +995,7 @@ class DnD_Char:
       self.spells["known"][level] = []
     if spell not in self.spells["known"][level]:
       self.spells["known"][level].append(spell)
+  @bumps_version
   def long_rest(self, change_spells = False, spells = []):
     self.hp[0] = self.hp[1]
     for key, val in self.spell_slots.items():
@@ -226,6 +1006,7 @@ class DnD_Char:
       self.spells["prepared"] = spells
     if self.exhaustion > 0:
       self.add_exhaustion(decrease = True)
+  @bumps_version
   def change_hp(self, amount):
     self.hp[0] = max(self.hp[0] + amount, 0)
     if self.hp[0] > self.hp[1]:
@@ -234,6 +1015,45 @@ class DnD_Char:
     return sum(self.classes.values())
   def proficiency_bonus(self):
     return (-(-self.get_level() // 4)) + 1
+  def _proficiency_level(self, *names):
+    #proficiencies are typed in by hand, so accept "sleight_of_hand" as well as "sleight of hand"
+    levels = [self.proficiencies.get(n, 0) or self.proficiencies.get(n.replace(" ", "_"), 0) for n in names]
+    return max(levels)
+  def _clear_derived(self):
+    #anything computed from stats, classes or proficiencies
+    self._checks = None
+    self._attacks = None
+  def check_bonuses(self):
+    #Bonus for every entry in check_names. Built on first use and thrown away
+    #whenever stats, classes or proficiencies change so a check is just a lookup
+    if self._checks is None:
+      pb = self.proficiency_bonus()
+      checks = {}
+      for stat, full_name in ability_names.items():
+        mod = self.get_modifier(stat)
+        checks[stat] = mod
+        checks[f"{stat} save"] = mod + pb * self._proficiency_level(stat, f"{stat} save", full_name, f"{full_name} save")
+      for skill, stat in skill_abilities.items():
+        checks[skill] = self.get_modifier(stat) + pb * self._proficiency_level(skill)
+      self._checks = checks
+    return self._checks
+  def attack_roll(self, weapon):
+    #CompiledAttack for a Weapon from the catalog, worked out once per weapon until stats, classes or proficiencies change
+    if self._attacks is None:
+      self._attacks = {}
+    attack = self._attacks.get(weapon.name)
+    if attack is None:
+      if weapon.ranged:
+        mod = self.get_modifier("dex")
+      elif "finesse" in weapon.properties:
+        mod = max(self.get_modifier("str"), self.get_modifier("dex"))
+      else:
+        mod = self.get_modifier("str")
+      proficient = self._proficiency_level(f"{weapon.category} weapons", weapon.name, f"{weapon.name}s") > 0
+      to_hit = mod + (self.proficiency_bonus() if proficient else 0)
+      attack = CompiledAttack(to_hit, weapon.count, weapon.sides, mod)
+      self._attacks[weapon.name] = attack
+    return attack
   def to_dict(self):
     #for exporting to database cleanly and for throwing to a cache
     return {
@@ -245,13 +1065,13 @@ class DnD_Char:
       "classes": json.dumps(self.classes),
       "subclasses": json.dumps(self.subclasses),
       "hit_dice": json.dumps(self.hit_dice),
-      "stats": json.dumps(self.stats),
-      "hp": json.dumps(self.hp),
+      "stats": json.dumps(dict(self.stats)),
+      "hp": json.dumps(list(self.hp)),
       "ac": self.ac,
       "xp": self.xp,
       "abilities": json.dumps(self.abilities),
       "spells": json.dumps(self.spells),
-      "spell_slots": json.dumps(self.spell_slots),
+      "spell_slots": json.dumps(self.spell_slots.to_dict()),
       "points": json.dumps(self.points),
       "languages": json.dumps(self.languages),
       "equipment": json.dumps(self.equipment),
@@ -259,37 +1079,48 @@ class DnD_Char:
       "exhaustion": self.exhaustion,
       "proficiencies": json.dumps(self.proficiencies),
       "ms": self.ms,
-      "notes": json.dumps(self.notes)
+      "notes": json.dumps(self.notes),
+      "version": self.version
     }
-  def to_db(self, conn):
+  def to_snapshot(self):
+    #plain attribute dictionary for the cache snapshot, keys match the constructor arguments
+    data = {attr: getattr(self, attr) for attr in self.fields}
+    data["stats"] = dict(self.stats)
+    data["hp"] = list(self.hp)
+    data["spell_slots"] = self.spell_slots.to_dict()
+    return data
+  @timed
+  def to_db(self, conn, commit = True):
+    #commit = False lets callers write many characters in a single transaction
     cursor = conn.cursor()
+    self.version += 1
     main_data = self.to_dict()
     cursor.execute("""
     INSERT INTO dnd_characters (
-      id, owner, name, race, background, classes, hit_dice, stats, hp, ac, xp,
-      points, languages, equipment, feats, exhaustion, ms, notes
+      id, owner, name, race, background, hit_dice, stats, hp, ac, xp,
+      languages, equipment, feats, abilities, exhaustion, ms, notes, version
     ) VALUES (
-      :id, :owner, :name, :race, :background, :classes, :hit_dice, :stats, :hp, :ac, :xp,
-      :points, :languages, :equipment, :feats, :exhaustion, :ms, :notes
+      :id, :owner, :name, :race, :background, :hit_dice, :stats, :hp, :ac, :xp,
+      :languages, :equipment, :feats, :abilities, :exhaustion, :ms, :notes, :version
     )
     ON CONFLICT(id) DO UPDATE SET
       owner = excluded.owner,
       name = excluded.name,
       race = excluded.race,
       background = excluded.background,
-      classes = excluded.classes,
       hit_dice = excluded.hit_dice,
       stats = excluded.stats,
       hp = excluded.hp,
       ac = excluded.ac,
       xp = excluded.xp,
-      points = excluded.points,
       languages = excluded.languages,
       equipment = excluded.equipment,
       feats = excluded.feats,
+      abilities = excluded.abilities,
       exhaustion = excluded.exhaustion,
       ms = excluded.ms,
-      notes = excluded.notes
+      notes = excluded.notes,
+      version = excluded.version
     """, main_data)
     # Update related tables
     cursor.execute("DELETE FROM character_classes WHERE character_id = ?", (self.Id,))
@@ -301,12 +1132,24 @@ class DnD_Char:
       """, (self.Id, cls, level, subclass))
     cursor.execute("REPLACE INTO spells (character_id, spells) VALUES (?, ?)", 
                    (self.Id, json.dumps(self.spells)))
-    cursor.execute("REPLACE INTO spell_slots (character_id, slots) VALUES (?, ?)", 
-                   (self.Id, json.dumps(self.spell_slots)))
+    #spell slots and points are one row each so a single one can be spent without rewriting the character
+    #current is only written by save_resource_changes and save_long_rest, the values held here can be older
+    #than the row's so they only go in for new rows. Max values come from the character
+    resources = [(self.Id, kind, name, pair[0], pair[1]) for kind, name, pair in self.resources()]
+    cursor.executemany("""
+    INSERT INTO character_resources (character_id, kind, name, current, max) VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(character_id, kind, name) DO UPDATE SET max = excluded.max, current = MIN(current, excluded.max)
+    """, resources)
+    kept = {(kind, name) for _, kind, name, _, _ in resources}
+    cursor.execute("SELECT kind, name FROM character_resources WHERE character_id = ?", (self.Id,))
+    dropped = [(self.Id, kind, name) for kind, name in cursor.fetchall() if (kind, name) not in kept]
+    cursor.executemany("DELETE FROM character_resources WHERE character_id = ? AND kind = ? AND name = ?", dropped)
     cursor.execute("REPLACE INTO proficiencies (character_id, proficiencies) VALUES (?, ?)", 
                    (self.Id, json.dumps(self.proficiencies)))
-    conn.commit()
+    if commit:
+      conn.commit()
   @classmethod
+  @timed
   def from_db(cls, conn, character_id):
     cursor = conn.cursor()
     cursor.execute("SELECT * FROM dnd_characters WHERE id = ?", (character_id,))
@@ -326,9 +1169,7 @@ class DnD_Char:
     spells_row = cursor.fetchone()
     spells = json.loads(spells_row[0]) if spells_row else {}
 
-    cursor.execute("SELECT slots FROM spell_slots WHERE character_id = ?", (character_id,))
-    slots_row = cursor.fetchone()
-    spell_slots = json.loads(slots_row[0]) if slots_row else {}
+    spell_slots, points = load_resources(cursor, character_id)
 
     cursor.execute("SELECT proficiencies FROM proficiencies WHERE character_id = ?", (character_id,))
     prof_row = cursor.fetchone()
@@ -351,13 +1192,14 @@ class DnD_Char:
               proficiencies = proficiencies,
               spells = spells,
               spell_slots = spell_slots,
-              points = json.loads(row["points"] if "points" in row.keys() else "{}"),
+              points = points,
               ms = row["ms"] if "ms" in row.keys() else 30,
               languages = json.loads(row["languages"] if "languages" in row.keys() else "[]"),
               equipment = json.loads(row["equipment"] if "equipment" in row.keys() else "{}"),
               feats = json.loads(row["feats"] if "feats" in row.keys() else "[]"),
               exhaustion = row["exhaustion"] if "exhaustion" in row.keys() else 0,
-              notes = json.loads(row["notes"] if "notes" in row.keys() else "[]")
+              notes = json.loads(row["notes"] if "notes" in row.keys() else "[]"),
+              version = row["version"] if "version" in row.keys() else 0
               )
   def serialize_for_display(self):
     return {
@@ -367,44 +1209,530 @@ class DnD_Char:
       "Level": self.get_level(),
       "HP": f"Current - {self.hp[0]}; Max - {self.hp[1]}",
       "AC": self.ac,
-      "Stats": self.stats,
+      "Stats": dict(self.stats),
       "Spells": self.spells,
-      "Spell Slots": self.spell_slots,
+      "Spell Slots": self.spell_slots.to_dict(),
       "Abilities": self.abilities,
       "Feats": self.feats,
       "Languages": self.languages
     }
 
+#Snapshot file layout (little endian), versioned so old files can be told apart from new ones:
+#header: magic, format version, reserved, entry count, index offset
+#body: one utf-8 JSON payload per character, back to back
+#index: fixed size records (character id, row version, payload offset, payload length) sorted by id
+#The index is binary searched straight out of the memory map, so opening a snapshot only reads the header
+SNAPSHOT_MAGIC = b"DNDC"
+SNAPSHOT_FORMAT = 1
+SNAPSHOT_HEADER = struct.Struct("<4sHHIQ")
+SNAPSHOT_RECORD = struct.Struct("<qqQI")
+
+#Read side of a cache snapshot. Characters are only decoded when asked for and are
+#checked against the row version in the database so a stale entry is never handed out
+class CacheSnapshot:
+  def __init__(self, path, db = db_path):
+    self.path = path
+    self.db = db
+    self.lock = threading.Lock()
+    self.dropped = set() #ids that were found stale or removed from the cache
+    self.file = open(path, "rb")
+    try:
+      self.buf = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+      magic, fmt, _, self.count, self.index_offset = SNAPSHOT_HEADER.unpack_from(self.buf, 0)
+      if magic != SNAPSHOT_MAGIC or fmt != SNAPSHOT_FORMAT:
+        raise ValueError(f"Unsupported snapshot format in {path}")
+      if self.index_offset + self.count * SNAPSHOT_RECORD.size > len(self.buf):
+        raise ValueError(f"Truncated snapshot {path}")
+    except Exception:
+      self.close()
+      raise
+  def __len__(self):
+    return self.count
+  def _find(self, character_id):
+    #binary search over the fixed size index records
+    lo, hi = 0, self.count
+    while lo < hi:
+      mid = (lo + hi) // 2
+      record = SNAPSHOT_RECORD.unpack_from(self.buf, self.index_offset + mid * SNAPSHOT_RECORD.size)
+      if record[0] < character_id:
+        lo = mid + 1
+      elif record[0] > character_id:
+        hi = mid
+      else:
+        return record
+    return None
+  def _is_current(self, character_id, version):
+    conn = lite.connect(self.db, factory = TimedConnection)
+    try:
+      row = conn.execute("SELECT version FROM dnd_characters WHERE id = ?", (character_id,)).fetchone()
+    finally:
+      conn.close()
+    #a missing row means the character was deleted. Any other version means the snapshot and the database
+    #have gone separate ways (the snapshot is behind, or the database was restored from a backup), the database wins
+    return row is not None and (row[0] or 0) == version
+  def discard(self, character_id):
+    with self.lock:
+      self.dropped.add(character_id)
+  def load(self, character_id):
+    #Returns a DnD_Char or None if the id is absent or stale
+    with self.lock:
+      if self.buf is None or character_id in self.dropped:
+        return None
+      record = self._find(character_id)
+      if record is None:
+        return None
+      _, version, offset, length = record
+      data = json.loads(self.buf[offset:offset + length])
+    if not self._is_current(character_id, version):
+      logging.info(f"Snapshot entry for character {character_id} is stale, falling back to database.")
+      self.discard(character_id)
+      return None
+    return DnD_Char(**data)
+  def close(self):
+    with self.lock:
+      if getattr(self, "buf", None) is not None:
+        self.buf.close()
+      self.buf = None
+      if self.file:
+        self.file.close()
+      self.file = None
+
 #An object to store characters in runtime to reduce the need to query the database
 #Can grow this so that it includes dnd_characters dictionary and other game dictionary in the object, but for now only DnD
 class DnD_Cache:
   def __init__(self):
     self.lock = threading.Lock()
     self.characters = {} #Format {character_id (int): DnD_char instance}
+    self.snapshot = None #CacheSnapshot to fall back on for misses after a restart
+    self.active = {} #Format {user_id (int): character_id (int)}, kept across pushes
+    self.parties = {} #Format {party_id (int): Party instance}
+    self.party_names = {} #Format {(guild_id, name): party_id}
+    self.pinned = {} #Format {character_id: {holder,...}}, characters kept through clear while something holds them
   def add_char(self, character):
     with self.lock:
       self.characters[character.Id] = character
+  def set_active(self, user_id, character_id):
+    with self.lock:
+      self.active[user_id] = character_id
+  def get_active(self, user_id):
+    with self.lock:
+      return self.active.get(user_id)
   def remove_character(self, character_id):
     with self.lock:
       if character_id in self.characters:
         del self.characters[character_id]
+      snapshot = self.snapshot
+    if snapshot is not None:
+      snapshot.discard(character_id)
   def get_character(self, character_id):
     with self.lock:
-      return self.characters.get(character_id)
+      char = self.characters.get(character_id)
+      snapshot = self.snapshot
+    if char is not None:
+      cache_events.labels("characters", "hit").inc()
+      return char
+    if snapshot is not None:
+      #decode outside of the cache lock, the snapshot has its own
+      char = snapshot.load(character_id)
+      if char is not None:
+        cache_events.labels("characters", "snapshot_hit").inc()
+        with self.lock:
+          return self.characters.setdefault(character_id, char)
+    cache_events.labels("characters", "miss").inc()
+    return None
+  def attach_snapshot(self, path = snapshot_path):
+    #Only maps the file and reads the header so startup is not held up by decoding characters
+    if not os.path.exists(path):
+      return
+    try:
+      snapshot = CacheSnapshot(path)
+    except (OSError, ValueError, struct.error) as e:
+      logging.error(f"Could not open cache snapshot {path}: {e}")
+      return
+    with self.lock:
+      old, self.snapshot = self.snapshot, snapshot
+    if old is not None:
+      old.close()
+    logging.info(f"Attached cache snapshot with {len(snapshot)} characters.")
+  def detach_snapshot(self):
+    with self.lock:
+      old, self.snapshot = self.snapshot, None
+    if old is not None:
+      old.close()
   def all_characters(self):
     with self.lock:
       return self.characters.values()
+  def pin(self, character, holder):
+    #keeps the character cached through pushes until every holder unpins it, so the holder (ie an encounter)
+    #and every command work on the same object instead of a fresh copy loaded after a push
+    with self.lock:
+      self.characters[character.Id] = character
+      self.pinned.setdefault(character.Id, set()).add(holder)
+  def unpin(self, character_id, holder):
+    with self.lock:
+      holders = self.pinned.get(character_id)
+      if holders is not None:
+        holders.discard(holder)
+        if not holders:
+          del self.pinned[character_id]
   def clear(self):
+    #parties are written as they change, so only characters are flushed. Pinned characters stay
     with self.lock:
+      kept = {char_id: self.characters[char_id] for char_id in self.pinned if char_id in self.characters}
+      cache_events.labels("characters", "eviction").inc(len(self.characters) - len(kept))
       self.characters.clear()
+      self.characters.update(kept)
   def is_empty(self):
     with self.lock:
       return len(self.characters) == 0
+  def add_party(self, party):
+    with self.lock:
+      self.parties[party.Id] = party
+      self.party_names[(party.guild_id, party.name)] = party.Id
+  def characters_for_owner(self, owner):
+    with self.lock:
+      return {char.Id: char.name for char in self.characters.values() if char.owner == owner}
+  def find_party(self, guild_id, name):
+    with self.lock:
+      party_id = self.party_names.get((guild_id, name))
+      return self.parties.get(party_id)
+
+#A group of characters that play together. The bulk operations only change the
+#cached characters, persist_characters writes all of them in one transaction afterwards
+class Party:
+  __slots__ = ("Id", "guild_id", "name", "dm", "members")
+  def __init__(self, Id: int, guild_id: int, name: str, dm: int, members: list = None):
+    self.Id = Id
+    self.guild_id = guild_id
+    self.name = name
+    self.dm = dm #user id of whoever created the party, the only one allowed to run bulk operations
+    self.members = members or [] #character ids
+  def __repr__(self):
+    return f"<Party {self.name} (ID {self.Id}), {len(self.members)} members>"
+  def long_rest(self, chars):
+    for char in chars:
+      char.long_rest()
+  def split_xp(self, chars, amount):
+    #even split rounded down, returns each share
+    share = amount // len(chars) if chars else 0
+    for char in chars:
+      char.add_xp(share)
+    return share
+  def aoe_damage(self, chars, amount, saved = ()):
+    #characters whose id is in saved take half damage
+    for char in chars:
+      char.change_hp(-(amount // 2 if char.Id in saved else amount))
+
+#One side of a fight: a player character backed by a DnD_Char or a monster the DM added
+class Combatant:
+  __slots__ = ("name", "initiative_bonus", "initiative", "ac", "conditions", "char", "_hp", "removed")
+  def __init__(self, name: str, initiative_bonus: int, hp: int = 0, ac: int = 10, char: DnD_Char = None):
+    self.name = name
+    self.initiative_bonus = initiative_bonus
+    self.initiative = 0
+    self.ac = ac
+    self.conditions = set()
+    self.char = char
+    self._hp = [hp, hp] #only used by monsters, player characters use their own hp
+    self.removed = False
+  @property
+  def hp(self):
+    return self.char.hp if self.char is not None else self._hp
+  def change_hp(self, amount):
+    if self.char is not None:
+      self.char.change_hp(amount)
+    else:
+      self._hp[0] = min(max(self._hp[0] + amount, 0), self._hp[1])
+
+#Combat state for one channel, kept in memory until the encounter ends.
+#Turn order is a heap of (round, -initiative, -initiative bonus, sequence, combatant), so advancing
+#a turn pops the current combatant and pushes it back for the next round in O(log n).
+#Removed combatants are skipped when they come off the heap instead of being searched for
+class Encounter:
+  def __init__(self, channel_id: int, dm: int):
+    self.channel_id = channel_id
+    self.dm = dm
+    self.combatants = {} #Format {lower case name: Combatant}
+    self.heap = []
+    self.seq = 0 #tie breaker so the heap never compares combatants
+    self.round = 0 #0 until initiative is rolled
+    self.current = None #heap entry of the combatant whose turn it is
+  def add(self, combatant: Combatant):
+    self.combatants[combatant.name.lower()] = combatant
+    if self.round:
+      #joining mid fight: roll now, act this round if their slot has not passed yet
+      combatant.initiative = random.randint(1, 20) + combatant.initiative_bonus
+      entry = self._entry(self.round, combatant)
+      if self.current is not None and entry < self.current:
+        entry = self._entry(self.round + 1, combatant)
+      heapq.heappush(self.heap, entry)
+  def get(self, name):
+    combatant = self.combatants.get(name.strip().lower())
+    return None if combatant is None or combatant.removed else combatant
+  def remove(self, name):
+    combatant = self.get(name)
+    if combatant is not None:
+      combatant.removed = True
+    return combatant
+  def _entry(self, round_number, combatant):
+    self.seq += 1
+    return (round_number, -combatant.initiative, -combatant.initiative_bonus, self.seq, combatant)
+  def roll_initiative(self):
+    #one batched roll for every combatant, then a single heapify
+    combatants = [c for c in self.combatants.values() if not c.removed]
+    rolls = random.choices(range(1, 21), k = len(combatants))
+    self.round = 1
+    self.current = None
+    self.heap = []
+    for combatant, roll in zip(combatants, rolls):
+      combatant.initiative = roll + combatant.initiative_bonus
+      self.heap.append(self._entry(1, combatant))
+    heapq.heapify(self.heap)
+  def next_turn(self):
+    #returns the combatant whose turn it is now, or None if nobody is left
+    if self.current is not None:
+      heapq.heappush(self.heap, self._entry(self.current[0] + 1, self.current[-1]))
+      self.current = None
+    while self.heap:
+      entry = heapq.heappop(self.heap)
+      if not entry[-1].removed:
+        self.current = entry
+        self.round = entry[0]
+        return entry[-1]
+    return None
+  def damage(self, combatant: Combatant, amount: int):
+    #negative amounts heal. Monsters at 0 hp leave the turn order, player characters stay for death saves
+    combatant.change_hp(-amount)
+    if combatant.char is None and combatant.hp[0] == 0:
+      combatant.removed = True
+  def order(self, limit = 25):
+    #upcoming turns starting with the current one
+    entries = ([self.current] if self.current else []) + heapq.nsmallest(limit, (e for e in self.heap if not e[-1].removed))
+    return [entry[-1] for entry in entries][:limit]
+  def characters(self):
+    return [c.char for c in self.combatants.values() if c.char is not None]
+
+#Active encounters by channel id
+encounters = {}
+
+#Monster stat block for the simulator, ie "3x goblin 7/15/+4/1d6+2" is three goblins with
+#7 hp, AC 15, +4 to hit and 1d6+2 damage. An optional /n at the end gives n attacks a round
+monster_pattern = re.compile(r"(?:(\d+)\s*x\s*)?(.+?)\s+(\d+)/(\d+)/([+-]?\d+)/(\d+)d(\d+)([+-]\d+)?(?:/(\d+))?")
+
+#limits on what parse_monsters accepts, the simulator's arrays grow with every one of them
+monster_limits = {"monsters": 100, "hp": 10000, "dice": 40, "sides": 100, "attacks": 10}
+
+#parses "; " separated stat blocks into simulator rows (ac, hp, to hit, dice, sides, damage mod, attacks), one per monster
+def parse_monsters(text: str):
+  monsters = []
+  for block in text.split(";"):
+    if not block.strip():
+      continue
+    match = monster_pattern.fullmatch(block.strip())
+    if not match:
+      raise ValueError(f"Could not read monster: {block.strip()}")
+    count, _, hp, ac, to_hit, dice, sides, mod, attacks = match.groups()
+    count = int(count or 1)
+    row = (int(ac), int(hp), int(to_hit), int(dice), int(sides), int(mod or 0), int(attacks or 1))
+    for what, value in (("hp", row[1]), ("dice", row[3]), ("sides", row[4]), ("attacks", row[6])):
+      if value > monster_limits[what]:
+        raise ValueError(f"Too many {what} in {block.strip()}, the most is {monster_limits[what]}")
+    if len(monsters) + count > monster_limits["monsters"]:
+      raise ValueError(f"Too many monsters, the most is {monster_limits['monsters']}")
+    monsters.extend([row] * count)
+  return monsters
+
+#simulator row for a character: current hp, ac and a d8 weapon attack with the better of STR and DEX
+def combat_profile(char: DnD_Char):
+  mod = max(char.get_modifier("str"), char.get_modifier("dex"))
+  return (char.ac, char.hp[0], mod + char.proficiency_bonus(), 1, 8, mod, 1)
+
+#rolls a different number of sides-sided dice for every trial
+def roll_dice_batch(rng, counts, sides, max_count):
+  rolls = rng.integers(1, sides + 1, (len(counts), max_count))
+  return (rolls * (np.arange(max_count) < counts[:, None])).sum(axis = 1)
+
+#Monte Carlo estimate of a fight. Every trial is a column in numpy arrays so a round is a handful of
+#vector operations no matter how many trials run. Simplified rules: the party acts first each round and
+#focuses the first monster still standing, monsters spread their attacks over random conscious characters,
+#natural 20s double the dice. Runs in a worker process, see get_sim_pool
+def simulate_encounter(party: list, monsters: list, trials: int = 20000, max_rounds: int = 50, seed: int = None):
+  start = time.perf_counter()
+  rng = np.random.default_rng(seed)
+  pcs = np.array(party, dtype = np.int64)
+  mons = np.array(monsters, dtype = np.int64)
+  pc_hp = np.tile(pcs[:, 1], (trials, 1))
+  mon_hp = np.tile(mons[:, 1], (trials, 1))
+  rows = np.arange(trials)
+  done = np.zeros(trials, dtype = bool)
+  won = np.zeros(trials, dtype = bool)
+  rounds = np.full(trials, max_rounds)
+  def attack(attacker, target_ac, to_hit, dice, sides, mod):
+    d20 = rng.integers(1, 21, trials)
+    hit = attacker & ((d20 == 20) | ((d20 != 1) & (d20 + to_hit >= target_ac)))
+    damage = roll_dice_batch(rng, np.where(d20 == 20, 2 * dice, dice), sides, 2 * dice) + mod
+    return np.where(hit, np.maximum(damage, 0), 0)
+  for round_number in range(1, max_rounds + 1):
+    active = ~done
+    for j in range(len(pcs)):
+      mon_alive = mon_hp > 0
+      target = mon_alive.argmax(axis = 1)
+      attacker = active & (pc_hp[:, j] > 0) & mon_alive[rows, target]
+      for _ in range(pcs[j, 6]):
+        mon_hp[rows, target] -= attack(attacker, mons[target, 0], pcs[j, 2], pcs[j, 3], pcs[j, 4], pcs[j, 5])
+    for k in range(len(mons)):
+      for _ in range(mons[k, 6]):
+        pc_alive = pc_hp > 0
+        target = np.where(pc_alive, rng.random(pc_hp.shape), -1.0).argmax(axis = 1)
+        attacker = active & (mon_hp[:, k] > 0) & pc_alive[rows, target]
+        pc_hp[rows, target] -= attack(attacker, pcs[target, 0], mons[k, 2], mons[k, 3], mons[k, 4], mons[k, 5])
+    party_down = (pc_hp <= 0).all(axis = 1)
+    monsters_down = (mon_hp <= 0).all(axis = 1)
+    finished = active & (party_down | monsters_down)
+    rounds[finished] = round_number
+    won |= finished & monsters_down
+    done |= finished
+    if done.all():
+      break
+  downed = (pc_hp <= 0).sum(axis = 1)
+  return {
+    "trials": trials,
+    "win_rate": float(won.mean()),
+    "tpk_rate": float((done & ~won).mean()),
+    "unfinished_rate": float((~done).mean()),
+    "mean_rounds": float(rounds[done].mean()) if done.any() else float(max_rounds),
+    "mean_downed": float(downed.mean()),
+    "mean_downed_in_wins": float(downed[won].mean()) if won.any() else 0.0,
+    "seconds": time.perf_counter() - start
+  }
+
+#the simulator runs in its own process so a big simulation never holds up the event loop
+sim_pool = None
+def get_sim_pool():
+  global sim_pool
+  if sim_pool is None:
+    sim_pool = ProcessPoolExecutor(max_workers = 1)
+  return sim_pool
+
+#Per user {character_id: name} for character autocomplete. Filled once per user from the database,
+#kept up to date on create and rename, and dropped after idle_seconds without use
+class CharacterNameIndex:
+  def __init__(self, idle_seconds = 1800):
+    self.lock = threading.Lock()
+    self.idle_seconds = idle_seconds
+    self.users = {} #Format {user_id: {character_id: name}}
+    self.last_used = {} #Format {user_id: time.monotonic() of last use}
+    self.last_sweep = time.monotonic()
+  def _evict_idle(self, now):
+    #called with the lock held, at most once a minute
+    if now - self.last_sweep < 60:
+      return
+    self.last_sweep = now
+    idle = [u for u, used in self.last_used.items() if now - used > self.idle_seconds]
+    for user_id in idle:
+      del self.users[user_id]
+      del self.last_used[user_id]
+    cache_events.labels("character_names", "eviction").inc(len(idle))
+  def get(self, user_id):
+    #None means the user has not been loaded yet
+    now = time.monotonic()
+    with self.lock:
+      self._evict_idle(now)
+      names = self.users.get(user_id)
+      if names is not None:
+        self.last_used[user_id] = now
+    cache_events.labels("character_names", "miss" if names is None else "hit").inc()
+    return names
+  def fill(self, user_id, names: dict):
+    with self.lock:
+      self.users[user_id] = dict(names)
+      self.last_used[user_id] = time.monotonic()
+      return self.users[user_id]
+  def set_name(self, user_id, character_id, name):
+    #for new and renamed characters, users that are not loaded pick it up on their next fill
+    with self.lock:
+      names = self.users.get(user_id)
+      if names is not None:
+        names[character_id] = name
+
+character_names = CharacterNameIndex()
+
+#Rendered character sheets keyed on (character id, version). A sheet is only built again once
+#the character has changed, so a table full of players looking at the same sheet costs one render.
+#Least recently used sheets are dropped past max_entries
+class SheetCache:
+  def __init__(self, max_entries = 512):
+    self.lock = threading.Lock()
+    self.max_entries = max_entries
+    self.sheets = {} #Format {character_id: (version, sheet)}, least recently used first
+    self.hits = cache_events.labels("sheets", "hit")
+    self.misses = cache_events.labels("sheets", "miss")
+    self.evictions = cache_events.labels("sheets", "eviction")
+  def get(self, char, render):
+    with self.lock:
+      entry = self.sheets.pop(char.Id, None)
+      if entry is not None and entry[0] == char.version:
+        self.sheets[char.Id] = entry
+        self.hits.inc()
+        return entry[1]
+    self.misses.inc()
+    sheet = render(char)
+    with self.lock:
+      self.sheets[char.Id] = (char.version, sheet)
+      while len(self.sheets) > self.max_entries:
+        del self.sheets[next(iter(self.sheets))]
+        self.evictions.inc()
+    return sheet
+  def discard(self, character_id):
+    with self.lock:
+      self.sheets.pop(character_id, None)
+  def stats(self):
+    hits = self.hits.value
+    misses = self.misses.value
+    with self.lock:
+      entries = len(self.sheets)
+    return {
+      "entries": entries,
+      "hits": hits,
+      "misses": misses,
+      "evictions": self.evictions.value,
+      "hit_rate": hits / (hits + misses) if hits + misses else 0.0
+    }
+
+sheet_cache = SheetCache()
+
+#initialize cache
+dnd_cache = DnD_Cache()
+
+#the character a user last loaded or created, pulled back in if a push flushed it from the cache
+@timed
+def get_active_character(user_id: int):
+  char_id = dnd_cache.get_active(user_id)
+  if char_id is None:
+    return None
+  char = dnd_cache.get_character(char_id)
+  if char is None:
+    char = pull_character_from_db(char_id)
+    if char is not None:
+      dnd_cache.add_char(char)
+  return char
+
+#character names for autocomplete: from the name index, or one database read per user until it goes idle
+@timed
+def load_character_names(user_id: int):
+  names = character_names.get(user_id)
+  if names is None:
+    names = get_characters_by_user(user_id)
+    #new characters only reach the database on the next push
+    names.update(dnd_cache.characters_for_owner(user_id))
+    names = character_names.fill(user_id, names)
+  return names
 
 #a function to obtain the names and IDs of characters using a user_id from the database
+@timed
 def get_characters_by_user(user_id: int):
   #returns dict: {character_id: name,...}
-  conn = lite.connect(db_path)
+  conn = lite.connect(db_path, factory = TimedConnection)
   conn.row_factory = lite.Row
   cursor = conn.cursor()
   #dictionary to store characters by id: name
@@ -423,11 +1751,43 @@ def get_characters_by_user(user_id: int):
   conn.close()
   return characters
 
+#one page of a user's characters in id order using keyset pagination over the owner index.
+#after_id pages forward from a character id, before_id pages back from one.
+#Returns ([(character_id, name),...], more) where more is True if there is another page in that direction
+@timed
+def get_character_page(user_id: int, after_id: int = 0, before_id: int = None, limit: int = 10, db: str = db_path):
+  conn = lite.connect(db, factory = TimedConnection)
+  try:
+    cursor = conn.cursor()
+    if before_id is None:
+      cursor.execute("SELECT id, name FROM dnd_characters WHERE owner = ? AND id > ? ORDER BY id LIMIT ?", (user_id, after_id, limit + 1))
+      rows = cursor.fetchall()
+      more = len(rows) > limit
+      rows = rows[:limit]
+    else:
+      cursor.execute("SELECT id, name FROM dnd_characters WHERE owner = ? AND id < ? ORDER BY id DESC LIMIT ?", (user_id, before_id, limit + 1))
+      rows = cursor.fetchall()
+      more = len(rows) > limit
+      rows = rows[:limit][::-1]
+  finally:
+    conn.close()
+  return rows, more
+
+#spell slots and points for a character as (spell_slots, points) from character_resources
+def load_resources(cursor, character_id: int):
+  cursor.execute("SELECT kind, name, current, max FROM character_resources WHERE character_id = ?", (character_id,))
+  spell_slots = {}
+  points = {}
+  for kind, name, current, maximum in cursor.fetchall():
+    (spell_slots if kind == "slot" else points)[name] = [current, maximum]
+  return spell_slots, points
+
 #a function to pull characters from the database by character id
-def pull_character_from_db(char_id: int):
+@timed
+def pull_character_from_db(char_id: int, db: str = db_path):
   #Returns a DnD_Char object
   #I don't use joins to optimize for presence/absense in relational tables
-  conn = lite.connect(db_path)
+  conn = lite.connect(db, factory = TimedConnection)
   conn.row_factory = lite.Row
   cursor = conn.cursor()
   cursor.execute("SELECT * FROM dnd_characters where id = ?", (char_id,))
@@ -449,14 +1809,14 @@ def pull_character_from_db(char_id: int):
     "hp": json.loads(char["hp"]) if char["hp"] else [0, 0], #gaurantees this will load correctly
     "ac": char["ac"],
     "xp": char["xp"],
-    "points": get_json("points"),
     "languages": get_list("languages"),
     "equipment": get_json("equipment"),
     "feats": get_list("feats"),
     "abilities": get_list("abilities"),
     "notes": get_list("notes"),
     "ms": char["ms"],
-    "exhaustion": char["exhaustion"]
+    "exhaustion": char["exhaustion"],
+    "version": char["version"] or 0
   }
   #get class data
   cursor.execute("SELECT class_name, level, subclass FROM character_classes WHERE character_id = ?", (char_id,))
@@ -482,14 +1842,499 @@ def pull_character_from_db(char_id: int):
     "known": spells.get("known", {}),
     "prepared": spells.get("prepared", {})
   }
-  #Spell slots
-  cursor.execute("SELECT slots FROM spell_slots WHERE character_id = ?", (char_id,))
-  row = cursor.fetchone()
-  char_data["spell_slots"] = json.loads(row["slots"]) if row else {}
+  #Spell slots and points
+  char_data["spell_slots"], char_data["points"] = load_resources(cursor, char_id)
   conn.close()
   return DnD_Char(**char_data)
 
+#creates a new party in a guild, returns None if the name is taken there
+@timed
+def create_party(guild_id: int, name: str, dm: int, db: str = db_path):
+  conn = lite.connect(db, factory = TimedConnection)
+  try:
+    cursor = conn.cursor()
+    cursor.execute("INSERT INTO parties (guild_id, name, dm) VALUES (?, ?, ?)", (guild_id, name, dm))
+    conn.commit()
+    party = Party(cursor.lastrowid, guild_id, name, dm)
+  except lite.IntegrityError:
+    return None
+  finally:
+    conn.close()
+  dnd_cache.add_party(party)
+  return party
+
+#looks a party up by name, from the cache first and then the database
+@timed
+def get_party(guild_id: int, name: str, db: str = db_path):
+  party = dnd_cache.find_party(guild_id, name)
+  if party is not None:
+    return party
+  conn = lite.connect(db, factory = TimedConnection)
+  try:
+    cursor = conn.cursor()
+    cursor.execute("SELECT id, dm FROM parties WHERE guild_id = ? AND name = ?", (guild_id, name))
+    row = cursor.fetchone()
+    if not row:
+      return None
+    cursor.execute("SELECT character_id FROM party_members WHERE party_id = ?", (row[0],))
+    members = [r[0] for r in cursor.fetchall()]
+  finally:
+    conn.close()
+  party = Party(row[0], guild_id, name, row[1], members)
+  dnd_cache.add_party(party)
+  return party
+
+#rewrites the member list of a party
+@timed
+def save_party_members(party: Party, db: str = db_path):
+  conn = lite.connect(db, factory = TimedConnection)
+  try:
+    with conn:
+      conn.execute("DELETE FROM party_members WHERE party_id = ?", (party.Id,))
+      conn.executemany("INSERT INTO party_members (party_id, character_id) VALUES (?, ?)",
+                       [(party.Id, char_id) for char_id in party.members])
+  finally:
+    conn.close()
+
+#every member of a party as DnD_Char objects, misses are loaded over one connection and cached
+@timed
+def load_party_characters(party: Party, db: str = db_path):
+  chars = []
+  missing = []
+  for char_id in party.members:
+    char = dnd_cache.get_character(char_id)
+    if char is None:
+      missing.append(char_id)
+    else:
+      chars.append(char)
+  if missing:
+    conn = lite.connect(db, factory = TimedConnection)
+    conn.row_factory = lite.Row
+    try:
+      for char_id in missing:
+        try:
+          char = DnD_Char.from_db(conn, char_id)
+        except ValueError:
+          logging.error(f"Party {party.Id} member {char_id} not found in database.")
+          continue
+        dnd_cache.add_char(char)
+        chars.append(char)
+    finally:
+      conn.close()
+  return chars
+
+#a resource row changed in the database since the cached character last saw it. Nothing was written and the
+#cached values were put back in step with the database
+class ResourceConflict(Exception):
+  pass
+
+#writes resource changes made on a cached character, changes are (kind, name, current before)
+#each is a relative update on its own row, guarded on the value it had before so two writers can't
+#both spend the last slot. A missing row (character not pushed yet) is inserted with the cached value.
+#A row that is there but out of step means someone else changed it: the whole call is rolled back,
+#the cached values are refreshed from the database and ResourceConflict is raised
+@timed
+def save_resource_changes(char: DnD_Char, changes, db: str = db_path):
+  conn = lite.connect(db, factory = TimedConnection)
+  try:
+    cursor = conn.cursor()
+    conflicts = []
+    for kind, name, before in changes:
+      current, maximum = char.spell_slots[name] if kind == "slot" else char.points[name]
+      cursor.execute("""
+      UPDATE character_resources SET current = current + ?
+      WHERE character_id = ? AND kind = ? AND name = ? AND current = ?
+      """, (current - before, char.Id, kind, name, before))
+      if cursor.rowcount == 0:
+        cursor.execute("""
+        INSERT INTO character_resources (character_id, kind, name, current, max) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(character_id, kind, name) DO NOTHING
+        """, (char.Id, kind, name, current, maximum))
+        if cursor.rowcount == 0:
+          conflicts.append((kind, name))
+    if conflicts:
+      conn.rollback()
+      for kind, name, before in changes:
+        pair = char.spell_slots[name] if kind == "slot" else char.points[name]
+        row = cursor.execute("SELECT current FROM character_resources WHERE character_id = ? AND kind = ? AND name = ?",
+                             (char.Id, kind, name)).fetchone()
+        pair[0] = row[0] if row is not None else before
+      char.version += 1
+      raise ResourceConflict(", ".join(f"{resource_label(kind, name)} ({pair[0]}/{pair[1]})" for kind, name, pair in char.resources()
+                                       if (kind, name) in conflicts))
+    #the row version keeps cache snapshots from handing back the old values after a restart
+    char.version += 1
+    cursor.execute("UPDATE dnd_characters SET version = ? WHERE id = ?", (char.version, char.Id))
+    conn.commit()
+  except Exception:
+    conn.rollback()
+    raise
+  finally:
+    conn.close()
+
+#long rest for characters that were already rested in memory, all characters or none
+#to_db leaves current resource values alone so they are set back to max here
+@timed
+def save_long_rest(chars, db: str = db_path):
+  conn = lite.connect(db, factory = TimedConnection)
+  try:
+    for char in chars:
+      char.to_db(conn, commit = False)
+    conn.executemany("UPDATE character_resources SET current = max WHERE character_id = ?", [(char.Id,) for char in chars])
+    conn.commit()
+  except Exception:
+    conn.rollback()
+    raise
+  finally:
+    conn.close()
+
+#writes the result of a bulk operation (party or combat), all characters or none
+@timed
+def persist_characters(chars, db: str = db_path):
+  conn = lite.connect(db, factory = TimedConnection)
+  try:
+    for char in chars:
+      char.to_db(conn, commit = False)
+    conn.commit()
+  except Exception:
+    conn.rollback()
+    raise
+  finally:
+    conn.close()
+
+#Bulk import and export
+#A character file is a JSON list of records, or a CSV with one row per character. A record has the
+#constructor arguments of DnD_Char (hp as [current, max]); export adds the character's id, import ignores it
+#and gives every character a new one. In CSV the nested fields are JSON strings and hp and stats are split
+#into plain columns
+csv_scalar_columns = ("owner", "name", "race", "background", "ac", "ms", "xp", "exhaustion", "current_hp", "max_hp") + core_stats
+csv_json_columns = ("classes", "subclasses", "spells", "spell_slots", "points", "proficiencies",
+                    "languages", "equipment", "feats", "abilities", "notes")
+import_text_limit = 200 #characters in a name, race, background, list entry...
+
+def import_int(value, what, low, high):
+  #int() would quietly cut 12.5 down to 12 and take true as 1
+  if isinstance(value, bool) or isinstance(value, float) and not value.is_integer():
+    raise ValueError(f"{what} must be a whole number")
+  try:
+    value = int(value)
+  except (TypeError, ValueError):
+    raise ValueError(f"{what} must be a whole number")
+  if not low <= value <= high:
+    raise ValueError(f"{what} must be between {low} and {high}")
+  return value
+
+def import_text(value, what):
+  if not isinstance(value, str) or not value.strip():
+    raise ValueError(f"{what} is required")
+  if len(value) > import_text_limit:
+    raise ValueError(f"{what} is longer than {import_text_limit} characters")
+  return value.strip()
+
+def import_pairs(value, what, check_name):
+  #{name: [current, max]} for spell slots and points
+  if not isinstance(value, dict):
+    raise ValueError(f"{what} must be an object of name: [current, max]")
+  pairs = {}
+  for name, pair in value.items():
+    name = check_name(str(name).lower())
+    if not isinstance(pair, (list, tuple)) or len(pair) != 2:
+      raise ValueError(f"{what} {name} must be [current, max]")
+    top = import_int(pair[1], f"{what} {name} max", 0, 100)
+    pairs[name] = [import_int(pair[0], f"{what} {name} current", 0, top), top]
+  return pairs
+
+def import_slot_level(level):
+  if level not in {str(i) for i in range(1, 10)}:
+    raise ValueError(f"spell slot level {level} must be 1-9")
+  return level
+
+#checks one import record and returns the DnD_Char arguments for it (without Id), raising ValueError
+#with the first problem. Classes and subclasses follow the same rules as the character wizard
+def character_args_from_record(record, owner: int = None):
+  if not isinstance(record, dict):
+    raise ValueError("each character must be an object")
+  args = {key: import_text(record.get(key), key) for key in ("name", "race", "background")}
+  args["owner"] = import_int(owner if owner is not None else record.get("owner"), "owner", 1, 2**63 - 1)
+  classes = record.get("classes")
+  if not isinstance(classes, dict) or not classes:
+    raise ValueError("classes must be an object of class: level with at least one class")
+  args["classes"] = {}
+  for cls, lvl in classes.items():
+    cls = str(cls).lower()
+    if cls not in class_dice:
+      raise ValueError(f"unknown class {cls}, supported classes: {', '.join(class_dice)}")
+    args["classes"][cls] = import_int(lvl, f"{cls} level", 1, 20)
+  if sum(args["classes"].values()) > 20:
+    raise ValueError("total character level is over 20")
+  subclasses = record.get("subclasses") or {}
+  if not isinstance(subclasses, dict):
+    raise ValueError("subclasses must be an object of class: subclass")
+  args["subclasses"] = {}
+  for cls, subclass in subclasses.items():
+    cls = str(cls).lower()
+    lvl = args["classes"].get(cls)
+    if lvl is None:
+      raise ValueError(f"subclass given for {cls}, which the character doesn't have")
+    if lvl < subclass_levels[cls]:
+      raise ValueError(f"{cls} gets a subclass at level {subclass_levels[cls]}, this character is level {lvl}")
+    args["subclasses"][cls] = import_text(subclass, f"{cls} subclass").lower()
+  stats = record.get("stats")
+  if not isinstance(stats, dict):
+    raise ValueError("stats must be an object with str, dex, con, int, wis and cha")
+  unknown = set(stats) - set(core_stats)
+  if unknown:
+    raise ValueError(f"unknown stats {', '.join(sorted(map(str, unknown)))}, use {', '.join(core_stats)}")
+  args["stats"] = {stat: import_int(stats.get(stat), stat, 1, 30) for stat in core_stats}
+  hp = record.get("hp")
+  if not isinstance(hp, (list, tuple)) or len(hp) != 2:
+    raise ValueError("hp must be [current, max]")
+  max_hp = import_int(hp[1], "max hp", 1, 10000)
+  args["hp"] = [import_int(hp[0], "current hp", 0, max_hp), max_hp]
+  args["ac"] = import_int(record.get("ac"), "ac", 0, 50)
+  args["ms"] = import_int(record.get("ms", 30), "ms", 0, 500)
+  args["xp"] = import_int(record.get("xp", 0), "xp", 0, 10**9)
+  args["exhaustion"] = import_int(record.get("exhaustion", 0), "exhaustion", 0, 6)
+  args["hit_dice"] = hit_dice_for(args["classes"])
+  args["spell_slots"] = import_pairs(record.get("spell_slots") or {}, "spell slot", import_slot_level)
+  args["points"] = import_pairs(record.get("points") or {}, "points", lambda name: import_text(name, "points name"))
+  spells = record.get("spells") or {}
+  if not isinstance(spells, dict) or not set(spells) <= {"known", "prepared"}:
+    raise ValueError("spells must be an object with known and prepared")
+  args["spells"] = {"known": {}, "prepared": {}}
+  for key, levels in spells.items():
+    if not isinstance(levels, dict):
+      raise ValueError(f"{key} spells must be an object of level: [spells]")
+    for level, names in levels.items():
+      level = str(level).lower()
+      if level not in {"cantrip"} | {str(i) for i in range(1, 10)}:
+        raise ValueError(f"spell level {level} must be cantrip or 1-9")
+      if not isinstance(names, list):
+        raise ValueError(f"{key} spells at level {level} must be a list")
+      #any name goes, like in the wizard, the spell reference doesn't have every spell
+      args["spells"][key][level] = [import_text(name, f"{key} spell").lower() for name in names]
+  proficiencies = record.get("proficiencies") or {}
+  if not isinstance(proficiencies, dict):
+    raise ValueError("proficiencies must be an object of name: 1 or 2")
+  args["proficiencies"] = {str(name).lower(): import_int(level, f"{name} proficiency", 1, 2) for name, level in proficiencies.items()}
+  equipment = record.get("equipment") or {}
+  if not isinstance(equipment, dict):
+    raise ValueError("equipment must be an object of item: count")
+  args["equipment"] = {import_text(name, "item"): import_int(count, f"{name} count", 0, 10**9) for name, count in equipment.items()}
+  for key in ("languages", "feats", "abilities", "notes"):
+    values = record.get(key) or []
+    if not isinstance(values, list):
+      raise ValueError(f"{key} must be a list")
+    args[key] = [import_text(value, key[:-1]) if key != "notes" else str(value) for value in values]
+  return args
+
+#records from the text of a JSON or CSV character file
+def read_character_records(text: str, file_format: str):
+  if file_format == "json":
+    records = json.loads(text)
+    if not isinstance(records, list):
+      raise ValueError("a JSON character file must be a list of characters")
+    return records
+  records = []
+  for row in csv.DictReader(io.StringIO(text)):
+    record = {key: row.get(key) for key in csv_scalar_columns[:8]}
+    record["hp"] = [row.get("current_hp"), row.get("max_hp")]
+    record["stats"] = {stat: row.get(stat) for stat in core_stats}
+    for key in csv_json_columns:
+      record[key] = json.loads(row[key]) if row.get(key) else None
+    records.append(record)
+  return records
+
+#validates every record and builds the characters, ids are only given out once they all pass.
+#Returns (characters, errors) where errors is ["character 3 (Name): problem",...]; nothing is built if there are any
+def build_imported_characters(records, owner: int = None, max_errors: int = 10):
+  arg_sets = []
+  errors = []
+  for i, record in enumerate(records, 1):
+    try:
+      arg_sets.append(character_args_from_record(record, owner))
+    except ValueError as e:
+      name = record.get("name") if isinstance(record, dict) else None
+      errors.append(f"character {i}{f' ({name})' if name else ''}: {e}")
+      if len(errors) >= max_errors:
+        break
+  if errors:
+    return [], errors
+  ids = allocate_ids(len(arg_sets))
+  return [DnD_Char(Id = char_id, **args) for char_id, args in zip(ids, arg_sets)], []
+
+#Writes new characters straight to the database, chunk_size characters per transaction with one executemany
+#per table, and brings the owners' users rows up to date. Ids must be new, an existing one fails its chunk
+#(already written chunks stay). Returns the number of characters written
+@timed
+def insert_characters(chars, db: str = db_path, chunk_size: int = 1000):
+  conn = lite.connect(db, factory = TimedConnection)
+  written = 0
+  try:
+    cursor = conn.cursor()
+    for start in range(0, len(chars), chunk_size):
+      chunk = chars[start:start + chunk_size]
+      for char in chunk:
+        #the same version to_db gives a character on its first write
+        char.version += 1
+      try:
+        cursor.executemany("""
+        INSERT INTO dnd_characters (
+          id, owner, name, race, background, hit_dice, stats, hp, ac, xp,
+          languages, equipment, feats, abilities, exhaustion, ms, notes, version
+        ) VALUES (
+          :id, :owner, :name, :race, :background, :hit_dice, :stats, :hp, :ac, :xp,
+          :languages, :equipment, :feats, :abilities, :exhaustion, :ms, :notes, :version
+        )""", [char.to_dict() for char in chunk])
+        cursor.executemany("INSERT INTO character_classes (character_id, class_name, level, subclass) VALUES (?, ?, ?, ?)",
+                           [(char.Id, cls, lvl, char.subclasses.get(cls, "")) for char in chunk for cls, lvl in char.classes.items()])
+        cursor.executemany("INSERT INTO spells (character_id, spells) VALUES (?, ?)",
+                           [(char.Id, json.dumps(char.spells)) for char in chunk])
+        cursor.executemany("INSERT INTO character_resources (character_id, kind, name, current, max) VALUES (?, ?, ?, ?, ?)",
+                           [(char.Id, kind, name, pair[0], pair[1]) for char in chunk for kind, name, pair in char.resources()])
+        cursor.executemany("INSERT INTO proficiencies (character_id, proficiencies) VALUES (?, ?)",
+                           [(char.Id, json.dumps(char.proficiencies)) for char in chunk])
+        owners = {char.owner for char in chunk}
+        users = []
+        for owner in owners:
+          cursor.execute("SELECT id FROM dnd_characters WHERE owner = ? ORDER BY id", (owner,))
+          ids = [row[0] for row in cursor.fetchall()]
+          users.append((owner, json.dumps(ids), len(ids)))
+        cursor.executemany("""
+        INSERT INTO users (user_id, chars, n_chars) VALUES (?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET chars = excluded.chars, n_chars = excluded.n_chars
+        """, users)
+        conn.commit()
+      except Exception:
+        conn.rollback()
+        for char in chunk:
+          char.version -= 1
+        raise
+      written += len(chunk)
+  finally:
+    conn.close()
+  return written
+
+#import records for every character of owner (everyone if owner is None), in id order.
+#Five queries however many characters there are; characters in cache are exported as they are there,
+#changes not pushed yet included
+@timed
+def export_character_records(owner: int = None, cache: DnD_Cache = None, db: str = db_path):
+  conn = lite.connect(db, factory = TimedConnection)
+  conn.row_factory = lite.Row
+  try:
+    cursor = conn.cursor()
+    where, params = ("WHERE owner = ?", (owner,)) if owner is not None else ("", ())
+    #related tables only for the characters being exported
+    ids = f"SELECT id FROM dnd_characters {where}"
+    cursor.execute(f"SELECT * FROM dnd_characters {where} ORDER BY id", params)
+    rows = cursor.fetchall()
+    classes = {}
+    cursor.execute(f"SELECT character_id, class_name, level, subclass FROM character_classes WHERE character_id IN ({ids})", params)
+    for char_id, cls, lvl, subclass in cursor.fetchall():
+      classes.setdefault(char_id, ({}, {}))
+      classes[char_id][0][cls] = lvl
+      if subclass:
+        classes[char_id][1][cls] = subclass
+    cursor.execute(f"SELECT character_id, spells FROM spells WHERE character_id IN ({ids})", params)
+    spells = {char_id: json.loads(value) for char_id, value in cursor.fetchall()}
+    cursor.execute(f"SELECT character_id, proficiencies FROM proficiencies WHERE character_id IN ({ids})", params)
+    proficiencies = {char_id: json.loads(value) for char_id, value in cursor.fetchall()}
+    resources = {}
+    cursor.execute(f"SELECT character_id, kind, name, current, max FROM character_resources WHERE character_id IN ({ids})", params)
+    for char_id, kind, name, current, top in cursor.fetchall():
+      resources.setdefault(char_id, ({}, {}))[0 if kind == "slot" else 1][name] = [current, top]
+    records = []
+    for row in rows:
+      char_id = row["id"]
+      cached = cache.get_character(char_id) if cache is not None else None
+      if cached is not None:
+        records.append(character_record(cached))
+        continue
+      spell_slots, points = resources.get(char_id, ({}, {}))
+      char_classes, subclasses = classes.get(char_id, ({}, {}))
+      records.append({
+        "id": char_id,
+        "owner": row["owner"],
+        "name": row["name"],
+        "race": row["race"],
+        "background": row["background"],
+        "classes": char_classes,
+        "subclasses": subclasses,
+        "hit_dice": json.loads(row["hit_dice"]) if row["hit_dice"] else {},
+        "stats": json.loads(row["stats"]),
+        "hp": json.loads(row["hp"]) if row["hp"] else [0, 0],
+        "ac": row["ac"],
+        "ms": row["ms"],
+        "xp": row["xp"],
+        "exhaustion": row["exhaustion"],
+        "spells": spells.get(char_id, {}),
+        "spell_slots": spell_slots,
+        "points": points,
+        "proficiencies": proficiencies.get(char_id, {}),
+        "languages": json.loads(row["languages"]) if row["languages"] else [],
+        "equipment": json.loads(row["equipment"]) if row["equipment"] else {},
+        "feats": json.loads(row["feats"]) if row["feats"] else [],
+        "abilities": json.loads(row["abilities"]) if row["abilities"] else [],
+        "notes": json.loads(row["notes"]) if row["notes"] else []
+      })
+  finally:
+    conn.close()
+  return records
+
+#an export record for a loaded character
+def character_record(char: DnD_Char):
+  record = char.to_snapshot()
+  record["id"] = record.pop("Id")
+  del record["version"]
+  return record
+
+#export records as the text of a JSON or CSV character file
+def write_character_records(records, file_format: str):
+  if file_format == "json":
+    return json.dumps(records, indent = 1)
+  out = io.StringIO()
+  writer = csv.DictWriter(out, fieldnames = ("id",) + csv_scalar_columns + csv_json_columns)
+  writer.writeheader()
+  for record in records:
+    row = {key: record.get(key) for key in ("id",) + csv_scalar_columns[:8]}
+    row["current_hp"], row["max_hp"] = record["hp"]
+    row.update({stat: record["stats"].get(stat) for stat in core_stats})
+    row.update({key: json.dumps(record.get(key)) for key in csv_json_columns})
+    writer.writerow(row)
+  return out.getvalue()
+
+#writes a list of characters out as the cache snapshot and swaps it in for the old one
+@timed
+def save_cache_snapshot(cache: DnD_Cache, chars, path: str = snapshot_path):
+  tmp_path = path + ".tmp"
+  records = []
+  with open(tmp_path, "wb") as f:
+    #placeholder header, rewritten once the index offset is known
+    f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_FORMAT, 0, 0, 0))
+    seen = set()
+    for char in sorted(chars, key = lambda c: c.Id):
+      if char.Id in seen:
+        continue
+      seen.add(char.Id)
+      payload = json.dumps(char.to_snapshot()).encode("utf-8")
+      records.append((char.Id, char.version, f.tell(), len(payload)))
+      f.write(payload)
+    index_offset = f.tell()
+    for record in records:
+      f.write(SNAPSHOT_RECORD.pack(*record))
+    f.seek(0)
+    f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_FORMAT, 0, len(records), index_offset))
+    f.flush()
+    os.fsync(f.fileno())
+  #the old map has to be closed before the file can be replaced on windows
+  cache.detach_snapshot()
+  os.replace(tmp_path, path)
+  cache.attach_snapshot(path)
+  logging.info(f"Wrote cache snapshot with {len(records)} characters.")
+
 #updates the user table, used whenever the cache pushes to database
+@timed
 def update_users_table(cache: DnD_Cache, conn):
     cursor = conn.cursor()
     # Group characters by owner
@@ -519,33 +2364,38 @@ def update_users_table(cache: DnD_Cache, conn):
           chars = excluded.chars,
           n_chars = excluded.n_chars
         """, (user_id, chars_json, n_chars))
-      conn.commit()
+    conn.commit()
 
 #pushing the dnd character cache to a database
+#returns the list of characters that were pushed, empty if nothing was written
+@timed
 def push_dnd_cache_to_db(cache: DnD_Cache, db: str = db_path):
   if cache.is_empty():
     logging.info("Character cache is empty. Skipping database push.")
-    return
+    return []
   try:
-    conn = lite.connect(db)
+    conn = lite.connect(db, factory = TimedConnection)
     conn.row_factory = lite.Row
 
     chars = list(cache.all_characters())
     logging.info(f"Starting push of {len(chars)} characters to database.")
     
     for character in chars:
-      character.to_db(conn)
+      character.to_db(conn, commit = False)
     #update the users table
     update_users_table(cache, conn) 
     conn.commit()
+    push_rows.labels().inc(len(chars))
     logging.info(f"Pushed {len(chars)} characters to database.")
     cache.clear()
     logging.info("Cache cleared after successful push.")
+    return chars
 
   except Exception as e:
     if 'conn' in locals():
       conn.rollback()
     logging.error(f"Failed to push characters to database: {e}")
+    return []
   finally:
     if 'conn' in locals():
       conn.close()
@@ -555,46 +2405,390 @@ def schedule_push(cache, db_path, interval_seconds = 7200):
   def loop():
     while True:
       try:
-        push_dnd_cache_to_db(cache, db_path)
+        pushed = push_dnd_cache_to_db(cache, db_path)
+        #the pushed characters are the warm set, keep them on disk for a fast restart
+        if pushed:
+          save_cache_snapshot(cache, pushed)
       except Exception as e:
         logging.error(f"Scheduled push failed: {e}")
       time.sleep(interval_seconds)
   thread = threading.Thread(target = loop, daemon = True)
   thread.start()
   logging.info(f"Started Scheduled cache push every {interval_seconds} seconds.")
-  
-#initialize connection to database
-def init_db(db_path = db_path):
-  conn = lite.connect(db_path)
-  cursor = conn.cursor()
-  cursor.execute("""
-  CREATE TABLE IF NOT EXISTS users (
-    user_id INTEGER PRIMARY KEY,
-    chars TEXT, -- JSON [char_id,...]
-    n_chars INTEGER
-  );
-  """)
-  #Not adding a foreign key on user id/owner as this data may be used to train an ML model
-  cursor.execute("""
-  CREATE TABLE IF NOT EXISTS dnd_characters (
-    id INTEGER PRIMARY KEY,
-    owner INTEGER,
-    name TEXT,
-    race TEXT,
-    background TEXT,
-    hit_dice TEXT, -- JSON {"class": "1d8",...}
-    stats TEXT, -- JSON {"str": 10, "cha": 8,...}
+
+#flush the cache and leave a snapshot behind on a graceful shutdown
+def shutdown_cache(cache, db_path = db_path):
+  pushed = push_dnd_cache_to_db(cache, db_path)
+  if pushed:
+    save_cache_snapshot(cache, pushed)
+  cache.detach_snapshot()
+
+#Backups
+#Taken with sqlite's online backup API, pages_per_step pages at a time with a pause in between, so the
+#bot's writes only ever wait on one short step. A write mid backup makes sqlite start the copy over,
+#fine for a database that is written in bursts. If it keeps starting over (max_restarts) the rest
+#is copied in one step, which holds off writers for that one copy.
+#Each backup is integrity checked before it is given its final name, and only the newest backup_keep are kept.
+#BACKUP_DIR, BACKUP_KEEP and BACKUP_INTERVAL (seconds, 0 turns scheduled backups off) configure it
+backup_dir = os.getenv("BACKUP_DIR", os.path.join(os.path.dirname(__file__), "backups"))
+backup_keep = int(os.getenv("BACKUP_KEEP", 14))
+
+#True if sqlite's integrity check passes on the database at path
+def check_db_integrity(path: str):
+  conn = None
+  try:
+    conn = lite.connect(f"file:{path}?mode=ro", uri = True)
+    rows = conn.execute("PRAGMA integrity_check").fetchall()
+  except lite.DatabaseError as e:
+    logging.error(f"Integrity check of {path} failed: {e}")
+    return False
+  finally:
+    if conn:
+      conn.close()
+  if rows != [("ok",)]:
+    logging.error(f"Integrity check of {path} failed: {'; '.join(row[0] for row in rows[:5])}")
+    return False
+  return True
+
+#backups of db in directory, oldest first. Only the timestamped ones taken by backup_db, not pre-restore copies
+def list_backups(db: str = db_path, directory: str = backup_dir):
+  stem = os.path.splitext(os.path.basename(db))[0]
+  pattern = re.compile(rf"{re.escape(stem)}-\d{{8}}-\d{{6}}\.db")
+  if not os.path.isdir(directory):
+    return []
+  return sorted(os.path.join(directory, name) for name in os.listdir(directory) if pattern.fullmatch(name))
+
+#raised from the progress callback to stop a stepped copy that keeps starting over
+class BackupRestarting(Exception):
+  pass
+
+#copies db to directory/<name>-<utc timestamp>[-label].db and returns the path. Raises if the copy fails its integrity check
+@timed
+def backup_db(db: str = db_path, directory: str = backup_dir, keep: int = backup_keep, label: str = None,
+              pages_per_step: int = 256, pause: float = 0.01, max_restarts: int = 3):
+  os.makedirs(directory, exist_ok = True)
+  stem = os.path.splitext(os.path.basename(db))[0]
+  name = f"{stem}-{time.strftime('%Y%m%d-%H%M%S', time.gmtime())}{f'-{label}' if label else ''}.db"
+  path = os.path.join(directory, name)
+  tmp_path = path + ".tmp"
+  last_remaining = None
+  restarts = 0
+  def progress(status, remaining, total):
+    nonlocal last_remaining, restarts
+    #more pages left than after the last step means a write sent the copy back to the start
+    if last_remaining is not None and remaining > last_remaining:
+      restarts += 1
+      if restarts > max_restarts:
+        raise BackupRestarting()
+    last_remaining = remaining
+    #sqlite lets go of the source between steps, the pause gives the bot's writes a chance at it
+    time.sleep(pause)
+  source = lite.connect(db, factory = TimedConnection)
+  target = lite.connect(tmp_path)
+  try:
+    try:
+      source.backup(target, pages = pages_per_step, progress = progress)
+    except BackupRestarting:
+      logging.warning(f"Backup of {db} restarted {restarts} times under writes, finishing it in one step.")
+      source.backup(target)
+  finally:
+    target.close()
+    source.close()
+  if not check_db_integrity(tmp_path):
+    os.remove(tmp_path)
+    raise lite.DatabaseError(f"Backup of {db} failed its integrity check")
+  os.replace(tmp_path, path)
+  if label is None:
+    for old in list_backups(db, directory)[:-max(keep, 1)]:
+      os.remove(old)
+  logging.info(f"Backed up {db} to {path} ({os.path.getsize(path) / 2**20:.1f} MiB).")
+  return path
+
+#Overwrites db with a backup, after checking the backup and saving the current database as a -pre-restore backup.
+#Meant for the command line with the bot stopped: a running bot has characters cached from the old data
+#The cache snapshot is removed as well: its characters are from after the backup and would otherwise be
+#loaded, and pushed again, over the restored ones. Returns (pre-restore backup or None, True if a snapshot was removed)
+@timed
+def restore_db(backup_path: str, db: str = db_path, directory: str = backup_dir, snapshot: str = snapshot_path):
+  if not check_db_integrity(backup_path):
+    raise lite.DatabaseError(f"{backup_path} failed its integrity check, not restoring it")
+  previous = backup_db(db, directory, label = "pre-restore") if os.path.exists(db) else None
+  source = lite.connect(f"file:{backup_path}?mode=ro", uri = True)
+  target = lite.connect(db)
+  try:
+    source.backup(target)
+  finally:
+    target.close()
+    source.close()
+  removed = False
+  for path in (snapshot, snapshot + ".tmp"):
+    if os.path.exists(path):
+      os.remove(path)
+      removed = True
+  logging.info(f"Restored {db} from {backup_path}{', removed the cache snapshot' if removed else ''}.")
+  return previous, removed
+
+#scheduled backups on their own thread, like the cache push
+def schedule_backups(db_path, interval_seconds = int(os.getenv("BACKUP_INTERVAL", 6 * 3600))):
+  if interval_seconds <= 0:
+    return
+  def loop():
+    while True:
+      time.sleep(interval_seconds)
+      try:
+        backup_db(db_path)
+      except Exception as e:
+        logging.error(f"Scheduled backup failed: {e}")
+  thread = threading.Thread(target = loop, daemon = True)
+  thread.start()
+  logging.info(f"Started scheduled backups every {interval_seconds} seconds to {backup_dir}.")
+
+#Dice roll history for /luck
+#Every roll goes into its roller's ring buffer, which holds their last roll_ring_size rolls, and into a pending
+#list that a background thread appends to roll_history in batches (every ROLL_FLUSH_INTERVAL seconds, or
+#sooner once ROLL_FLUSH_BATCH rolls are waiting). Luck stats are running sums updated with each roll and
+#saved to roll_stats with every flush, so /luck never reads the history back. Players who haven't rolled
+#in a while are dropped from memory once everything of theirs is written
+Roll = namedtuple("Roll", ["time", "expression", "sides", "dice", "total"])
+
+#fixed size buffer of one player's latest rolls, the oldest is overwritten once it's full
+class RollRing:
+  __slots__ = ("rolls", "next", "count")
+  def __init__(self, size):
+    self.rolls = [None] * size
+    self.next = 0
+    self.count = 0
+  def append(self, roll):
+    self.rolls[self.next] = roll
+    self.next = (self.next + 1) % len(self.rolls)
+    self.count = min(self.count + 1, len(self.rolls))
+  def recent(self, n):
+    #newest first
+    size = len(self.rolls)
+    return [self.rolls[(self.next - i) % size] for i in range(1, min(n, self.count) + 1)]
+
+#one player's luck as running sums. rolled is compared with what fair dice average out to (expected), and
+#variance (the sum of each die's variance) turns the difference into a z score.
+#streak counts d20s in a row above 10 (positive) or at 10 or below (negative)
+class LuckStats:
+  __slots__ = ("rolls", "dice", "rolled", "expected", "variance", "d20s", "nat20s", "nat1s", "streak", "best_streak", "worst_streak")
+  def __init__(self, rolls = 0, dice = 0, rolled = 0, expected = 0.0, variance = 0.0, d20s = 0, nat20s = 0, nat1s = 0,
+               streak = 0, best_streak = 0, worst_streak = 0):
+    self.rolls = rolls
+    self.dice = dice
+    self.rolled = rolled
+    self.expected = expected
+    self.variance = variance
+    self.d20s = d20s
+    self.nat20s = nat20s
+    self.nat1s = nat1s
+    self.streak = streak
+    self.best_streak = best_streak
+    self.worst_streak = worst_streak
+  def add(self, sides, dice):
+    self.rolls += 1
+    self.dice += len(dice)
+    self.rolled += sum(dice)
+    self.expected += len(dice) * (sides + 1) / 2
+    self.variance += len(dice) * (sides * sides - 1) / 12
+    if sides != 20:
+      return
+    for die in dice:
+      self.d20s += 1
+      self.nat20s += die == 20
+      self.nat1s += die == 1
+      if die > 10:
+        self.streak = self.streak + 1 if self.streak > 0 else 1
+      else:
+        self.streak = self.streak - 1 if self.streak < 0 else -1
+      self.best_streak = max(self.best_streak, self.streak)
+      self.worst_streak = min(self.worst_streak, self.streak)
+  def z_score(self):
+    return (self.rolled - self.expected) / self.variance ** 0.5 if self.variance else 0.0
+  def row(self):
+    return tuple(getattr(self, name) for name in self.__slots__)
+
+class RollLog:
+  def __init__(self, ring_size = 50, flush_batch = 500, idle_seconds = 3600):
+    self.lock = threading.Lock()
+    self.ring_size = ring_size
+    self.flush_batch = flush_batch
+    self.idle_seconds = idle_seconds
+    self.rings = {} #Format {user_id: RollRing}
+    self.stats = {} #Format {user_id: LuckStats}, a player is loaded once both are here
+    self.unloaded = {} #Format {user_id: [Roll,...]}, rolls made before the player's saved stats were loaded
+    self.last_roll = {} #Format {user_id: time.monotonic() of their last roll}
+    self.pending = [] #Format [(user_id, Roll),...], not in roll_history yet
+    self.dirty = set() #players whose stats changed since the last flush
+    self.flush_wanted = threading.Event()
+  def loaded(self, user_id):
+    with self.lock:
+      return user_id in self.stats
+  #reads a player's saved stats and latest rolls, blocking, so called with asyncio.to_thread
+  def load(self, user_id, db: str = db_path):
+    if self.loaded(user_id):
+      return
+    stats, recent = load_roll_history(user_id, self.ring_size, db)
+    with self.lock:
+      if user_id in self.stats:
+        return
+      early = self.unloaded.pop(user_id, [])
+      #a flush may have written some of the early rolls already, those come from early instead
+      cutoff = early[0].time if early else float("inf")
+      ring = RollRing(self.ring_size)
+      for roll in reversed(recent):
+        if roll.time < cutoff:
+          ring.append(roll)
+      for roll in early:
+        ring.append(roll)
+        stats.add(roll.sides, roll.dice)
+      if early:
+        self.dirty.add(user_id)
+      self.rings[user_id] = ring
+      self.stats[user_id] = stats
+      self.last_roll[user_id] = time.monotonic()
+  #returns True if the player isn't loaded yet. The roll is kept aside until load adds it to their saved stats
+  def record(self, user_id, expression: str, sides: int, dice, total: int):
+    roll = Roll(time.time(), expression, sides, tuple(dice), total)
+    with self.lock:
+      self.pending.append((user_id, roll))
+      if len(self.pending) >= self.flush_batch:
+        self.flush_wanted.set()
+      stats = self.stats.get(user_id)
+      if stats is None:
+        self.unloaded.setdefault(user_id, []).append(roll)
+        return True
+      self.rings[user_id].append(roll)
+      stats.add(sides, roll.dice)
+      self.last_roll[user_id] = time.monotonic()
+      self.dirty.add(user_id)
+      return False
+  #a copy of the player's stats and their latest rolls, newest first
+  def snapshot(self, user_id, recent: int = 5):
+    with self.lock:
+      return LuckStats(*self.stats[user_id].row()), self.rings[user_id].recent(recent)
+  #hands the pending rolls and changed stats to a flush, which gives them back with requeue if it fails
+  def take_pending(self):
+    with self.lock:
+      pending, self.pending = self.pending, []
+      stats_rows = [(user_id,) + self.stats[user_id].row() for user_id in self.dirty]
+      self.dirty.clear()
+    return pending, stats_rows
+  def requeue(self, pending, stats_rows):
+    with self.lock:
+      self.pending[:0] = pending
+      self.dirty.update(row[0] for row in stats_rows)
+  def evict_idle(self):
+    cutoff = time.monotonic() - self.idle_seconds
+    with self.lock:
+      waiting = {user_id for user_id, _ in self.pending} | self.dirty
+      idle = [user_id for user_id, last in self.last_roll.items() if last < cutoff and user_id not in waiting]
+      for user_id in idle:
+        del self.rings[user_id], self.stats[user_id], self.last_roll[user_id]
+    return len(idle)
+  def counts(self):
+    with self.lock:
+      return len(self.stats), len(self.pending)
+
+roll_log = RollLog(
+  ring_size = int(os.getenv("ROLL_HISTORY_SIZE", 50)),
+  flush_batch = int(os.getenv("ROLL_FLUSH_BATCH", 500))
+)
+
+#a player's saved luck stats and their latest limit rolls, newest first
+@timed
+def load_roll_history(user_id: int, limit: int, db: str = db_path):
+  conn = lite.connect(db, factory = TimedConnection)
+  try:
+    row = conn.execute(f"SELECT {', '.join(LuckStats.__slots__)} FROM roll_stats WHERE user_id = ?", (user_id,)).fetchone()
+    rows = conn.execute("""
+      SELECT rolled_at, expression, sides, dice, total FROM roll_history
+      WHERE user_id = ? ORDER BY rolled_at DESC LIMIT ?
+    """, (user_id, limit)).fetchall()
+  finally:
+    conn.close()
+  recent = [Roll(rolled_at, expression, sides, tuple(json.loads(dice)), total) for rolled_at, expression, sides, dice, total in rows]
+  return LuckStats(*row) if row else LuckStats(), recent
+
+#appends the pending rolls to roll_history and saves the stats that changed, in one transaction.
+#Returns the number of rolls written
+@timed
+def flush_roll_log(log: RollLog, db: str = db_path):
+  pending, stats_rows = log.take_pending()
+  if not pending and not stats_rows:
+    return 0
+  conn = lite.connect(db, factory = TimedConnection)
+  try:
+    conn.executemany("INSERT INTO roll_history (user_id, rolled_at, expression, sides, dice, total) VALUES (?, ?, ?, ?, ?, ?)",
+                     [(user_id, roll.time, roll.expression, roll.sides, json.dumps(roll.dice), roll.total) for user_id, roll in pending])
+    columns = ("user_id",) + LuckStats.__slots__
+    conn.executemany(f"REPLACE INTO roll_stats ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})", stats_rows)
+    conn.commit()
+  except lite.Error:
+    conn.rollback()
+    log.requeue(pending, stats_rows)
+    raise
+  finally:
+    conn.close()
+  return len(pending)
+
+#roll flushes on their own thread, woken early when a batch fills up
+def schedule_roll_flush(log: RollLog, db_path, interval_seconds = int(os.getenv("ROLL_FLUSH_INTERVAL", 30))):
+  def loop():
+    while True:
+      log.flush_wanted.wait(interval_seconds)
+      log.flush_wanted.clear()
+      try:
+        flush_roll_log(log, db_path)
+        log.evict_idle()
+      except Exception as e:
+        logging.error(f"Roll history flush failed: {e}")
+  thread = threading.Thread(target = loop, daemon = True)
+  thread.start()
+  logging.info(f"Started roll history flushes every {interval_seconds} seconds.")
+
+#version of the schema built by init_db, kept in the database's user_version pragma.
+#Bump it whenever init_db gains a table, index or migration
+schema_version = 4
+
+#initialize connection to database
+#returns False without running any DDL if the database is already at schema_version
+@timed
+def init_db(db_path = db_path):
+  conn = lite.connect(db_path, factory = TimedConnection)
+  if conn.execute("PRAGMA user_version").fetchone()[0] >= schema_version:
+    conn.close()
+    return False
+  cursor = conn.cursor()
+  cursor.execute("""
+  CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    chars TEXT, -- JSON [char_id,...]
+    n_chars INTEGER
+  );
+  """)
+  #Not adding a foreign key on user id/owner as this data may be used to train an ML model
+  cursor.execute("""
+  CREATE TABLE IF NOT EXISTS dnd_characters (
+    id INTEGER PRIMARY KEY,
+    owner INTEGER,
+    name TEXT,
+    race TEXT,
+    background TEXT,
+    hit_dice TEXT, -- JSON {"class": "1d8",...}
+    stats TEXT, -- JSON {"str": 10, "cha": 8,...}
     hp TEXT, -- JSON [current, max]
     ac INTEGER,
     xp INTEGER,
-    points TEXT, -- JSON {"sorcerer points": 4, ...}
+    points TEXT, -- legacy JSON {"sorcerer points": 4, ...}, now kept in character_resources
     languages TEXT, -- JSON ["common", "thieves cant",...]
     equipment TEXT, -- JSON {"gold": 500, "dagger": 2,...}
     feats TEXT, -- JSON [...]
     abilities TEXT, -- JSON ["Darkvision", ...]
     exhaustion INTEGER,
-    ms INTEGER -- move speed,
-    notes TEXT -- JSON ["Note1", ...]
+    ms INTEGER, -- move speed
+    notes TEXT, -- JSON ["Note1", ...]
+    version INTEGER DEFAULT 0, -- bumped on every write, checked against cache snapshots
     FOREIGN KEY (owner) REFERENCES users(user_id)
   );
   """)
@@ -623,6 +2817,19 @@ def init_db(db_path = db_path):
     FOREIGN KEY (character_id) REFERENCES dnd_characters(id) ON DELETE CASCADE
   );
   """)
+  #spell slots and class points, one row each. Replaces the spell_slots table and points column, which
+  #migrate_resources copies over once
+  cursor.execute("""
+  CREATE TABLE IF NOT EXISTS character_resources (
+    character_id INTEGER,
+    kind TEXT, -- slot or points
+    name TEXT, -- slot level or points name, ie "3" or "sorcery points"
+    current INTEGER,
+    max INTEGER,
+    PRIMARY KEY (character_id, kind, name),
+    FOREIGN KEY (character_id) REFERENCES dnd_characters(id) ON DELETE CASCADE
+  ) WITHOUT ROWID;
+  """)
   cursor.execute("""
   CREATE TABLE IF NOT EXISTS spells (
     character_id INTEGER PRIMARY KEY,
@@ -630,20 +2837,204 @@ def init_db(db_path = db_path):
     FOREIGN KEY (character_id) REFERENCES dnd_characters(id) ON DELETE CASCADE
   );
   """)
+  #character creation wizard drafts, one per user, saved after every step
+  cursor.execute("""
+  CREATE TABLE IF NOT EXISTS character_drafts (
+    owner INTEGER PRIMARY KEY,
+    step TEXT, -- key of the current wizard step
+    data TEXT, -- JSON of everything entered so far
+    updated REAL
+  );
+  """)
+  #parties group characters for bulk operations like a party long rest
+  cursor.execute("""
+  CREATE TABLE IF NOT EXISTS parties (
+    id INTEGER PRIMARY KEY,
+    guild_id INTEGER,
+    name TEXT,
+    dm INTEGER, -- user id of the party's DM
+    UNIQUE (guild_id, name)
+  );
+  """)
+  cursor.execute("""
+  CREATE TABLE IF NOT EXISTS party_members (
+    party_id INTEGER,
+    character_id INTEGER,
+    PRIMARY KEY (party_id, character_id),
+    FOREIGN KEY (party_id) REFERENCES parties(id) ON DELETE CASCADE,
+    FOREIGN KEY (character_id) REFERENCES dnd_characters(id) ON DELETE CASCADE
+  );
+  """)
+  cursor.execute("CREATE INDEX IF NOT EXISTS idx_char_id_party_members ON party_members(character_id)")
+  #every dice roll, only ever appended to, and each player's running luck stats for /luck
+  cursor.execute("""
+  CREATE TABLE IF NOT EXISTS roll_history (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER,
+    rolled_at REAL,
+    expression TEXT, -- what was rolled, ie 2d6+3 or check: stealth
+    sides INTEGER,
+    dice TEXT, -- JSON [4, 2]
+    total INTEGER
+  );
+  """)
+  cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_id_roll_history ON roll_history(user_id, rolled_at)")
+  cursor.execute("""
+  CREATE TABLE IF NOT EXISTS roll_stats (
+    user_id INTEGER PRIMARY KEY,
+    rolls INTEGER,
+    dice INTEGER,
+    rolled INTEGER,
+    expected REAL,
+    variance REAL,
+    d20s INTEGER,
+    nat20s INTEGER,
+    nat1s INTEGER,
+    streak INTEGER, -- d20s in a row above 10 (positive) or at 10 or below (negative)
+    best_streak INTEGER,
+    worst_streak INTEGER
+  );
+  """)
+  #weapon catalog for /attack, seeded with the player's handbook weapons
+  cursor.execute("""
+  CREATE TABLE IF NOT EXISTS weapons (
+    name TEXT PRIMARY KEY,
+    damage TEXT, -- dice in ndm format, ie 1d8
+    damage_type TEXT,
+    category TEXT, -- simple or martial
+    ranged INTEGER,
+    properties TEXT -- JSON ["finesse", "light",...]
+  );
+  """)
+  cursor.executemany("INSERT OR IGNORE INTO weapons (name, damage, damage_type, category, ranged, properties) VALUES (?, ?, ?, ?, ?, ?)",
+                     [(name, damage, damage_type, category, ranged, json.dumps(properties)) for name, damage, damage_type, category, ranged, properties in weapon_seed])
   cursor.execute("CREATE INDEX IF NOT EXISTS idx_char_id_spells ON spells(character_id)")
   cursor.execute("CREATE INDEX IF NOT EXISTS idx_char_id_spell_slots ON spell_slots(character_id)")
   cursor.execute("CREATE INDEX IF NOT EXISTS idx_char_id_proficiencies ON proficiencies(character_id)")
   cursor.execute("CREATE INDEX IF NOT EXISTS idx_char_id_classes ON character_classes(character_id)")
   cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_id ON dnd_characters(owner)")
+  #databases made before row versions were added
+  cursor.execute("PRAGMA table_info(dnd_characters)")
+  columns = {row[1] for row in cursor.fetchall()}
+  if "version" not in columns:
+    cursor.execute("ALTER TABLE dnd_characters ADD COLUMN version INTEGER DEFAULT 0")
+  migrate_resources(cursor)
+  init_search_index(cursor)
+  cursor.execute(f"PRAGMA user_version = {schema_version}")
   conn.commit()
   conn.close()
+  return True
+
+#copies spell slots and points of characters saved before character_resources existed out of the spell_slots
+#table and the points column. Characters that already have resource rows are left alone
+def migrate_resources(cursor):
+  cursor.execute("""
+  SELECT c.id, c.points, s.slots FROM dnd_characters c LEFT JOIN spell_slots s ON s.character_id = c.id
+  WHERE NOT EXISTS (SELECT 1 FROM character_resources r WHERE r.character_id = c.id)
+  """)
+  rows = []
+  for char_id, points, slots in cursor.fetchall():
+    for kind, data in (("slot", slots), ("points", points)):
+      for name, value in json.loads(data or "{}").items():
+        current, maximum = value if isinstance(value, list) else (value, value)
+        rows.append((char_id, kind, name, current, maximum))
+  cursor.executemany("INSERT INTO character_resources (character_id, kind, name, current, max) VALUES (?, ?, ?, ?, ?)", rows)
+  if rows:
+    logging.info(f"Moved {len(rows)} spell slot and points entries into character_resources.")
+
+#Full text search over character names, notes, abilities and equipment for /search.
+#character_search is an FTS5 index that reads its text from dnd_characters (external content), so nothing is
+#stored twice. The triggers update it on every insert, delete and change of one of those columns, however the
+#row was written. The JSON columns are indexed as they are, the tokenizer skips the brackets and quotes.
+#An sqlite built without FTS5 just goes without search
+def init_search_index(cursor):
+  cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'character_search'")
+  is_new = cursor.fetchone() is None
+  try:
+    cursor.execute("""
+    CREATE VIRTUAL TABLE IF NOT EXISTS character_search USING fts5(
+      name, notes, abilities, equipment,
+      content = 'dnd_characters', content_rowid = 'id', tokenize = 'unicode61 remove_diacritics 2'
+    )""")
+  except lite.OperationalError as e:
+    logging.warning(f"No character search, this sqlite can't make an FTS5 table: {e}")
+    return
+  cursor.execute("""
+  CREATE TRIGGER IF NOT EXISTS character_search_insert AFTER INSERT ON dnd_characters BEGIN
+    INSERT INTO character_search (rowid, name, notes, abilities, equipment)
+    VALUES (new.id, new.name, new.notes, new.abilities, new.equipment);
+  END""")
+  cursor.execute("""
+  CREATE TRIGGER IF NOT EXISTS character_search_delete AFTER DELETE ON dnd_characters BEGIN
+    INSERT INTO character_search (character_search, rowid, name, notes, abilities, equipment)
+    VALUES ('delete', old.id, old.name, old.notes, old.abilities, old.equipment);
+  END""")
+  #to_db rewrites every column, only reindex when the searched text actually changed
+  cursor.execute("""
+  CREATE TRIGGER IF NOT EXISTS character_search_update AFTER UPDATE OF name, notes, abilities, equipment ON dnd_characters
+  WHEN old.name IS NOT new.name OR old.notes IS NOT new.notes OR old.abilities IS NOT new.abilities OR old.equipment IS NOT new.equipment
+  BEGIN
+    INSERT INTO character_search (character_search, rowid, name, notes, abilities, equipment)
+    VALUES ('delete', old.id, old.name, old.notes, old.abilities, old.equipment);
+    INSERT INTO character_search (rowid, name, notes, abilities, equipment)
+    VALUES (new.id, new.name, new.notes, new.abilities, new.equipment);
+  END""")
+  if is_new:
+    #index the characters that are already there
+    cursor.execute("INSERT INTO character_search (character_search) VALUES ('rebuild')")
+
+#FTS5 query for what a user typed: every word has to match, the last one as a prefix so a half typed word still does
+def search_query(text: str):
+  words = re.findall(r"\w+", text.lower())
+  if not words:
+    return None
+  return " ".join(f'"{word}"' for word in words[:-1]) + f' "{words[-1]}"*'
+
+#characters in a guild matching text, best match first: [(character_id, owner, name, snippet),...].
+#A guild's characters are the ones in its parties and the ones owned by member_ids.
+#Name matches weigh the most, then abilities and equipment, then notes
+@timed
+def search_characters(text: str, guild_id: int, member_ids, limit: int = 10, db: str = db_path):
+  query = search_query(text)
+  if query is None:
+    return []
+  conn = lite.connect(db, factory = TimedConnection)
+  try:
+    cursor = conn.cursor()
+    cursor.execute("""
+    SELECT c.id, c.owner, c.name, snippet(character_search, -1, '**', '**', '...', 12)
+    FROM character_search JOIN dnd_characters c ON c.id = character_search.rowid
+    WHERE character_search MATCH ?
+      AND (c.owner IN (SELECT value FROM json_each(?))
+           OR c.id IN (SELECT pm.character_id FROM party_members pm JOIN parties p ON p.id = pm.party_id WHERE p.guild_id = ?))
+    ORDER BY bm25(character_search, 5.0, 1.0, 2.0, 2.0)
+    LIMIT ?
+    """, (query, json.dumps(list(member_ids)), guild_id, limit))
+    rows = cursor.fetchall()
+  finally:
+    conn.close()
+  #snippets come out of the JSON columns, drop the brackets and quotes
+  return [(char_id, owner, name, re.sub(r'[\[\]{}"]', "", snippet)) for char_id, owner, name, snippet in rows]
+
+#drafts nobody came back to in 30 days
+@timed
+def purge_stale_drafts(max_age_days: int = 30, db = db_path):
+  conn = lite.connect(db, factory = TimedConnection)
+  try:
+    removed = conn.execute("DELETE FROM character_drafts WHERE updated < ?", (time.time() - max_age_days * 86400,)).rowcount
+    conn.commit()
+  finally:
+    conn.close()
+  if removed:
+    logging.info(f"Removed {removed} abandoned character drafts.")
 
 #Get the highest character ID from the table
+@timed
 def update_max_id():
   global max_id
   conn = None
   try:
-    conn = lite.connect(db_path)
+    conn = lite.connect(db_path, factory = TimedConnection)
     cursor = conn.cursor()
     cursor.execute("SELECT MAX(id) FROM dnd_characters")
     result = cursor.fetchone()
@@ -657,15 +3048,16 @@ def update_max_id():
       conn.close()
 #Function to check tables for entries
 #This is necessary to populate the ID iterator correctly in runtime cache of characters
+@timed
 def check_for_entries(table_name, db = db_path):
   #returns True if there are one or more entires, False otherwise
   #Return: bool: True if 1 or more entries, False otherwise
   conn = None
-  allowed_tables = {"dnd_characters", "users", "spells", "spell_slots", "proficiencies", "character_classes"}
+  allowed_tables = {"dnd_characters", "users", "spells", "spell_slots", "proficiencies", "character_classes", "weapons", "character_resources"}
   if table_name not in allowed_tables:
     raise ValueError("Invalid table name")
   try:
-    conn = lite.connect(db)
+    conn = lite.connect(db, factory = TimedConnection)
     cursor = conn.cursor()
     #query to count entries
     cursor.execute(f"SELECT COUNT(*) FROM {table_name}")
@@ -680,519 +3072,692 @@ def check_for_entries(table_name, db = db_path):
 
 TOKEN = os.getenv("DISCORD_TOKEN")
 
-slot_lib = ctypes.CDLL('./slot_machine.dll')
-
-slot_lib.play_machine.argtypes = [ctypes.c_char_p]
-slot_lib.play_machine.restype = ctypes.c_char_p
+#the slot machine library is loaded on first use so the module can be imported without it (benchmarks, tools)
+slot_lib = None
+def get_slot_lib():
+  global slot_lib
+  if slot_lib is None:
+    lib = ctypes.CDLL('./slot_machine.dll')
+    lib.play_machine.argtypes = [ctypes.c_char_p]
+    lib.play_machine.restype = ctypes.c_char_p
+    slot_lib = lib
+  return slot_lib
 MACHINE_TYPES = ["basic","complex","default"]
 
-intents = discord.Intents.default()
-bot = commands.Bot(command_prefix = "!", intents = intents)
-tree = app_commands.CommandTree(bot)
-
-#a class to handle getting multiple classes with levels as an interactive prompt in character creation
-class ClassLevelModal(ui.Modal, title = "Add a Class"):
-  class_name = ui.TextInput(label = "Class", placeholder = "eg. wizard", required = True)
-  level = ui.TextInput(label = f"Level", placeholder = "eg. 1", required = True)
-  def __init__(self, existing_classes):
-    super().__init__(title = "Add a class", custom_id = "class_level_modal")
-    self.existing_classes = existing_classes
-    self.result = None
-  async def on_submit(self, interaction: discord.Interaction):
-    cls = self.class_name.value.strip().lower()
-    lvl = self.level.value.strip()
-    if cls not in class_dice:
-      await interaction.response.send_message(f"Invalid class selection: {cls}. Supported classes: {', '.join(class_dice)}", ephemeral = True)
-      return
-    try:
-      lvl = int(lvl)
-      if lvl < 1 or lvl > 20:
-        raise ValueError
-    except ValueError:
-      await interaction.response.send_message("Level must be a number between 1 and 20.", ephemeral = True)
-      return
-    if cls in self.existing_classes:
-      await interaction.response.send_message(f"The class {cls} is already in your list. Each class can only be added once.", ephemeral = True)
-      return
-    self.result = (cls, lvl)
-    await interaction.response.send_message(f"Added {cls} at level {lvl}.", ephemeral = True)
-
-#Interactive view to loop until user done entering classes
-class ClassLoopView(ui.View):
-  def __init__(self, timeout = 500):
-    super().__init__(timeout = timeout)
-    self.class_data = {}
-    self.finished = False
-  @discord.ui.button(label = "Add Class", style = discord.ButtonStyle.primary)
-  async def add_class(self, interaction: discord.Interaction, button: ui.Button):
-    await interaction.response.send_message(f"Please add a class from the following list of classes: {", ".join(class_dice)}", ephemeral = True)
-    modal = ClassLevelModal(existing_classes = self.class_data)
-    await interaction.response.send_modal(modal)
-    def check(i): return i.user == interaction.user and i.type.name == "modal_submit" and i.data.get("custom_id") == "class_level_modal"
-    try:
-      modal_interaction = await interaction.client.wait_for("interaction", check=check, timeout=300)
-    except asyncio.TimeoutError:
-      await interaction.followup.send("Modal timed out.", ephemeral = True)
-      return
-    if modal.result:
-      cls, lvl = modal.result
-      self.class_data[cls] = lvl
-  @discord.ui.button(label = "Finish", style = discord.ButtonStyle.success)
-  async def finish(self, interaction: discord.Interaction, button = ui.Button):
-    if not self.class_data:
-      await interaction.followup.send("Please add at least one class.", ephemeral = True)
-      return
-    self.finished = True
-    self.stop()
-    class_summary = "\n".join([f"{cls.title()} - Level {lvl}" for cls, lvl in self.class_data.items()])
-    await interaction.followup.send(f"Final class breakdown:\n{class_summary}", ephemeral = True)
-
-class SubclassModal(ui.Modal, title = "Add Subclass"):
-  subclass = ui.TextInput(label = "Subclass Name", placeholder = "eg.; Circle of the Moon", required = True, max_length = 50)
-  def __init__(self, view):
-    super().__init__(title = "Add Subclass", timeout = 180, custom_id = "subclass_modal")
-    self.view = view
-    self.add_item(self.subclass)
-  async def on_submit(self, interaction: discord.Interaction):
-    name = self.subclass.value.strip().lower()
-    if not name:
-      await interaction.response.send_message("Subclass name cannot be empty.", ephemeral = True)
-      return
-    self.view.subclass = name
-    await interaction.response.send_message(f"Added {name} as subclass.", ephemeral = True)
+#Command scheduling
+#Every app command asks command_scheduler for a slot before it runs (see MetricsTree._call). A guild and a user
+#can each only have so many commands running at once, and both are rate limited with token buckets.
+#Commands have a priority: gameplay (dice, checks, combat) goes before standard commands, which go before bulk and
+#cosmetic ones (slot, simulate, the character wizard, party bulk operations). Freed slots go to the highest
+#priority waiting, and the lower priorities can't spend the last part of a bucket, so a busy guild loses its
+#slot machine before its dice. Bulk commands don't queue at all, and nothing waits longer than
+#SCHEDULER_MAX_WAIT because discord wants a response within 3 seconds. Turned away commands get a reply saying why
+PRIORITY_GAMEPLAY, PRIORITY_STANDARD, PRIORITY_BULK = 0, 1, 2
+priority_names = ("gameplay", "standard", "bulk")
+#by qualified name, then by group name. Anything not listed is standard
+command_priorities = {
+  "roll": PRIORITY_GAMEPLAY, "check": PRIORITY_GAMEPLAY, "attack": PRIORITY_GAMEPLAY, "spell": PRIORITY_GAMEPLAY,
+  "use": PRIORITY_GAMEPLAY, "restore": PRIORITY_GAMEPLAY, "combat": PRIORITY_GAMEPLAY,
+  "slot": PRIORITY_BULK, "simulate": PRIORITY_BULK, "add_character": PRIORITY_BULK, "resume_character": PRIORITY_BULK,
+  "party rest": PRIORITY_BULK, "party xp": PRIORITY_BULK, "party damage": PRIORITY_BULK,
+  "import_characters": PRIORITY_BULK, "export_characters": PRIORITY_BULK, "stats": PRIORITY_BULK, "sync_commands": PRIORITY_BULK,
+  "backup": PRIORITY_BULK
+}
+#share of a bucket each priority has to leave behind, gameplay can empty it
+bucket_reserve = (0.0, 0.25, 0.5)
+rejection_messages = {
+  "user_rate": "You're sending commands too quickly, try again in a few seconds.",
+  "guild_rate": "This server is sending a lot of commands right now, try again in a few seconds.",
+  "user_busy": "Your other commands are still running, try again once they finish.",
+  "guild_busy": "This server has a lot of commands running right now, try again in a few seconds."
+}
 
-class SubclassView(ui.View):
-  def __init__(self):
-    super().__init__(timeout = 300)
-    self.subclass = ""
-    self.finished = False
-  @discord.ui.button(label = "Add subclass", style = discord.ButtonStyle.primary)
-  async def add_subclass(self, interaction: discord.Interaction, button: ui.Button):
-    modal = SubclassModal(view = self)
-    await interaction.response.send_modal(modal)
-    def check(i): return i.user == interaction.user and i.type.name == "modal_submit" and i.data.get("custom_id") == "subclass_modal"
-    try:
-      await interaction.client.wait_for("interaction", check = check, timeout = 300)
-    except asyncio.TimeoutError:
-      await interaction.followup.send("Subclass entry timed out.", ephemeral = True)
-  @discord.ui.button(label = "Finish", style = discord.ButtonStyle.success)
-  async def finish(self, interaction: discord.Interaction, button: ui.Button):
-    self.finished = True
-    self.stop()
-    if self.subclass == "":
-      await interaction.response.send_message("No subclass added.\nYour class level indicates you should have a subclass.\nAdd one later.", ephemeral = True)
-    else:
-      await interaction.response.send_message("Subclass entry complete.", ephemeral = True)
-
-class ProficiencyModal(ui.Modal, title = "Add Proficiency"):
-  proficiency = ui.TextInput(label = "Proficiency name", placeholder = "eg.; str, athletics, thieves tools etc", required = True, max_length = 50)
-  level = ui.TextInput(label = "Proficiency level (1 = Proficient, 2 = Expertise)", placeholder = "Enter 1 or 2", required = True, max_length = 1)
-  def __init__(self, view):
-    super().__init__(title="Add Proficiency", timeout=180, custom_id="proficiency_modal")
-    self.view = view
-    self.add_item(self.proficiency)
-    self.add_item(self.level)
-  async def on_submit(self, interaction: discord.Interaction):
-    name = self.proficiency.value.strip().lower()
-    level = self.level.value.strip()
-    if level not in ("1", "2"):
-      await interaction.response.send_message("Level must be 1 or 2. Please try again.", ephemeral = True)
-      return
-    if not name:
-      await interaction.response.send_message("Proficiency name cannot be empty", ephemeral = True)
-      return
-    if name in self.view.proficiencies:
-      await interaction.response.send_message(f"{name} already added.", ephemeral = True)
-      return
-    self.view.proficiencies[name] = int(level)
-    await interaction.response.send_message(f"Added: {name} (Level {level})", ephemeral = True)
+def command_priority(name: str):
+  priority = command_priorities.get(name)
+  if priority is None:
+    priority = command_priorities.get(name.split(" ")[0], PRIORITY_STANDARD)
+  return priority
 
-class ProficiencyView(ui.View):
-  def __init__(self):
-    super().__init__(timeout = 300)
-    self.proficiencies = {}
-    self.finished = False
-  @discord.ui.button(label = "Add Proficiency", style = discord.ButtonStyle.primary)
-  async def add_proficiency(self, interaction: discord.Interaction, button: ui.Button):
-    modal = ProficiencyModal(view = self)
-    await interaction.response.send_modal(modal)
-    def check(i): return i.user == interaction.user and i.type.name == "modal_submit" and i.data.get("custom_id") == "proficiency_modal"
+#rate tokens a second up to capacity
+class TokenBucket:
+  __slots__ = ("rate", "capacity", "tokens", "updated")
+  def __init__(self, rate: float, capacity: float):
+    self.rate = rate
+    self.capacity = capacity
+    self.tokens = capacity
+    self.updated = time.monotonic()
+  def refill(self, now: float):
+    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+    self.updated = now
+  def take(self, now: float, reserve: float = 0.0):
+    #False if taking a token would leave less than reserve
+    self.refill(now)
+    if self.tokens - 1 < reserve:
+      return False
+    self.tokens -= 1
+    return True
+  def give_back(self):
+    self.tokens = min(self.capacity, self.tokens + 1)
+
+#at most limit holders, the rest wait in priority order (then arrival order)
+class ConcurrencyLimit:
+  __slots__ = ("limit", "active", "waiters", "seq")
+  def __init__(self, limit: int):
+    self.limit = limit
+    self.active = 0
+    self.waiters = [] #heap of (priority, seq, future)
+    self.seq = 0
+  def idle(self):
+    return self.active == 0 and not self.waiters
+  async def acquire(self, priority: int, timeout: float):
+    if self.active < self.limit and not self.waiters:
+      self.active += 1
+      return True
+    if timeout <= 0:
+      return False
+    future = asyncio.get_running_loop().create_future()
+    self.seq += 1
+    heapq.heappush(self.waiters, (priority, self.seq, future))
     try:
-      await interaction.client.wait_for("interaction", check = check, timeout = 300)
+      await asyncio.wait_for(future, timeout)
     except asyncio.TimeoutError:
-      await interaction.followup.send("Proficiency entry timed out.", ephemeral = True)
-  @discord.ui.button(label = "Finish", style = discord.ButtonStyle.success)
-  async def finish(self, interaction: discord.Interaction, button: ui.Button):
-    self.finished = True
-    self.stop()
-    if not self.proficiencies:
-      await interaction.response.send_message("No proficiencies added.", ephemeral = True)
-    else:
-      proficiency_summary = "\n".join([f"{prof.title()} - Level {lvl}" for prof, lvl in self.proficiencies.items()])
-      await interaction.response.send_message(f"Added proficiencies:\n{proficiency_summary}", ephemeral = True)
-    
+      if future.done() and not future.cancelled():
+        #the slot was handed over just as the wait ran out, pass it on
+        self.release()
+      future.cancel()
+      return False
+    return True
+  def release(self):
+    #hand the slot straight to the next waiter still waiting, active stays the same
+    while self.waiters:
+      future = heapq.heappop(self.waiters)[2]
+      if not future.done():
+        future.set_result(None)
+        return
+    self.active -= 1
 
-class SpellsModal(ui.Modal, title = "Add Spell"):
-  spell = ui.TextInput(label = "Spell Name", placeholder = "eg.; fireball", required = True, max_length = 30)
-  level = ui.TextInput(label = "Spell Level (cantrip or 1-9)", placeholder = "eg.; (cantrip) or (1)", required = True, max_length = 7)
-  def __init__(self, view):
-    super().__init__(title = "Add Spell", timeout = 180, custom_id = "spells_modal")
-    self.view = view
-    self.add_item(self.spell)
-    self.add_item(self.level)
-  async def on_submit(self, interaction: discord.Interaction):
-    name = self.spell.value.strip().lower()
-    level = self.level.value.strip()
-    approved = {"cantrip"} | {str(i) for i in range(1,10)}
-    if level not in approved:
-      await interaction.response.send_message("level must either be cantrip or a number 1-9. Please try again.", ephemeral = True)
-      return
-    self.view.spells[name] = level
-    await interaction.response.send_message(f"Added: {name.title()} (Level {level})", ephemeral = True)
+#what an admitted command holds, released once when the command is done (or earlier, see release_early)
+class SchedulerTicket:
+  __slots__ = ("scheduler", "guild_id", "user_id", "priority", "released")
+  def __init__(self, scheduler, guild_id, user_id, priority):
+    self.scheduler = scheduler
+    self.guild_id = guild_id
+    self.user_id = user_id
+    self.priority = priority
+    self.released = False
+  def release(self):
+    if not self.released:
+      self.released = True
+      self.scheduler.release(self)
 
-class SpellsView(ui.View):
-  def __init__(self):
-    super().__init__(timeout = 300)
-    self.spells = {}
-    self.finished = False
-  @discord.ui.button(label = "Add spell", style = discord.ButtonStyle.primary)
-  async def add_spell(self, interaction: discord.Interaction, button: ui.Button):
-    modal = SpellsModal(view = self)
-    await interaction.response.send_modal(modal)
-    def check(i: discord.Interaction): return i.user == interaction.user and i.type.name == "modal_submit" and i.data.get("custom_id") == "spells_modal"
-    try:
-      await interaction.client.wait_for("interaction", check = check, timeout = 300)
-    except asyncio.TimeoutError:
-      await interaction.followup.send("Spell entry timed out.", ephemeral = True)
-  @discord.ui.button(label = "Finish", style = discord.ButtonStyle.success)
-  async def finish(self, interaction: discord.Interaction, button: ui.Button):
-    self.finished = True
-    self.stop()
-    if not self.spells:
-      await interaction.response.send_message("No spells added at this time.", ephemeral = True)
-    else:
-      spells_summary = "\n".join([f"{spell.title()} - Level {lvl}" for spell, lvl in self.spells.items()])
-      await interaction.response.send_message(f"Added spells:\n{spells_summary}", ephemeral = True)
-
-class SpellSlotsModal(ui.Modal, title = "Add spell slots array"):
-  level = ui.TextInput(label = "Slot level", placeholder = "eg.; 1", required = True, max_length = 1)
-  num = ui.TextInput(label = "Number of Slots for that level", placeholder = "eg.; 3", required = True, max_length = 2)
-  def __init__(self, view):
-    super().__init__(title = "Add spell slots array", timeout = 180, custom_id = "spellslots_modal")
-    self.view = view
-    self.add_item(self.level)
-    self.add_item(self.num)
-  async def on_submit(self, interaction: discord.Interaction):
-    level = self.level.value.strip()
-    try:
-      num = int(self.num.value.strip())
-    except ValueError:
-      await interaction.response.send_message("Number of slots must be a valid integer.", ephemeral = True)
-      return
-    approved = {str(i) for i in range(1,10)}
-    if level not in approved:
-      await interaction.response.send_message("level must be a number 1-9. Please try again.", ephemeral = True)
-      return
-    self.view.slots[level] = num
-    await interaction.response.send_message(f"Added {num} slots at level {level}", ephemeral = True)
+class CommandScheduler:
+  def __init__(self, guild_concurrency: int, user_concurrency: int, guild_rate: float, guild_burst: float,
+               user_rate: float, user_burst: float, max_wait: float):
+    self.guild_concurrency = guild_concurrency
+    self.user_concurrency = user_concurrency
+    self.guild_rate = guild_rate
+    self.guild_burst = guild_burst
+    self.user_rate = user_rate
+    self.user_burst = user_burst
+    self.max_wait = max_wait
+    self.guild_limits = {} #Format {guild_id: ConcurrencyLimit}, dropped when idle
+    self.user_limits = {} #Format {user_id: ConcurrencyLimit}, dropped when idle
+    self.guild_buckets = {} #Format {guild_id: TokenBucket}
+    self.user_buckets = {} #Format {user_id: TokenBucket}
+    self.tickets = {} #Format {interaction id: SchedulerTicket} for commands still running
+    self.admitted = 0
+  def bucket(self, buckets, key, rate, burst):
+    bucket = buckets.get(key)
+    if bucket is None:
+      bucket = buckets[key] = TokenBucket(rate, burst)
+    return bucket
+  def prune(self, now: float):
+    #buckets that have filled back up are the same as new ones
+    for buckets in (self.guild_buckets, self.user_buckets):
+      for key in [key for key, bucket in buckets.items() if now - bucket.updated > bucket.capacity / bucket.rate]:
+        del buckets[key]
+  def limit(self, limits, key, size):
+    limit = limits.get(key)
+    if limit is None:
+      limit = limits[key] = ConcurrencyLimit(size)
+    return limit
+  def reject(self, reason: str, priority: int):
+    scheduler_rejections.labels(reason, priority_names[priority]).inc()
+    return None, reason
+  #returns (ticket, None) when the command can run, or (None, reason) when it was turned away
+  async def admit(self, interaction_id: int, guild_id: int, user_id: int, priority: int):
+    now = time.monotonic()
+    self.admitted += 1
+    if self.admitted % 1024 == 0:
+      self.prune(now)
+    user_bucket = self.bucket(self.user_buckets, user_id, self.user_rate, self.user_burst)
+    if not user_bucket.take(now, bucket_reserve[priority] * self.user_burst):
+      return self.reject("user_rate", priority)
+    guild_bucket = self.bucket(self.guild_buckets, guild_id, self.guild_rate, self.guild_burst) if guild_id is not None else None
+    if guild_bucket is not None and not guild_bucket.take(now, bucket_reserve[priority] * self.guild_burst):
+      user_bucket.give_back()
+      return self.reject("guild_rate", priority)
+    max_wait = 0 if priority == PRIORITY_BULK else self.max_wait
+    #a command turned away as busy never ran, so it gives its rate tokens back
+    if not await self.limit(self.user_limits, user_id, self.user_concurrency).acquire(priority, max_wait):
+      self.drop_idle(self.user_limits, user_id)
+      self.give_back(user_bucket, guild_bucket)
+      return self.reject("user_busy", priority)
+    if guild_id is not None:
+      waited = time.monotonic() - now
+      if not await self.limit(self.guild_limits, guild_id, self.guild_concurrency).acquire(priority, max_wait - waited):
+        self.drop_idle(self.guild_limits, guild_id)
+        self.user_limits[user_id].release()
+        self.drop_idle(self.user_limits, user_id)
+        self.give_back(user_bucket, guild_bucket)
+        return self.reject("guild_busy", priority)
+    scheduler_wait_seconds.labels(priority_names[priority]).observe(time.monotonic() - now)
+    scheduler_running.labels(priority_names[priority]).inc()
+    ticket = SchedulerTicket(self, guild_id, user_id, priority)
+    self.tickets[interaction_id] = ticket
+    return ticket, None
+  def give_back(self, user_bucket: TokenBucket, guild_bucket: TokenBucket = None):
+    user_bucket.give_back()
+    if guild_bucket is not None:
+      guild_bucket.give_back()
+  def drop_idle(self, limits, key):
+    limit = limits.get(key)
+    if limit is not None and limit.idle():
+      del limits[key]
+  def release(self, ticket: SchedulerTicket):
+    scheduler_running.labels(priority_names[ticket.priority]).dec()
+    if ticket.guild_id is not None:
+      self.guild_limits[ticket.guild_id].release()
+      self.drop_idle(self.guild_limits, ticket.guild_id)
+    self.user_limits[ticket.user_id].release()
+    self.drop_idle(self.user_limits, ticket.user_id)
+  #done with an interaction, called by the tree once its command returns
+  def finish(self, interaction_id: int):
+    ticket = self.tickets.pop(interaction_id, None)
+    if ticket is not None:
+      ticket.release()
+  #for a command about to wait on the user (a select menu, a confirm button): the slot is given back
+  #so a menu left open doesn't count as a running command
+  def release_early(self, interaction_id: int):
+    ticket = self.tickets.get(interaction_id)
+    if ticket is not None:
+      ticket.release()
 
-class SpellSlotsView(ui.View):
-  def __init__(self):
-    super().__init__(timeout = 300)
-    self.slots = {}
-    self.finished = False
-  @discord.ui.button(label = "Add spell slot level", style = discord.ButtonStyle.primary)
-  async def add_spell_slot(self, interaction: discord.Interaction, button: ui.Button):
-    modal = SpellSlotsModal(view = self)
-    await interaction.response.send_modal(modal)
-    def check(i): return i.user == interaction.user and i.type.name == "modal_submit" and i.data.get("custom_id") == "spellslots_modal"
-    try:
-      await interaction.client.wait_for("interaction", check = check, timeout = 300)
-    except asyncio.TimeoutError:
-      await interaction.followup.send("Spell slot entry timed out.", ephemeral = True)
-  @discord.ui.button(label = "Finish", style = discord.ButtonStyle.success)
-  async def finish(self, interaction: discord.Interaction, button: ui.Button):
-    self.finished = True
-    self.stop()
-    if not self.slots:
-      await interaction.response.send_message("No changes entered.", ephemeral = True)
-    else:
-      slots_summary = "\n".join([f"Level: {lvl} - Number: {num}" for lvl, num in sorted(self.slots.items(), key = lambda x: int(x[0]))])
-      await interaction.response.send_message(f"Changes summary:\n{slots_summary}", ephemeral = True)
-
-class FeatsModal(ui.Modal, title = "Add feats"):
-  feat = ui.TextInput(label = "Feat Name", placeholder = "eg.; Sharpshooter", max_length = 50)
-  def __init__(self, view):
-    super().__init__(title = "Add feat", timeout = 300, custom_id = "feats_modal")
-    self.view = view
-    self.add_item(self.feat)
-  async def on_submit(self, interaction: discord.Interaction):
-    name = self.feat.value.strip()
-    self.view.feats.append(name)
-    await interaction.response.send_message(f"Added {name.title()} to list of feats.", ephemeral = True)
+command_scheduler = CommandScheduler(
+  guild_concurrency = int(os.getenv("GUILD_CONCURRENCY", 8)),
+  user_concurrency = int(os.getenv("USER_CONCURRENCY", 2)),
+  guild_rate = float(os.getenv("GUILD_RATE", 10)),
+  guild_burst = float(os.getenv("GUILD_BURST", 40)),
+  user_rate = float(os.getenv("USER_RATE", 2)),
+  user_burst = float(os.getenv("USER_BURST", 8)),
+  max_wait = float(os.getenv("SCHEDULER_MAX_WAIT", 2.0))
+)
 
-class FeatsView(ui.View):
-  def __init__(self):
-    super().__init(timeout = 300)
-    self.feats = []
-    self.finished = False
-  @discord.ui.button(label = "Add a feat", style = discord.ButtonStyle.primary)
-  async def add_feat(self, interaction: discord.Interaction, button: ui.Button):
-    modal = FeatsModal(view = self)
-    await interaction.response.send_modal(modal)
-    def check(i): return i.user == interaction.user and i.type.name == "modal_submit" and i.data.get("custom_id") == "feats_modal"
+#Command tree that times every app command and autocomplete into command_seconds, and runs
+#commands through command_scheduler (autocomplete is cheap and isn't scheduled).
+#_call is where discord.py hands an interaction to the tree, it has kept that name through 2.x
+class MetricsTree(app_commands.CommandTree):
+  async def _call(self, interaction: discord.Interaction):
+    start = time.perf_counter()
+    name = interaction.command.qualified_name if interaction.command is not None else "unknown"
+    kind = "autocomplete" if interaction.type == discord.InteractionType.autocomplete else "command"
+    if kind == "command" and interaction.command is not None:
+      ticket, reason = await command_scheduler.admit(interaction.id, interaction.guild_id, interaction.user.id, command_priority(name))
+      if ticket is None:
+        await interaction.response.send_message(rejection_messages[reason], ephemeral = True)
+        return
     try:
-      await interaction.client.wait_for("interaction", check = check, timeout = 300)
-    except asyncio.TimeoutError:
-      await interaction.followup.send("Feat entry timed out.", ephemeral = True)
-  @discord.ui.button(label = "Finish", style = discord.ButtonStyle.success)
-  async def finish(self, interaction: discord.Interaction, button: ui.Button):
-    self.finished = True
-    self.stop()
-    if not self.feats:
-      await interaction.response.send_message("No feats added at this time.", ephemeral = True)
-    else:
-      feats_summary = "\n".join(self.feats)
-      await interaction.response.send_message(f"Feats added summary:\n{feats_summary}", ephemeral = True)
-
-class EquipmentModal(ui.Modal, title = "Add equipment"):
-  equipment = ui.TextInput(label = "Item Name", placeholder = "eg.; Gold", max_length = 50)
-  num = ui.TextInput(label = "Number held", placeholder = "eg.; 500", max_length = 10)
-  def __init__(self, view):
-    super().__init__(title = "Add equipment", timeout = 300, custom_id = "equipment_modal")
-    self.view = view
-    self.add_item(self.equipment)
-    self.add_item(self.num)
-  async def on_submit(self, interaction: discord.Interaction):
-    name = self.equipment.value.strip()
+      await super()._call(interaction)
+    finally:
+      command_scheduler.finish(interaction.id)
+      command_seconds.labels(name, kind).observe(time.perf_counter() - start)
+  async def on_error(self, interaction: discord.Interaction, error: app_commands.AppCommandError):
+    command_errors.labels(interaction.command.qualified_name if interaction.command is not None else "unknown").inc()
+    await super().on_error(interaction, error)
+
+intents = discord.Intents.default()
+bot = commands.Bot(command_prefix = "!", intents = intents, tree_cls = MetricsTree)
+
+#Character creation wizard
+#add_character starts a draft and every later step is a modal opened from one shared set of buttons.
+#The draft is the only state: it is saved after each step, so nothing waits on a user and a restart
+#doesn't lose anyone's progress (/resume_character picks it back up)
+
+#one step of the wizard: the modal fields it asks for as (label, placeholder, max length), the function
+#that adds a submitted modal to the draft and, for optional steps, when the step applies at all
+WizardStep = namedtuple("WizardStep", ["key", "title", "prompt", "fields", "add", "summary", "applies"])
+
+#each add function takes the draft data and the submitted values, raises ValueError with a message for the user
+def draft_add_class(data, cls, lvl):
+  cls = cls.lower()
+  if cls not in class_dice:
+    raise ValueError(f"Invalid class selection: {cls}. Supported classes: {', '.join(class_dice)}")
+  try:
+    lvl = int(lvl)
+  except ValueError:
+    lvl = 0
+  if lvl < 1 or lvl > 20:
+    raise ValueError("Level must be a number between 1 and 20.")
+  if cls in data["classes"]:
+    raise ValueError(f"The class {cls} is already in your list. Each class can only be added once.")
+  data["classes"][cls] = lvl
+  return f"Added {cls} at level {lvl}."
+
+def needs_subclass(data):
+  return [cls for cls, lvl in data["classes"].items() if lvl >= subclass_levels[cls]]
+
+def draft_add_subclass(data, cls, subclass):
+  cls = cls.lower()
+  if cls not in needs_subclass(data):
+    raise ValueError(f"{cls.title()} doesn't get a subclass at your level. Classes that do: {', '.join(needs_subclass(data))}")
+  data["subclasses"][cls] = subclass.lower()
+  return f"Added {subclass.lower()} as your {cls} subclass."
+
+def draft_add_proficiency(data, name, level):
+  name = name.lower()
+  if level not in ("1", "2"):
+    raise ValueError("Level must be 1 or 2. Please try again.")
+  if name in data["proficiencies"]:
+    raise ValueError(f"{name} already added.")
+  data["proficiencies"][name] = int(level)
+  return f"Added: {name} (Level {level})"
+
+def spell_adder(key):
+  def add(data, name, level):
+    name = name.lower()
+    level = level.lower()
+    if level not in {"cantrip"} | {str(i) for i in range(1, 10)}:
+      raise ValueError("level must either be cantrip or a number 1-9. Please try again.")
+    if not name.strip():
+      raise ValueError("Please enter a spell name.")
+    data[key][name] = level
+    #the reference doesn't have every spell, so a name it doesn't know is kept and close matches are offered in case of a typo
+    if spell_catalog.get(name) is None:
+      suggestions = ", ".join(s.title() for s in spell_catalog.search(name, limit = 5))
+      if suggestions:
+        return f"Added: {name.title()} (Level {level}). It isn't in the spell reference, did you mean: {suggestions}?"
+    return f"Added: {name.title()} (Level {level})"
+  return add
+
+def draft_add_slots(data, level, num):
+  if level not in {str(i) for i in range(1, 10)}:
+    raise ValueError("level must be a number 1-9. Please try again.")
+  try:
+    data["slots"][level] = int(num)
+  except ValueError:
+    raise ValueError("Number of slots must be a valid integer.")
+  return f"Added {num} slots at level {level}"
+
+#equipment and points are both a name with a number
+def count_adder(key, what):
+  def add(data, name, num):
     try:
-      num = int(self.num.value.strip())
+      data[key][name] = int(num)
     except ValueError:
-      await interaction.response.send_message("Amount must be a valid integer.", ephemeral = True)
-      return
-    self.view.equipment[name] = num
-    await interaction.response.send_message(f"Item: {name.title()} - Amount: {num}", ephemeral = True)
+      raise ValueError(f"{what} must be a valid integer.")
+    return f"{name.title()}: {num}"
+  return add
 
-class EquipmentView(ui.View):
-  def __init__(self):
-    super().__init(timeout = 300)
-    self.equipment = {}
-    self.finished = False
-  @discord.ui.button(label = "Add an item", style = discord.ButtonStyle.primary)
-  async def add_item(self, interaction: discord.Interaction, button: ui.Button):
-    modal = EquipmentModal(view = self)
-    await interaction.response.send_modal(modal)
-    def check(i): return i.user == interaction.user and i.type.name == "modal_submit" and i.data.get("custom_id") == "equipment_modal"
-    try:
-      await interaction.client.wait_for("interaction", check = check, timeout = 300)
-    except asyncio.TimeoutError:
-      await interaction.followup.send("Equipment entry timed out.", ephemeral = True)
-  @discord.ui.button(label = "Finish", style = discord.ButtonStyle.success)
-  async def finish(self, interaction: discord.Interaction, button: ui.Button):
-    self.finished = True
-    self.stop()
-    if not self.equipment:
-      await interaction.response.send_message("No items or money added at this time.", ephemeral = True)
-    else:
-      items_summary = "\n".join([f"Item: {item} - Amount: {num}" for item, num in self.equipment.items()])
-      await interaction.response.send_message(f"Items added summary:\n{items_summary}", ephemeral = True)
-
-class AbilitiesModal(ui.Modal, title = "Add Abilities"):
-  ability = ui.TextInput(label = "Ability Name", placeholder = "eg.; Hunter's Mark", max_length = 50)
-  def __init__(self, view):
-    super().__init__(title = "Add Abilities", timeout = 300, custom_id = "abilities_modal")
-    self.view = view
-    self.add_item(self.ability)
-  async def on_submit(self, interaction: discord.Interaction):
-    name = self.ability.value.strip()
-    self.view.abilities.append(name)
-    await interaction.response.send_message(f"Added {name.title()} to list of abilities.", ephemeral = True)
+def list_adder(key):
+  def add(data, value):
+    data[key].append(value)
+    return f"Added {value.title() if key != 'notes' else 'a note'}."
+  return add
 
-class AbilitiesView(ui.View):
-  def __init__(self):
-    super().__init(timeout = 300)
-    self.abilities = []
-    self.finished = False
-  @discord.ui.button(label = "Add an ability", style = discord.ButtonStyle.primary)
-  async def add_ability(self, interaction: discord.Interaction, button: ui.Button):
-    modal = AbilitiesModal(view = self)
-    await interaction.response.send_modal(modal)
-    def check(i): return i.user == interaction.user and i.type.name == "modal_submit" and i.data.get("custom_id") == "abilities_modal"
-    try:
-      await interaction.client.wait_for("interaction", check = check, timeout = 300)
-    except asyncio.TimeoutError:
-      await interaction.followup.send("Ability entry timed out.", ephemeral = True)
-  @discord.ui.button(label = "Finish", style = discord.ButtonStyle.success)
-  async def finish(self, interaction: discord.Interaction, button: ui.Button):
-    self.finished = True
-    self.stop()
-    if not self.abilities:
-      await interaction.response.send_message("No abilities added at this time.", ephemeral = True)
-    else:
-      abilities_summary = "\n".join(self.abilities)
-      await interaction.response.send_message(f"Abilities added summary:\n{abilities_summary}", ephemeral = True)
-
-class PointsModal(ui.Modal, title = "Add expendable points"):
-  point = ui.TextInput(label = "Point Name", placeholder = "eg.; Sorcery Points or Bardic Inspiration", max_length = 50)
-  num = ui.TextInput(label = "Maximum number", placeholder = "eg.; 5", max_length = 3)
-  def __init__(self, view):
-    super().__init__(title = "Add expendable points", timeout = 300, custom_id = "points_modal")
-    self.view = view
-    self.add_item(self.point)
-    self.add_item(self.num)
+def summarize(values):
+  if isinstance(values, dict):
+    return ", ".join(f"{name} ({val})" for name, val in values.items())
+  return ", ".join(values)
+
+wizard_steps = (
+  WizardStep("classes", "Add a class", f"Add your character's classes. Supported classes: {', '.join(class_dice)}",
+             (("Class", "eg. wizard", 20), ("Level", "eg. 1", 2)), draft_add_class, summarize, None),
+  WizardStep("subclasses", "Add a subclass", "Your class levels say you should have a subclass. Add one for each class listed.",
+             (("Class", "eg. druid", 20), ("Subclass", "eg. Circle of the Moon", 50)), draft_add_subclass, summarize, needs_subclass),
+  WizardStep("proficiencies", "Add a proficiency", "Add your proficiencies, including saves, abilities, and items. Level 1 is proficient, 2 is expertise.",
+             (("Proficiency name", "eg. str, athletics, thieves tools", 50), ("Level (1 or 2)", "1", 1)), draft_add_proficiency, summarize, None),
+  WizardStep("known", "Add a known spell", "Add your known spells. If your class knows the whole list and only prepares spells, or you don't cast spells, skip this step.",
+             (("Spell name", "eg. fireball", 30), ("Spell level (cantrip or 1-9)", "eg. cantrip or 1", 7)), spell_adder("known"), summarize, None),
+  WizardStep("prepared", "Add a prepared spell", "Add your prepared spells. If your class does not prepare spells, skip this step.",
+             (("Spell name", "eg. fireball", 30), ("Spell level (cantrip or 1-9)", "eg. cantrip or 1", 7)), spell_adder("prepared"), summarize, None),
+  WizardStep("slots", "Add spell slots", "Add your spell slots array. If your character does not need spell slots, skip this step.",
+             (("Slot level", "eg. 1", 1), ("Number of slots for that level", "eg. 3", 2)), draft_add_slots, summarize, None),
+  WizardStep("feats", "Add a feat", "Add any feats your character has.",
+             (("Feat name", "eg. Sharpshooter", 50),), list_adder("feats"), summarize, None),
+  WizardStep("equipment", "Add equipment", "Add any money or equipment.",
+             (("Item name", "eg. Gold", 50), ("Number held", "eg. 500", 10)), count_adder("equipment", "Amount"), summarize, None),
+  WizardStep("abilities", "Add an ability", "Add any character abilities.",
+             (("Ability name", "eg. Hunter's Mark", 50),), list_adder("abilities"), summarize, None),
+  WizardStep("points", "Add expendable points", "Add expendable points. Examples include Sorcery Points, Action Surge, and Bardic Inspiration.",
+             (("Point name", "eg. Sorcery Points", 50), ("Maximum number", "eg. 5", 3)), count_adder("points", "Number"), summarize, None),
+  WizardStep("languages", "Add a language", "Add languages known.",
+             (("Language name", "eg. Common", 50),), list_adder("languages"), summarize, None),
+  WizardStep("notes", "Add a note", "Add campaign or character notes.",
+             (("Note", "eg. The shopkeeper hates us", 500),), list_adder("notes"), lambda notes: f"{len(notes)} notes", None)
+)
+wizard_step_index = {step.key: i for i, step in enumerate(wizard_steps)}
+
+#A character being built. data holds the /add_character options plus one entry per step
+class CharacterDraft:
+  __slots__ = ("owner", "step", "data", "updated")
+  def __init__(self, owner: int, data: dict, step: str = "classes", updated: float = None):
+    self.owner = owner
+    self.step = step
+    self.data = data
+    self.updated = updated or time.time()
+    for key in wizard_step_index:
+      self.data.setdefault(key, [] if key in ("feats", "abilities", "languages", "notes") else {})
+  def current(self):
+    return wizard_steps[wizard_step_index[self.step]]
+  def move(self, direction):
+    #next or previous step that applies to this character, returns False past either end
+    i = wizard_step_index[self.step] + direction
+    while 0 <= i < len(wizard_steps):
+      step = wizard_steps[i]
+      if step.applies is None or step.applies(self.data):
+        self.step = step.key
+        return True
+      i += direction
+    return False
+  def to_json(self):
+    return json.dumps(self.data, separators = (",", ":"))
+  def build(self, char_id: int):
+    #the finished DnD_Char, in the layout add_character has always produced
+    data = self.data
+    classes = data["classes"]
+    hit_dice = hit_dice_for(classes)
+    #spells are entered as {spell: level}, characters keep {level: [spells]}
+    spells = {"known": {}, "prepared": {}}
+    for key in spells:
+      for spell, lvl in data[key].items():
+        spells[key].setdefault(lvl, []).append(spell)
+    return DnD_Char(
+      owner = self.owner,
+      name = data["name"],
+      race = data["race"],
+      background = data["background"],
+      classes = classes,
+      hit_dice = hit_dice,
+      stats = data["stats"],
+      hp = [data["current_hp"], data["max_hp"]],
+      ac = data["ac"],
+      Id = char_id,
+      xp = data["xp"],
+      subclasses = {cls: sub for cls, sub in data["subclasses"].items() if cls in classes},
+      abilities = data["abilities"],
+      notes = data["notes"],
+      spells = spells,
+      spell_slots = {lvl: [num, num] for lvl, num in data["slots"].items()},
+      points = {name: [num, num] for name, num in data["points"].items()},
+      ms = data["ms"],
+      languages = data["languages"],
+      equipment = data["equipment"],
+      feats = data["feats"],
+      exhaustion = 0,
+      proficiencies = data["proficiencies"]
+    )
+
+@timed
+def save_draft(draft: CharacterDraft, db: str = db_path):
+  conn = lite.connect(db, factory = TimedConnection)
+  try:
+    conn.execute("REPLACE INTO character_drafts (owner, step, data, updated) VALUES (?, ?, ?, ?)",
+                 (draft.owner, draft.step, draft.to_json(), draft.updated))
+    conn.commit()
+  finally:
+    conn.close()
+
+@timed
+def load_draft(owner: int, db: str = db_path):
+  conn = lite.connect(db, factory = TimedConnection)
+  try:
+    row = conn.execute("SELECT step, data, updated FROM character_drafts WHERE owner = ?", (owner,)).fetchone()
+  finally:
+    conn.close()
+  if row is None or row[0] not in wizard_step_index:
+    return None
+  return CharacterDraft(owner, json.loads(row[1]), row[0], row[2])
+
+@timed
+def delete_draft(owner: int, db: str = db_path):
+  conn = lite.connect(db, factory = TimedConnection)
+  try:
+    conn.execute("DELETE FROM character_drafts WHERE owner = ?", (owner,))
+    conn.commit()
+  finally:
+    conn.close()
+
+#writes the finished character and deletes its draft in one transaction, so a crash can't lose both and
+#two clicks on Next can't both create it. The id is only taken once the draft is known to be there.
+#Returns the new DnD_Char, or None if the draft was already gone
+@timed
+def finish_draft(draft: CharacterDraft, db: str = db_path):
+  conn = lite.connect(db, factory = TimedConnection)
+  try:
+    if conn.execute("DELETE FROM character_drafts WHERE owner = ?", (draft.owner,)).rowcount == 0:
+      conn.rollback()
+      return None
+    character = draft.build(get_next_id())
+    character.to_db(conn, commit = False)
+    conn.commit()
+    return character
+  except Exception:
+    conn.rollback()
+    raise
+  finally:
+    conn.close()
+
+#Live drafts, one per user. Capped and idle ones are dropped, which is safe because every
+#change is written through to character_drafts first. A dropped draft is read back on next use
+class DraftStore:
+  def __init__(self, max_live = 200, idle_seconds = 900):
+    self.lock = threading.Lock()
+    self.max_live = max_live
+    self.idle_seconds = idle_seconds
+    self.drafts = {} #Format {user_id: CharacterDraft}, least recently used first
+  def _evict(self):
+    #called with the lock held
+    now = time.time()
+    before = len(self.drafts)
+    for owner in [o for o, d in self.drafts.items() if now - d.updated > self.idle_seconds]:
+      del self.drafts[owner]
+    while len(self.drafts) > self.max_live:
+      del self.drafts[next(iter(self.drafts))]
+    cache_events.labels("drafts", "eviction").inc(before - len(self.drafts))
+  def get(self, owner, db = db_path):
+    with self.lock:
+      draft = self.drafts.pop(owner, None)
+      if draft is not None:
+        self.drafts[owner] = draft
+        return draft
+    draft = load_draft(owner, db)
+    if draft is not None:
+      with self.lock:
+        self.drafts[owner] = draft
+        self._evict()
+    return draft
+  def save(self, draft: CharacterDraft, db = db_path):
+    draft.updated = time.time()
+    save_draft(draft, db)
+    with self.lock:
+      self.drafts.pop(draft.owner, None)
+      self.drafts[draft.owner] = draft
+      self._evict()
+  def discard(self, owner, db = db_path):
+    with self.lock:
+      self.drafts.pop(owner, None)
+    delete_draft(owner, db)
+  def finish(self, draft: CharacterDraft, db = db_path):
+    with self.lock:
+      self.drafts.pop(draft.owner, None)
+    return finish_draft(draft, db)
+
+draft_store = DraftStore()
+
+#wizard message for the draft's current step
+def wizard_text(draft: CharacterDraft):
+  step = draft.current()
+  number = wizard_step_index[step.key] + 1
+  so_far = step.summary(draft.data[step.key]) or "nothing yet"
+  finish = "\nPress Next to save your character." if number == len(wizard_steps) else ""
+  return (f"**{draft.data['name']}** - step {number} of {len(wizard_steps)}\n"
+          f"{step.prompt}\nSo far: {so_far}{finish}\n"
+          f"-# Your progress is saved, use /resume_character to come back to it.")
+
+#modal for one step, built from the step's fields
+class DraftStepModal(ui.Modal):
+  def __init__(self, step: WizardStep):
+    super().__init__(title = step.title, timeout = 300)
+    self.step = step
+    self.inputs = []
+    for label, placeholder, max_length in step.fields:
+      text = ui.TextInput(label = label, placeholder = placeholder, required = True, max_length = max_length,
+                          style = discord.TextStyle.paragraph if max_length > 100 else discord.TextStyle.short)
+      self.inputs.append(text)
+      self.add_item(text)
   async def on_submit(self, interaction: discord.Interaction):
-    name = self.point.value.strip()
-    try:
-      num = int(self.num.value.strip())
-    except ValueError:
-      await interaction.response.send_message("Number must be a valid integer.", ephemeral = True)
+    draft = await asyncio.to_thread(draft_store.get, interaction.user.id)
+    if draft is None or draft.step != self.step.key:
+      await interaction.response.send_message("That step is no longer open. Use /resume_character to carry on.", ephemeral = True)
       return
-    self.view.points[name] = num
-    await interaction.response.send_message(f"Type: {name.title()} - Amount: {num}", ephemeral = True)
-
-class PointsView(ui.View):
-  def __init__(self):
-    super().__init(timeout = 300)
-    self.points = {}
-    self.finished = False
-  @discord.ui.button(label = "Add a point type", style = discord.ButtonStyle.primary)
-  async def add_point(self, interaction: discord.Interaction, button: ui.Button):
-    modal = PointsModal(view = self)
-    await interaction.response.send_modal(modal)
-    def check(i): return i.user == interaction.user and i.type.name == "modal_submit" and i.data.get("custom_id") == "points_modal"
     try:
-      await interaction.client.wait_for("interaction", check = check, timeout = 300)
-    except asyncio.TimeoutError:
-      await interaction.followup.send("Point entry timed out.", ephemeral = True)
-  @discord.ui.button(label = "Finish", style = discord.ButtonStyle.success)
-  async def finish(self, interaction: discord.Interaction, button: ui.Button):
-    self.finished = True
-    self.stop()
-    if not self.points:
-      await interaction.response.send_message("No expendable points added at this time.", ephemeral = True)
-    else:
-      items_summary = "\n".join([f"Type: {item} - Max: {num}" for item, num in self.points.items()])
-      await interaction.response.send_message(f"Points added summary:\n{items_summary}", ephemeral = True)
-
-class LanguagesModal(ui.Modal, title = "Add Languages"):
-  language = ui.TextInput(label = "Language Name", placeholder = "eg.; Common", max_length = 50)
-  def __init__(self, view):
-    super().__init__(title = "Add Languages", timeout = 300, custom_id = "languages_modal")
-    self.view = view
-    self.add_item(self.language)
-  async def on_submit(self, interaction: discord.Interaction):
-    name = self.language.value.strip()
-    self.view.languages.append(name)
-    await interaction.response.send_message(f"Added {name.title()} to list of languages.", ephemeral = True)
+      message = self.step.add(draft.data, *[text.value.strip() for text in self.inputs])
+    except ValueError as e:
+      await interaction.response.send_message(str(e), ephemeral = True)
+      return
+    await asyncio.to_thread(draft_store.save, draft)
+    await interaction.response.edit_message(content = f"{message}\n\n{wizard_text(draft)}", view = character_wizard_view)
 
-class LanguagesView(ui.View):
+#Buttons for every user's wizard. It holds no state of its own, the draft is looked up by user,
+#so one persistent instance (registered in on_ready) serves everyone and keeps working after a restart
+class CharacterWizardView(ui.View):
   def __init__(self):
-    super().__init(timeout = 300)
-    self.languages = []
-    self.finished = False
-  @discord.ui.button(label = "Add a language", style = discord.ButtonStyle.primary)
-  async def add_language(self, interaction: discord.Interaction, button: ui.Button):
-    modal = LanguagesModal(view = self)
-    await interaction.response.send_modal(modal)
-    def check(i): return i.user == interaction.user and i.type.name == "modal_submit" and i.data.get("custom_id") == "languages_modal"
-    try:
-      await interaction.client.wait_for("interaction", check = check, timeout = 300)
-    except asyncio.TimeoutError:
-      await interaction.followup.send("Language entry timed out.", ephemeral = True)
-  @discord.ui.button(label = "Finish", style = discord.ButtonStyle.success)
-  async def finish(self, interaction: discord.Interaction, button: ui.Button):
-    self.finished = True
-    self.stop()
-    if not self.languages:
-      await interaction.response.send_message("No languages added at this time.", ephemeral = True)
-    else:
-      summary = "\n".join(self.languages)
-      await interaction.response.send_message(f"Languages added summary:\n{summary}", ephemeral = True)
-
-class NotesModal(ui.Modal, title = "Add Notes"):
-  note = ui.TextInput(label = "Note", placeholder = "eg.; The shopkeeper hates us", max_length = 500)
-  def __init__(self, view):
-    super().__init__(title = "Add Notes", timeout = 500, custom_id = "notes_modal")
-    self.view = view
-    self.add_item(self.note)
-  async def on_submit(self, interaction: discord.Interaction):
-    name = self.note.value.strip()
-    self.view.notes.append(name)
-    await interaction.response.send_message(f"Added a note.\n{name}", ephemeral = True)
+    super().__init__(timeout = None)
+  async def _draft(self, interaction: discord.Interaction):
+    draft = await asyncio.to_thread(draft_store.get, interaction.user.id)
+    if draft is None:
+      await interaction.response.edit_message(content = "No character in progress. Start one with /add_character.", view = None)
+    return draft
+  @discord.ui.button(label = "Add", style = discord.ButtonStyle.primary, custom_id = "wizard:add")
+  async def add_entry(self, interaction: discord.Interaction, button: ui.Button):
+    draft = await self._draft(interaction)
+    if draft is not None:
+      await interaction.response.send_modal(DraftStepModal(draft.current()))
+  @discord.ui.button(label = "Back", style = discord.ButtonStyle.secondary, custom_id = "wizard:back")
+  async def back_step(self, interaction: discord.Interaction, button: ui.Button):
+    draft = await self._draft(interaction)
+    if draft is None:
+      return
+    draft.move(-1)
+    await asyncio.to_thread(draft_store.save, draft)
+    await interaction.response.edit_message(content = wizard_text(draft), view = self)
+  @discord.ui.button(label = "Next", style = discord.ButtonStyle.success, custom_id = "wizard:next")
+  async def next_step(self, interaction: discord.Interaction, button: ui.Button):
+    draft = await self._draft(interaction)
+    if draft is None:
+      return
+    if draft.step == "classes" and not draft.data["classes"]:
+      await interaction.response.send_message("Please add at least one class.", ephemeral = True)
+      return
+    if draft.move(1):
+      await asyncio.to_thread(draft_store.save, draft)
+      await interaction.response.edit_message(content = wizard_text(draft), view = self)
+      return
+    #past the last step, the character is done. It is saved before it is used, only the first click gets to save it
+    character = await asyncio.to_thread(draft_store.finish, draft)
+    if character is None:
+      await interaction.response.edit_message(content = f"{draft.data['name']} has already been created.", view = None)
+      return
+    dnd_cache.add_char(character)
+    dnd_cache.set_active(draft.owner, character.Id)
+    character_names.set_name(draft.owner, character.Id, character.name)
+    class_summary = ", ".join(f"{cls.title()} {lvl}" for cls, lvl in character.classes.items())
+    await interaction.response.edit_message(content = f"Created {character.name} ({class_summary}). They are now your loaded character.", view = None)
+  @discord.ui.button(label = "Cancel", style = discord.ButtonStyle.danger, custom_id = "wizard:cancel")
+  async def cancel(self, interaction: discord.Interaction, button: ui.Button):
+    await asyncio.to_thread(draft_store.discard, interaction.user.id)
+    await interaction.response.edit_message(content = "Character creation cancelled.", view = None)
 
-class NotesView(ui.View):
-  def __init__(self):
-    super().__init(timeout = 300)
-    self.notes = []
-    self.finished = False
-  @discord.ui.button(label = "Add a note", style = discord.ButtonStyle.primary)
-  async def add_note(self, interaction: discord.Interaction, button: ui.Button):
-    modal = NotesModal(view = self)
-    await interaction.response.send_modal(modal)
-    def check(i): return i.user == interaction.user and i.type.name == "modal_submit" and i.data.get("custom_id") == "notes_modal"
-    try:
-      await interaction.client.wait_for("interaction", check = check, timeout = 500)
-    except asyncio.TimeoutError:
-      await interaction.followup.send("Note entry timed out.", ephemeral = True)
-  @discord.ui.button(label = "Finish", style = discord.ButtonStyle.success)
-  async def finish(self, interaction: discord.Interaction, button: ui.Button):
-    self.finished = True
-    self.stop()
-    if not self.notes:
-      await interaction.response.send_message("No notes added at this time.", ephemeral = True)
-    else:
-      summary = "\n".join(self.notes)
-      await interaction.response.send_message(f"Notes added summary:\n{summary}", ephemeral = True)
+#created in on_ready, views need the event loop to be running
+character_wizard_view = None
 
 class CharacterDropdown(discord.ui.Select):
-  def __init__(self, characters, page, per_page):
-    self.characters = characters
-    self.page = page
-    self.per_page = per_page
+  def __init__(self, characters, has_prev, has_next):
+    self.characters = characters #only the page on screen, [(character_id, name),...]
+    self.has_prev = has_prev
+    self.has_next = has_next
     options = self._build_options()
     super().__init__(placeholder = "Choose a character", min_values = 1, max_values = 1, options = options)
   def _build_options(self):
-    start = self.page * self.per_page
-    end = start + self.per_page
-    options = [discord.SelectOption(label = name, value = str(cid)) for cid, name in self.characters[start:end]]
-    if self.page > 0:
+    options = [discord.SelectOption(label = name, value = str(cid)) for cid, name in self.characters]
+    if self.has_prev:
       options.append(discord.SelectOption(label = "← Previous Page", value = "__prev__"))
-    if end < len(self.characters):
+    if self.has_next:
       options.append(discord.SelectOption(label = "Next Page →", value = "__next__"))
     return options
   async def callback(self, interaction: discord.Interaction):
     view: CharacterSelect = self.view
     value = self.values[0]
     if value == "__next__":
-      view.page += 1
-      await view.update_select(interaction)
+      await view.show_next(interaction)
     elif value == "__prev__":
-      view.page -= 1
-      await view.update_select(interaction)
+      await view.show_prev(interaction)
     else:
       view.selected_id = int(value)
       view.stop()
       await interaction.response.send_message(f"Character selected: ID {value}", ephemeral = True)
         
 #a view to select a character from a menu
+#Pages are fetched on demand with get_character_page, so only the page on screen and the
+#prefetched next one are held no matter how many characters the user has
 class CharacterSelect(discord.ui.View):
-  def __init__(self, characters: dict[int, str], per_page = 10):
+  def __init__(self, user_id: int, first_page: list, has_next: bool, per_page = 10):
     super().__init__(timeout = 300)
-    self.characters = list(characters.items())
-    self.page = 0
+    self.user_id = user_id
+    self.characters = first_page
+    self.has_prev = False
+    self.has_next = has_next
     self.per_page = per_page
+    self.next_page = None #task fetching the page after this one
     self.selected_id = None
     self.cancelled = False
     self.message = None
+    self.prefetch()
     self.add_items()
+  def prefetch(self):
+    #start loading the next page while the user looks at this one
+    self.next_page = None
+    if self.has_next:
+      after_id = self.characters[-1][0]
+      self.next_page = asyncio.create_task(asyncio.to_thread(get_character_page, self.user_id, after_id, None, self.per_page))
   def add_items(self):
     self.clear_items()
-    self.add_item(CharacterDropdown(self.characters, self.page, self.per_page))
+    self.add_item(CharacterDropdown(self.characters, self.has_prev, self.has_next))
     cancel_button = discord.ui.Button(label = "Cancel", style = discord.ButtonStyle.danger)
     cancel_button.callback = self.cancel_callback
     self.add_item(cancel_button)
-  async def update_select(self, interaction: discord.Interaction):
+  async def show_next(self, interaction: discord.Interaction):
     await interaction.response.defer()
+    if self.next_page is not None:
+      page, more = await self.next_page
+    else:
+      page, more = await asyncio.to_thread(get_character_page, self.user_id, self.characters[-1][0], None, self.per_page)
+    if page:
+      self.characters, self.has_prev, self.has_next = page, True, more
+    else:
+      self.has_next = False
+    self.prefetch()
+    await self.update_select(interaction)
+  async def show_prev(self, interaction: discord.Interaction):
+    await interaction.response.defer()
+    page, more = await asyncio.to_thread(get_character_page, self.user_id, 0, self.characters[0][0], self.per_page)
+    if page:
+      self.characters, self.has_prev, self.has_next = page, more, True
+    else:
+      self.has_prev = False
+    self.prefetch()
+    await self.update_select(interaction)
+  async def update_select(self, interaction: discord.Interaction):
     self.add_items()
     await interaction.edit_original_response(view = self)
   async def cancel_callback(self, interaction: discord.Interaction):
@@ -1207,13 +3772,244 @@ async def machine_type_autocomplete(interaction: discord.Interaction, current: s
     if current.lower() in mt.lower()
   ]
   
+#stable hash of every registered command as discord would receive it, so a sync is only
+#needed when a command, option or description actually changed
+def command_tree_fingerprint(tree: app_commands.CommandTree):
+  payloads = []
+  for command in tree.get_commands():
+    try:
+      payloads.append(command.to_dict(tree))
+    except TypeError:
+      #discord.py before 2.4 takes no tree argument
+      payloads.append(command.to_dict())
+  payloads.sort(key = lambda payload: (payload.get("type", 1), payload["name"]))
+  return hashlib.sha256(json.dumps(payloads, sort_keys = True, separators = (",", ":")).encode("utf-8")).hexdigest()
+
+#syncs the command tree with discord if it changed since the last sync (or force is set)
+#returns True if a sync was sent. The sync is a slow rate limited call, so reconnects skip it
+async def sync_command_tree(force: bool = False, path: str = tree_hash_path):
+  fingerprint = command_tree_fingerprint(bot.tree)
+  try:
+    with open(path, "r") as f:
+      synced = f.read().strip()
+  except OSError:
+    synced = None
+  if fingerprint == synced and not force:
+    logging.info("Command tree unchanged since the last sync, skipping sync.")
+    return False
+  start = time.perf_counter()
+  synced_commands = await bot.tree.sync()
+  with open(path, "w") as f:
+    f.write(fingerprint)
+  logging.info(f"Synced {len(synced_commands)} commands in {time.perf_counter() - start:.2f}s.")
+  return True
+
+#loads the catalogs side by side in worker threads once the bot is ready
+async def warm_up():
+  def _phase(name, load):
+    with startup_profile.phase(name):
+      load()
+  try:
+    await asyncio.gather(
+      asyncio.to_thread(_phase, "weapon catalog", weapon_catalog.load),
+      asyncio.to_thread(_phase, "spell catalog", spell_catalog.load),
+      asyncio.to_thread(_phase, "draft cleanup", purge_stale_drafts)
+    )
+  except Exception as e:
+    logging.error(f"Warm up after startup failed: {e}")
+  startup_profile.report("Background warm up")
+
+#Event loop health. A heartbeat task measures how late the loop wakes it (lag goes into loop_lag_seconds),
+#and a watchdog thread checks on the heartbeat. When the loop has been stuck past the threshold the thread
+#grabs the loop thread's stack, so the log says which function blocked it and which command called it.
+#DEBUG=1 watches closely and reports every stall. Otherwise it samples twice a second and reports
+#at most one stall every 30 seconds. LOOP_WATCHDOG=0 turns it off, LOOP_LAG_THRESHOLD sets the threshold in seconds
+class LoopWatchdog:
+  def __init__(self, interval: float, threshold: float, report_every: float):
+    self.interval = interval
+    self.threshold = threshold
+    self.report_every = report_every
+    self.last_tick = time.monotonic()
+    self.loop_thread = None
+    self.stalled = False
+    self.last_report = -report_every
+    self.task = None #the heartbeat task, held here so it isn't garbage collected
+  async def heartbeat(self):
+    self.loop_thread = threading.get_ident()
+    while True:
+      self.last_tick = time.monotonic()
+      await asyncio.sleep(self.interval)
+      lag = max(time.monotonic() - self.last_tick - self.interval, 0.0)
+      loop_lag_seconds.labels().observe(lag)
+      if self.stalled:
+        self.stalled = False
+        logging.warning(f"Event loop running again after a {lag:.2f}s stall.")
+  def watch(self):
+    while True:
+      time.sleep(self.interval)
+      behind = time.monotonic() - self.last_tick - self.interval
+      if behind > self.threshold and not self.stalled and self.loop_thread is not None:
+        self.stalled = True
+        self.report(behind)
+  def report(self, behind):
+    frame = sys._current_frames().get(self.loop_thread)
+    if frame is None:
+      return
+    #innermost frame in this file is the blocking call, outermost command callback is who asked for it
+    command_code = {command.callback.__code__: command.qualified_name for command in bot.tree.walk_commands() if hasattr(command, "callback")}
+    culprit = None
+    command = None
+    f = frame
+    while f is not None:
+      if culprit is None and f.f_code.co_filename == __file__:
+        culprit = f
+      command = command_code.get(f.f_code, command)
+      f = f.f_back
+    name = culprit.f_code.co_name if culprit is not None else "outside main.py"
+    loop_stalls.labels(name).inc()
+    now = time.monotonic()
+    if now - self.last_report < self.report_every:
+      return
+    self.last_report = now
+    where = f"{name} (line {culprit.f_lineno})" if culprit is not None else name
+    stack = "".join(traceback.format_stack(frame, limit = 15))
+    logging.warning(f"Event loop blocked for {behind:.2f}s in {where}, command: {command or 'none'}\n{stack}")
+
+def start_loop_watchdog():
+  if os.getenv("LOOP_WATCHDOG", "1") == "0":
+    return None
+  debug = os.getenv("DEBUG", "") not in ("", "0")
+  threshold = float(os.getenv("LOOP_LAG_THRESHOLD", 0.1 if debug else 0.5))
+  watchdog = LoopWatchdog(interval = 0.05 if debug else 0.5, threshold = threshold, report_every = 0 if debug else 30)
+  if debug:
+    #asyncio's own slow callback warnings as well
+    loop = asyncio.get_running_loop()
+    loop.set_debug(True)
+    loop.slow_callback_duration = threshold
+  watchdog.task = asyncio.create_task(watchdog.heartbeat())
+  threading.Thread(target = watchdog.watch, daemon = True).start()
+  logging.info(f"Loop watchdog started, reporting stalls over {threshold * 1000:.0f} ms.")
+  return watchdog
+
+#set in on_ready, the event loop only holds weak references to tasks so the watchdog is kept here
+loop_watchdog = None
+
+#on_ready fires again after every gateway reconnect, the one time setup only needs to run once
+startup_done = False
+
 @bot.event
 async def on_ready():
-  await bot.tree.sync()
-  await init_db()
-  await init_max_id_from_db()
+  global startup_done, character_wizard_view, loop_watchdog
+  if not startup_done:
+    startup_done = True
+    startup_profile.mark("connect to discord")
+    #schema check and max id off the event loop, both are a single read on a database that is up to date
+    with startup_profile.phase("database"):
+      await asyncio.to_thread(init_db)
+      await asyncio.to_thread(update_max_id)
+    start_metrics_server()
+    loop_watchdog = start_loop_watchdog()
+    with startup_profile.phase("views and snapshot"):
+      #the wizard buttons keep working on messages sent before a restart
+      character_wizard_view = CharacterWizardView()
+      bot.add_view(character_wizard_view)
+      dnd_cache.attach_snapshot(snapshot_path)
+    schedule_push(dnd_cache, db_path)
+    schedule_backups(db_path)
+    schedule_roll_flush(roll_log, db_path)
+    with startup_profile.phase("command sync"):
+      await sync_command_tree()
+    logging.info(f"Ready {time.perf_counter() - process_start:.2f}s after start.")
+    startup_profile.report()
+    #the catalogs load themselves on first use anyway, this just gets it done before anyone asks
+    asyncio.create_task(warm_up())
   print(f"Logged in as {bot.user}")
 
+#busiest children of a histogram family as "label: count, mean, p95" lines
+def histogram_lines(family: MetricFamily, limit: int = 8):
+  children = sorted(family.items(), key = lambda item: item[1].total, reverse = True)[:limit]
+  return [
+    f"{' '.join(values) or family.name}: {h.count} calls, mean {h.total / h.count * 1000:.1f} ms, p95 <= {h.quantile(0.95) * 1000:g} ms"
+    for values, h in children if h.count
+  ]
+
+#metrics summary for admins, the full set is on the metrics endpoint
+@bot.tree.command(name = "stats", description = "Show bot latency, storage timings and cache hit rates (admin only)")
+@app_commands.default_permissions(administrator = True)
+@app_commands.guild_only()
+async def stats(interaction: discord.Interaction):
+  caches = {}
+  for (cache, event), counter in cache_events.items():
+    caches.setdefault(cache, {})[event] = counter.value
+  cache_lines = []
+  for cache, events in sorted(caches.items()):
+    hits = events.get("hit", 0) + events.get("snapshot_hit", 0)
+    lookups = hits + events.get("miss", 0)
+    rate = f"{hits / lookups:.0%} hit rate over {lookups} lookups, " if lookups else ""
+    cache_lines.append(f"{cache}: {rate}{events.get('eviction', 0)} evictions")
+  push = storage_seconds.labels("push_dnd_cache_to_db")
+  roll_players, roll_pending = roll_log.counts()
+  sections = [
+    ("Commands", histogram_lines(command_seconds)),
+    ("Storage", histogram_lines(storage_seconds)),
+    ("Queries", histogram_lines(query_seconds, limit = 5)),
+    ("Caches", cache_lines),
+    ("Cache pushes", [f"{push.count} pushes, {push_rows.labels().value} characters written, mean {push.total / push.count * 1000 if push.count else 0:.1f} ms"]),
+    ("Slot engine", histogram_lines(slot_engine_seconds)),
+    ("Roll history", [f"{roll_players} players in memory, {roll_pending} rolls waiting to be written"]),
+    ("Scheduler", histogram_lines(scheduler_wait_seconds) + [
+      f"turned away, {reason.replace('_', ' ')} ({priority}): {counter.value}"
+      for (reason, priority), counter in sorted(scheduler_rejections.items()) if counter.value
+    ])
+  ]
+  text = "\n\n".join(f"**{title}**\n" + ("\n".join(lines) or "nothing yet") for title, lines in sections)
+  await interaction.response.send_message(text[:2000], ephemeral = True)
+
+#push the command tree to discord even if it looks unchanged, ie after editing commands in the developer portal
+@bot.tree.command(name = "sync_commands", description = "Force a sync of the bot's slash commands (admin only)")
+@app_commands.default_permissions(administrator = True)
+@app_commands.guild_only()
+async def sync_commands(interaction: discord.Interaction):
+  await interaction.response.defer(ephemeral = True)
+  await sync_command_tree(force = True)
+  await interaction.followup.send(f"Synced {len(bot.tree.get_commands())} commands.", ephemeral = True)
+
+#take a backup now and list the recent ones. Only the bot's owner, backups cover every server's data
+@bot.tree.command(name = "backup", description = "Back up the character database now (bot owner only)")
+async def backup(interaction: discord.Interaction):
+  if not await bot.is_owner(interaction.user):
+    await interaction.response.send_message("Only the bot's owner can take backups.", ephemeral = True)
+    return
+  await interaction.response.defer(ephemeral = True)
+  try:
+    path = await asyncio.to_thread(backup_db)
+  except (OSError, lite.Error) as e:
+    logging.error(f"Backup from /backup failed: {e}")
+    await interaction.followup.send(f"Backup failed: {e}", ephemeral = True)
+    return
+  recent = [os.path.basename(p) for p in (await asyncio.to_thread(list_backups))[-5:]]
+  await interaction.followup.send(f"Backed up to {os.path.basename(path)}.\nRecent backups:\n" + "\n".join(recent), ephemeral = True)
+
+roll_loads = {} #Format {user_id: task loading their roll history}
+
+#one load per player however many of their commands need it, in the background so a roll never waits on the database
+def load_roll_log(user_id: int):
+  task = roll_loads.get(user_id)
+  if task is None:
+    task = asyncio.create_task(asyncio.to_thread(roll_log.load, user_id))
+    roll_loads[user_id] = task
+    def done(task):
+      roll_loads.pop(user_id, None)
+      if not task.cancelled() and task.exception() is not None:
+        logging.error(f"Could not load roll history for {user_id}: {task.exception()}")
+    task.add_done_callback(done)
+  return task
+
+#adds a roll to the player's history for /luck
+def record_roll(user_id: int, expression: str, sides: int, dice, total: int):
+  if roll_log.record(user_id, expression, sides, dice, total):
+    load_roll_log(user_id)
+
 #dice roller
 @bot.tree.command(name = 'roll', description = 'Roll some dice!')
 @app_commands.describe(dice = "Dice roll in ndm or ndm+x or ndm-x format (ie 1d6+2)")
@@ -1222,7 +4018,8 @@ async def roll(interaction: discord.Interaction, dice: str = "1d6+0"):
   if not match:
     await interaction.response.send_message("Invalid format. Please use ndm+x like 2d6+0 or 1d20-3.", ephemeral = True)
     return
-  num, sides, mod = map(int, match.groups())
+  num, sides = int(match.group(1)), int(match.group(2))
+  mod = int(match.group(3) or 0) #the modifier is optional, 1d20 is as good as 1d20+0
   if num < 1:
     await interaction.response.send_message("Invalid format. Please enter a positive integer for nubmer of dice like 1 or 2.")
     return
@@ -1235,9 +4032,280 @@ async def roll(interaction: discord.Interaction, dice: str = "1d6+0"):
   rolls = [random.randint(1, sides) for _ in range(num)]
   total = sum(rolls) + mod
   roll_text = ", ".join(str(r) for r in rolls)
+  record_roll(interaction.user.id, f"{num}d{sides}{mod:+d}" if mod else f"{num}d{sides}", sides, rolls, total)
 
   await interaction.response.send_message(f"Rolling {num}d{sides}:\nResults: {roll_text}\n**Total: {total}**")
 
+#how someone's dice have been treating them, from the running stats kept as they roll
+@bot.tree.command(name = "luck", description = "See how your dice have been rolling compared to fair dice")
+@app_commands.describe(player = "Show this player's luck instead")
+async def luck(interaction: discord.Interaction, player: discord.Member = None):
+  user = player or interaction.user
+  if not roll_log.loaded(user.id):
+    await load_roll_log(user.id)
+  luck_stats, recent = roll_log.snapshot(user.id)
+  if luck_stats.rolls == 0:
+    await interaction.response.send_message(f"{user.display_name} hasn't rolled any dice yet.", ephemeral = True)
+    return
+  z = luck_stats.z_score()
+  verdict = "cursed" if z <= -2 else "unlucky" if z <= -1 else "blessed" if z >= 2 else "lucky" if z >= 1 else "about as lucky as fair dice"
+  lines = [
+    f"**{user.display_name}** is {verdict} ({z:+.1f} standard deviations from fair dice)",
+    f"{luck_stats.rolls} rolls, {luck_stats.dice} dice: {luck_stats.rolled} rolled against {luck_stats.expected:g} expected ({luck_stats.rolled / luck_stats.expected - 1:+.1%})"
+  ]
+  if luck_stats.d20s:
+    d20s = luck_stats.d20s
+    streak = luck_stats.streak
+    streak_text = f"{streak} above 10 in a row" if streak > 0 else f"{-streak} at 10 or below in a row"
+    lines += [
+      f"d20s: {d20s}, natural 20s {luck_stats.nat20s} ({luck_stats.nat20s / d20s:.1%}), natural 1s {luck_stats.nat1s} ({luck_stats.nat1s / d20s:.1%}), fair dice 5% each",
+      f"Streaks: now {streak_text}, best {luck_stats.best_streak} above 10, worst {-luck_stats.worst_streak} at 10 or below"
+    ]
+  lines.append("Last rolls: " + ", ".join(f"{roll.expression} = {roll.total}" for roll in recent))
+  await interaction.response.send_message("\n".join(lines))
+
+async def character_autocomplete(interaction: discord.Interaction, current: str):
+  names = character_names.get(interaction.user.id)
+  if names is None:
+    names = await asyncio.to_thread(load_character_names, interaction.user.id)
+  current = current.lower()
+  return [
+    app_commands.Choice(name = name, value = str(char_id))
+    for char_id, name in names.items()
+    if current in name.lower()
+  ][:25]
+
+#the character a command should act on: the one picked in the character option, or the active one.
+#Picking a character also makes it the active one
+#Returns (character, None), or (None, message for the user) if there isn't one
+async def character_for_command(user_id: int, character: str = None):
+  if not character:
+    char = await asyncio.to_thread(get_active_character, user_id)
+    return char, None if char is not None else "No character loaded. Use /load_character first."
+  #only the user's own characters are looked at. Autocomplete fills in the id, a typed name is matched by name
+  names = character_names.get(user_id)
+  if names is None:
+    names = await asyncio.to_thread(load_character_names, user_id)
+  typed = character.strip()
+  if typed.isdigit() and int(typed) in names:
+    matches = [int(typed)]
+  else:
+    matches = [char_id for char_id, name in names.items() if name.lower() == typed.lower()]
+  if not matches:
+    return None, f"You don't have a character named {typed}."
+  if len(matches) > 1:
+    return None, f"You have more than one character named {typed}, pick one from the list."
+  char_id = matches[0]
+  char = dnd_cache.get_character(char_id)
+  if char is None:
+    char = await asyncio.to_thread(pull_character_from_db, char_id)
+    if char is None:
+      return None, f"You don't have a character named {typed}."
+    dnd_cache.add_char(char)
+  dnd_cache.set_active(user_id, char_id)
+  return char, None
+
+async def check_autocomplete(interaction: discord.Interaction, current: str):
+  current = current.lower()
+  return [
+    app_commands.Choice(name = name.title(), value = name)
+    for name in check_names
+    if current in name
+  ][:25]
+
+#roll a d20 for a check, returns (kept roll, all rolls)
+def roll_d20(roll_mode: str = "normal"):
+  first = random.randint(1, 20)
+  if roll_mode == "advantage":
+    second = random.randint(1, 20)
+    return max(first, second), [first, second]
+  if roll_mode == "disadvantage":
+    second = random.randint(1, 20)
+    return min(first, second), [first, second]
+  return first, [first]
+
+#skill, save and ability checks for the active character
+@bot.tree.command(name = "check", description = "Roll a skill check, saving throw or ability check")
+@app_commands.describe(check = "Skill, save or ability (ie stealth, dex save, wis)", roll_mode = "Roll normally or with advantage/disadvantage", character = "Character to roll for, defaults to your loaded one")
+@app_commands.autocomplete(check = check_autocomplete, character = character_autocomplete)
+@app_commands.choices(roll_mode = [
+  app_commands.Choice(name = "Normal", value = "normal"),
+  app_commands.Choice(name = "Advantage", value = "advantage"),
+  app_commands.Choice(name = "Disadvantage", value = "disadvantage")
+])
+async def check(interaction: discord.Interaction, check: str, roll_mode: str = "normal", character: str = None):
+  char, missing = await character_for_command(interaction.user.id, character)
+  if char is None:
+    await interaction.response.send_message(missing, ephemeral = True)
+    return
+  name = check.strip().lower()
+  bonus = char.check_bonuses().get(name)
+  if bonus is None:
+    await interaction.response.send_message(f"Unknown check: {check}. Try a skill, a save (ie dex save) or an ability (ie wis).", ephemeral = True)
+    return
+  kept, rolls = roll_d20(roll_mode)
+  roll_text = f"{kept}" if len(rolls) == 1 else f"{rolls[0]}, {rolls[1]} ({roll_mode}) -> {kept}"
+  record_roll(interaction.user.id, f"check: {name}", 20, rolls, kept + bonus)
+  await interaction.response.send_message(f"{char.name} rolls {name.title()} ({bonus:+d}):\nd20: {roll_text}\n**Total: {kept + bonus}**")
+
+async def spell_autocomplete(interaction: discord.Interaction, current: str):
+  return [app_commands.Choice(name = name.title(), value = name) for name in spell_catalog.search(current)]
+
+#spell reference lookup
+@bot.tree.command(name = "spell", description = "Look up a spell")
+@app_commands.describe(name = "Spell name")
+@app_commands.autocomplete(name = spell_autocomplete)
+async def spell(interaction: discord.Interaction, name: str):
+  found = spell_catalog.get(name)
+  if found is None:
+    suggestions = ", ".join(s.title() for s in spell_catalog.search(name, limit = 5))
+    hint = f"\nDid you mean: {suggestions}?" if suggestions else ""
+    await interaction.response.send_message(f"{name} isn't in the spell reference.{hint}", ephemeral = True)
+    return
+  level = "Cantrip" if found.level == 0 else f"Level {found.level}"
+  concentration = ", concentration" if found.concentration else ""
+  await interaction.response.send_message(
+    f"**{found.name.title()}** - {level} {found.school}\n"
+    f"Casting time: {found.casting_time} | Range: {found.range} | Components: {found.components}\n"
+    f"Duration: {found.duration}{concentration}\n"
+    f"Classes: {', '.join(c.title() for c in found.classes)}\n"
+    f"{found.summary}"
+  )
+
+async def weapon_autocomplete(interaction: discord.Interaction, current: str):
+  return [app_commands.Choice(name = name.title(), value = name) for name in weapon_catalog.search(current)]
+
+#weapon attack for the active character: to hit roll and damage, dice doubled on a natural 20
+@bot.tree.command(name = "attack", description = "Attack with a weapon")
+@app_commands.describe(weapon = "Weapon name", roll_mode = "Roll normally or with advantage/disadvantage", character = "Character to attack with, defaults to your loaded one")
+@app_commands.autocomplete(weapon = weapon_autocomplete, character = character_autocomplete)
+@app_commands.choices(roll_mode = [
+  app_commands.Choice(name = "Normal", value = "normal"),
+  app_commands.Choice(name = "Advantage", value = "advantage"),
+  app_commands.Choice(name = "Disadvantage", value = "disadvantage")
+])
+async def attack(interaction: discord.Interaction, weapon: str, roll_mode: str = "normal", character: str = None):
+  char, missing = await character_for_command(interaction.user.id, character)
+  if char is None:
+    await interaction.response.send_message(missing, ephemeral = True)
+    return
+  found = weapon_catalog.get(weapon)
+  if found is None:
+    await interaction.response.send_message(f"Unknown weapon: {weapon}.", ephemeral = True)
+    return
+  attack_roll = char.attack_roll(found)
+  kept, rolls = roll_d20(roll_mode)
+  crit = kept == 20
+  dice = [random.randint(1, attack_roll.sides) for _ in range(attack_roll.count * (2 if crit else 1))]
+  damage = max(0, sum(dice) + attack_roll.damage_mod)
+  roll_text = f"{kept}" if len(rolls) == 1 else f"{rolls[0]}, {rolls[1]} ({roll_mode}) -> {kept}"
+  crit_text = " **Critical hit!**" if crit else ""
+  record_roll(interaction.user.id, f"attack: {found.name}", 20, rolls, kept + attack_roll.to_hit)
+  record_roll(interaction.user.id, f"damage: {found.name}", attack_roll.sides, dice, damage)
+  await interaction.response.send_message(
+    f"{char.name} attacks with a {found.name.title()}:{crit_text}\n"
+    f"To hit: {roll_text} {attack_roll.to_hit:+d} = **{kept + attack_roll.to_hit}**\n"
+    f"Damage: {', '.join(str(d) for d in dice)} {attack_roll.damage_mod:+d} = **{damage} {found.damage_type}**"
+  )
+
+#display name for a resource, ie "Level 3 slots" or "Sorcery Points"
+def resource_label(kind: str, name: str):
+  return f"Level {name} slots" if kind == "slot" else name.title()
+
+async def resource_autocomplete(interaction: discord.Interaction, current: str):
+  char = dnd_cache.get_character(dnd_cache.get_active(interaction.user.id) or 0)
+  if char is None:
+    return []
+  current = current.lower()
+  choices = [
+    app_commands.Choice(name = f"{resource_label(kind, name)} ({pair[0]}/{pair[1]})", value = f"slot {name}" if kind == "slot" else name)
+    for kind, name, pair in char.resources()
+    if current in resource_label(kind, name).lower()
+  ]
+  if interaction.command is not None and interaction.command.name == "restore":
+    choices = [app_commands.Choice(name = rest.title(), value = rest) for rest in ("short rest", "long rest") if current in rest] + choices
+  return choices[:25]
+
+#save_resource_changes for a command, telling the user and returning False if the change lost to another one
+async def save_resources_for_command(interaction: discord.Interaction, char: DnD_Char, changes):
+  try:
+    await asyncio.to_thread(save_resource_changes, char, changes)
+  except ResourceConflict as e:
+    await interaction.response.send_message(f"{char.name}'s resources changed somewhere else at the same time, nothing was saved. "
+                                            f"Now: {e}. Please try again.", ephemeral = True)
+    return False
+  return True
+
+#spend spell slots or class points for the active character, one row update in the database
+@bot.tree.command(name = "use", description = "Spend a spell slot or class points (sorcery points, ki, action surge...)")
+@app_commands.describe(resource = "Spell slot level or points", amount = "How many to spend")
+@app_commands.autocomplete(resource = resource_autocomplete)
+async def use(interaction: discord.Interaction, resource: str, amount: int = 1):
+  char, missing = await character_for_command(interaction.user.id)
+  if char is None:
+    await interaction.response.send_message(missing, ephemeral = True)
+    return
+  found = char.resource(resource.strip().lower()) or char.resource(resource.strip())
+  if found is None:
+    await interaction.response.send_message(f"{char.name} has no resource called {resource}. Check /resources.", ephemeral = True)
+    return
+  kind, name, pair = found
+  before = pair[0]
+  if kind == "slot":
+    #a spell only ever takes one slot
+    spent = amount == 1 and char.cast_spell(name)
+  else:
+    spent = char.use_points(name, amount)
+  if not spent:
+    await interaction.response.send_message(f"{char.name} doesn't have {amount} {resource_label(kind, name)} to spend ({pair[0]}/{pair[1]}).", ephemeral = True)
+    return
+  if not await save_resources_for_command(interaction, char, [(kind, name, before)]):
+    return
+  await interaction.response.send_message(f"{char.name} uses {amount} {resource_label(kind, name)}. {pair[0]}/{pair[1]} left.")
+
+#short or long rest for the active character, or top up a single resource
+@bot.tree.command(name = "restore", description = "Take a short or long rest, or restore a single resource")
+@app_commands.describe(resource = "Short rest, long rest, or a spell slot level or points", amount = "How many to restore, defaults to all of them")
+@app_commands.autocomplete(resource = resource_autocomplete)
+async def restore(interaction: discord.Interaction, resource: str, amount: int = None):
+  char, missing = await character_for_command(interaction.user.id)
+  if char is None:
+    await interaction.response.send_message(missing, ephemeral = True)
+    return
+  key = resource.strip().lower()
+  if key == "long rest":
+    #hp and exhaustion change as well, so the whole character is written
+    char.long_rest()
+    await asyncio.to_thread(save_long_rest, [char])
+    await interaction.response.send_message(f"{char.name} finishes a long rest. HP and every resource restored.")
+    return
+  if key == "short rest":
+    changes = char.short_rest()
+    if changes and not await save_resources_for_command(interaction, char, changes):
+      return
+    restored = ", ".join(resource_label(kind, name) for kind, name, _ in changes) or "nothing needed restoring"
+    await interaction.response.send_message(f"{char.name} finishes a short rest. Restored: {restored}.")
+    return
+  found = char.resource(key) or char.resource(resource.strip())
+  if found is None:
+    await interaction.response.send_message(f"{char.name} has no resource called {resource}. Check /resources.", ephemeral = True)
+    return
+  kind, name, pair = found
+  before = char.restore_resource(kind, name, amount)
+  if pair[0] != before and not await save_resources_for_command(interaction, char, [(kind, name, before)]):
+    return
+  await interaction.response.send_message(f"{char.name} restores {resource_label(kind, name)}. {pair[0]}/{pair[1]}.")
+
+#every resource the active character has and the rest that brings it back
+@bot.tree.command(name = "resources", description = "Show your loaded character's spell slots and class points")
+async def resources(interaction: discord.Interaction):
+  char, missing = await character_for_command(interaction.user.id)
+  if char is None:
+    await interaction.response.send_message(missing, ephemeral = True)
+    return
+  lines = [f"{resource_label(kind, name)}: {pair[0]}/{pair[1]} ({char.recharge(kind, name)} rest)" for kind, name, pair in char.resources()]
+  await interaction.response.send_message(f"**{char.name}**\n" + ("\n".join(lines) or "No spell slots or class points."), ephemeral = True)
+
 #enter a character that is already built elsewhere to the database
 @bot.tree.command(name = "add_character", description = "Add a character that you already have built to your account (Interactive)")
 @app_commands.describe(name = "Character Name",
@@ -1261,195 +4329,563 @@ async def add_character(interaction: discord.Interaction,
                         current_hp: int,
                         ac: int,
                         ms: int,
-                        xp: int = 0,
                         background: str,
                         str_stat: int,
                         dex_stat: int,
                         con_stat: int,
                         int_stat: int,
                         wis_stat: int,
-                        cha_stat: int):
-                          #Get the stat array into a dictionary
-                          stats = {"str": str_stat,
-                                  "dex": dex_stat,
-                                  "con": con_stat,
-                                  "int": int_stat,
-                                  "wis": wis_stat,
-                                  "cha": cha_stat}
-                          owner = interaction.user.id
-                          #set hp
-                          hp = [current_hp, max_hp]
-                          #for iterative interactive command prompting checks
-                          def check(m):
-                            return m.author.id == interaction.user.id and m.channel == interaction.channel
-                          #Get the classes
-                          class_view = ClassLoopView()
-                          await interaction.response.send_message("Let's add your character's classes.", ephemeral = True)
-                          await interaction.followup.send(view = class_view, ephemeral = True)
-                          await class_view.wait()
-                          subclasses = {}
-                          if not class_view.class_data:
-                            await interaction.followup.send("No classes entered. Character creation cancelled.")
-                            return
-                          if class_view.finished:
-                            classes = class_view.class_data
-                            hit_dice = {}
-                            for cls in classes:
-                              die = class_dice[cls]
-                              if die not in hit_dice:
-                                hit_dice[die] = [classes[cls], classes[cls]]
-                              else:
-                                hit_dice[die][0] += classes[cls]
-                                hit_dice[die][1] += classes[cls]
-                              if classes[cls] >= subclass_levels[cls]:
-                                subclass_view = SubclassView()
-                                await interaction.followup.send(f"Your level in {cls.title()} indicates you should have a subclass.\nAdd it now.", ephemeral = True)
-                                await interaction.followup.send(view = subclass_view, ephemeral = True)
-                                await subclass_view.wait()
-                                if subclass_view.finished:
-                                  subclasses[cls] = subclass_view.subclass
-                          #add proficiencies
-                          proficiencies = {}
-                          prof_view = ProficiencyView()
-                          await interaction.followup.send("Let's add your proficiencies, including saves, abilities, and items.", ephemeral = True)
-                          await interaction.followup.send(view = prof_view, ephemeral = True)
-                          await prof_view.wait()
-                          if prof_view.finished:
-                            proficiencies = prof_view.proficiencies
-                          #add known spells
-                          spells_known = {}
-                          spells_view = SpellsView()
-                          await interaction.followup.send("Let's add your known spells.\nIf your class knows the whole list and only prepares spells, skip this step.\nSkip if you don't cast spells.", ephemeral = True)
-                          await interaction.followup.send(view = spells_view, ephemeral = True)
-                          await spells_view.wait()
-                          if spells_view.finished and spells_view.spells:
-                            #need to flip dictionary from {spell: level} to {level: [spells]}
-                            for spell, lvl in spells_view.spells.items():
-                              spells_known.setdefault(lvl, []).append(spell)
-                          #add prepared spells
-                          spells_prepared = {}
-                          prep_view = SpellsView()
-                          await interaction.followup.send("Let's add your prepared spells.\nIf your class does not prepare spells, skip this step.\nSkip if you don't cast spells.", ephemeral = True)
-                          await interaction.followup.send(view = prep_view, ephemeral = True)
-                          await prep_view.wait()
-                          if prep_view.finished:
-                            if prep_view.spells:
-                              for spell, lvl in prep_view.spells.items():
-                                if lvl not in spells_prepared:
-                                  spells_prepared[lvl] = [spell]
-                                else:
-                                  spells_prepared[lvl].append(spell)
-                          #Add spell slots
-                          spell_slots = {}
-                          slots_view = SpellSlotsView()
-                          await interaction.followup.send("Let's add your spell slots array.\nIf your character does not need spell slots, skip this step.", ephemeral = True)
-                          await interaction.followup.send(view = slots_view, ephemeral = True)
-                          await slots_view.wait()
-                          if slots_view.finished and slots_view.slots:
-                            for lvl, num in slots_view.slots.items():
-                              spell_slots[lvl] = [num, num]
-                          #add feats
-                          feats = []
-                          feats_view = FeatsView()
-                          await interaction.followup.send("Add any feats your character has.\nIf you don't have any feats, just select Finished.", ephemeral = True)
-                          await interaction.followup.send(view = feats_view, ephemeral = True)
-                          await feats_view.wait()
-                          if feats_view.finished and feats_view.feats:
-                            feats = feats_view.feats
-                          #add equipment, including gold/silver/etc
-                          equipment = {}
-                          equipment_view = EquipmentView()
-                          await interaction.followup.send("Add any money or equipment.", ephemeral = True)
-                          await interaction.followup.send(view = equipment_view, ephemeral = True)
-                          await equipment_view.wait()
-                          if equipment_view.finished and equipment_view.equipment:
-                            equipment = equipment_view.equipment
-                          #add abilities
-                          abilities = []
-                          abilities_view = AbilitiesView()
-                          await interaction.followup.send("Add any character abilities.", ephemeral = True)
-                          await interaction.followup.send(view = abilities_view, ephemeral = True)
-                          await abilities_view.wait()
-                          if abilities_view.finished and abilities_view.abilities:
-                            abilities = abilities_view.abilities
-                          #add expendable points like bardic inspiration or action surge
-                          points = {}
-                          points_view = PointsView()
-                          await interaction.followup.send("Add expendable points.\nExamples include Sorcery Points, Action Surge, and Bardic Inspiration.", ephemeral = True)
-                          await interaction.followup.send(view = points_view, ephemeral = True)
-                          await points_view.wait()
-                          if points_view.finished and points_view.points:
-                            points = points_view.points
-                          #Add languages known
-                          languages = []
-                          langs_view = LanguagesView()
-                          await interaction.followup.send("Add languages known.", ephemeral = True)
-                          await interaction.followup.send(view = langs_view, ephemeral = True)
-                          await langs_view.wait()
-                          if langs_view.finished and langs_view.languages:
-                            languages = langs_view.languages
-                          #add notes
-                          notes = []
-                          notes_view = NotesView()
-                          await interaction.followup.send("Add campaign or character notes.", ephemeral = True)
-                          await interaction.followup.send(view = notes_view, ephemeral = True)
-                          await notes_view.wait()
-                          if notes_view.finished and notes_view.notes:
-                            notes = notes_view.notes
-                          #Set exhaustion elvel to 0
-                          exhaustion = 0
-                          #generate character id
-                          char_id = get_next_id()
-                          #create dnd_character object
-                          character = DnD_Char(
-                            owner = owner,
-                            name = name,
-                            race = race,
-                            background = background,
-                            classes = classes,
-                            hit_dice = hit_dice,
-                            stats = stats,
-                            hp = hp,
-                            ac = ac,
-                            Id = char_id,
-                            xp = xp,
-                            subclasses = subclasses,
-                            abilities = abilities,
-                            notes = notes,
-                            spells = { "known": spells_known, "prepared": spells_prepared},
-                            spell_slots = spell_slots,
-                            points = points,
-                            ms = ms,
-                            languages = languages,
-                            equipment = equipment,
-                            feats = feats,
-                            exhaustion = exhaustion,
-                            proficiencies = proficiencies
-                          )
-                          dnd_chache[character.Id] = character
+                        cha_stat: int,
+                        xp: int = 0):
+  owner = interaction.user.id
+  replaced = await asyncio.to_thread(draft_store.get, owner)
+  draft = CharacterDraft(owner, {
+    "name": name,
+    "race": race,
+    "background": background,
+    "max_hp": max_hp,
+    "current_hp": current_hp,
+    "ac": ac,
+    "ms": ms,
+    "xp": xp,
+    "stats": {"str": str_stat, "dex": dex_stat, "con": con_stat, "int": int_stat, "wis": wis_stat, "cha": cha_stat}
+  })
+  await asyncio.to_thread(draft_store.save, draft)
+  note = f"Your unfinished draft for {replaced.data['name']} was replaced.\n\n" if replaced is not None else ""
+  await interaction.response.send_message(note + wizard_text(draft), view = character_wizard_view, ephemeral = True)
+
+#pick up a character draft where it was left, including after a restart
+@bot.tree.command(name = "resume_character", description = "Carry on with the character you were adding")
+async def resume_character(interaction: discord.Interaction):
+  draft = await asyncio.to_thread(draft_store.get, interaction.user.id)
+  if draft is None:
+    await interaction.response.send_message("No character in progress. Start one with /add_character.", ephemeral = True)
+    return
+  await interaction.response.send_message(wizard_text(draft), view = character_wizard_view, ephemeral = True)
+
+#Party commands, grouped under /party
+party_group = app_commands.Group(name = "party", description = "Manage a party and run bulk operations on it")
+
+#looks up the party for a party command, replying with an error if there is none or the user is not its DM
+async def party_for_command(interaction: discord.Interaction, name: str, dm_only: bool = True):
+  if interaction.guild_id is None:
+    await interaction.response.send_message("Parties only work inside a server.", ephemeral = True)
+    return None
+  party = await asyncio.to_thread(get_party, interaction.guild_id, name.strip().lower())
+  if party is None:
+    await interaction.response.send_message(f"No party called {name} in this server.", ephemeral = True)
+    return None
+  if dm_only and party.dm != interaction.user.id:
+    await interaction.response.send_message("Only the party's DM can do that.", ephemeral = True)
+    return None
+  return party
+
+@party_group.command(name = "create", description = "Create a party in this server, you will be its DM")
+@app_commands.describe(name = "Party name")
+async def party_create(interaction: discord.Interaction, name: str):
+  if interaction.guild_id is None:
+    await interaction.response.send_message("Parties only work inside a server.", ephemeral = True)
+    return
+  party = await asyncio.to_thread(create_party, interaction.guild_id, name.strip().lower(), interaction.user.id)
+  if party is None:
+    await interaction.response.send_message(f"A party called {name} already exists in this server.", ephemeral = True)
+    return
+  await interaction.response.send_message(f"Created party {party.name.title()}. Players can add their loaded character with /party join.")
+
+@party_group.command(name = "join", description = "Add your loaded character to a party")
+@app_commands.describe(name = "Party name", character = "Character to add, defaults to your loaded one")
+@app_commands.autocomplete(character = character_autocomplete)
+async def party_join(interaction: discord.Interaction, name: str, character: str = None):
+  party = await party_for_command(interaction, name, dm_only = False)
+  if party is None:
+    return
+  char, missing = await character_for_command(interaction.user.id, character)
+  if char is None:
+    await interaction.response.send_message(missing, ephemeral = True)
+    return
+  if char.Id not in party.members:
+    party.members.append(char.Id)
+    await asyncio.to_thread(save_party_members, party)
+  await interaction.response.send_message(f"{char.name} joined {party.name.title()}.")
+
+@party_group.command(name = "leave", description = "Remove your loaded character from a party")
+@app_commands.describe(name = "Party name")
+async def party_leave(interaction: discord.Interaction, name: str):
+  party = await party_for_command(interaction, name, dm_only = False)
+  if party is None:
+    return
+  char = await asyncio.to_thread(get_active_character, interaction.user.id)
+  if char is None or char.Id not in party.members:
+    await interaction.response.send_message("Your loaded character is not in that party.", ephemeral = True)
+    return
+  party.members.remove(char.Id)
+  await asyncio.to_thread(save_party_members, party)
+  await interaction.response.send_message(f"{char.name} left {party.name.title()}.")
+
+@party_group.command(name = "rest", description = "Long rest for the whole party (DM only)")
+@app_commands.describe(name = "Party name")
+async def party_rest(interaction: discord.Interaction, name: str):
+  party = await party_for_command(interaction, name)
+  if party is None:
+    return
+  chars = await asyncio.to_thread(load_party_characters, party)
+  party.long_rest(chars)
+  await asyncio.to_thread(save_long_rest, chars)
+  await interaction.response.send_message(f"{party.name.title()} took a long rest. {len(chars)} characters restored.")
+
+@party_group.command(name = "xp", description = "Split experience points between the party (DM only)")
+@app_commands.describe(name = "Party name", amount = "Total xp to split evenly")
+async def party_xp(interaction: discord.Interaction, name: str, amount: app_commands.Range[int, 1]):
+  party = await party_for_command(interaction, name)
+  if party is None:
+    return
+  chars = await asyncio.to_thread(load_party_characters, party)
+  share = party.split_xp(chars, amount)
+  await asyncio.to_thread(persist_characters, chars)
+  await interaction.response.send_message(f"{len(chars)} characters in {party.name.title()} gained {share} xp each.")
+
+@party_group.command(name = "damage", description = "Damage every party member at once, ie a fireball (DM only)")
+@app_commands.describe(name = "Party name", amount = "Damage taken", saved = "Comma separated names of characters that saved for half damage")
+async def party_damage(interaction: discord.Interaction, name: str, amount: app_commands.Range[int, 1], saved: str = ""):
+  party = await party_for_command(interaction, name)
+  if party is None:
+    return
+  chars = await asyncio.to_thread(load_party_characters, party)
+  saved_names = {n.strip().lower() for n in saved.split(",") if n.strip()}
+  saved_ids = {char.Id for char in chars if char.name.lower() in saved_names}
+  party.aoe_damage(chars, amount, saved_ids)
+  await asyncio.to_thread(persist_characters, chars)
+  summary = "\n".join(f"{char.name}: {char.hp[0]}/{char.hp[1]} HP" for char in chars)
+  await interaction.response.send_message(f"{party.name.title()} took {amount} damage.\n{summary}")
+
+bot.tree.add_command(party_group)
+
+#Combat commands, grouped under /combat. The encounter lives in memory and player characters are written once at the end
+combat_group = app_commands.Group(name = "combat", description = "Run an encounter with initiative and turn order")
+
+#looks up the encounter in this channel, replying with an error if there is none or the user is not its DM
+async def encounter_for_command(interaction: discord.Interaction, dm_only: bool = False):
+  encounter = encounters.get(interaction.channel_id)
+  if encounter is None:
+    await interaction.response.send_message("There is no encounter running in this channel. Start one with /combat start.", ephemeral = True)
+    return None
+  if dm_only and encounter.dm != interaction.user.id:
+    await interaction.response.send_message("Only the DM running this encounter can do that.", ephemeral = True)
+    return None
+  return encounter
+
+#the combatant a command changes: the DM can change anyone, players only their own character
+async def combatant_for_command(interaction: discord.Interaction, encounter: Encounter, target: str):
+  combatant = encounter.get(target)
+  if combatant is None:
+    await interaction.response.send_message(f"{target} is not in the encounter.", ephemeral = True)
+    return None
+  if combatant.char is None and interaction.user.id != encounter.dm:
+    await interaction.response.send_message(f"Only the DM can change {combatant.name}.", ephemeral = True)
+    return None
+  if combatant.char is not None and interaction.user.id not in (encounter.dm, combatant.char.owner):
+    await interaction.response.send_message(f"Only the DM or {combatant.name}'s player can change {combatant.name}.", ephemeral = True)
+    return None
+  return combatant
+
+async def combatant_autocomplete(interaction: discord.Interaction, current: str):
+  encounter = encounters.get(interaction.channel_id)
+  if encounter is None:
+    return []
+  current = current.lower()
+  return [
+    app_commands.Choice(name = c.name, value = c.name)
+    for key, c in encounter.combatants.items()
+    if current in key and not c.removed
+  ][:25]
+
+def describe_combatant(combatant: Combatant):
+  conditions = f" ({', '.join(sorted(combatant.conditions))})" if combatant.conditions else ""
+  return f"{combatant.name}: init {combatant.initiative}, {combatant.hp[0]}/{combatant.hp[1]} HP, AC {combatant.ac}{conditions}"
+
+@combat_group.command(name = "start", description = "Start an encounter in this channel, you will run it")
+async def combat_start(interaction: discord.Interaction):
+  if interaction.channel_id in encounters:
+    await interaction.response.send_message("An encounter is already running in this channel.", ephemeral = True)
+    return
+  encounters[interaction.channel_id] = Encounter(interaction.channel_id, interaction.user.id)
+  await interaction.response.send_message("Encounter started! Players join with /combat join, the DM adds monsters with /combat add.")
+
+@combat_group.command(name = "join", description = "Join the encounter with your character")
+@app_commands.describe(character = "Character to join with, defaults to your loaded one")
+@app_commands.autocomplete(character = character_autocomplete)
+async def combat_join(interaction: discord.Interaction, character: str = None):
+  encounter = await encounter_for_command(interaction)
+  if encounter is None:
+    return
+  char, missing = await character_for_command(interaction.user.id, character)
+  if char is None:
+    await interaction.response.send_message(missing, ephemeral = True)
+    return
+  if encounter.get(char.name) is not None:
+    await interaction.response.send_message(f"{char.name} is already in the encounter.", ephemeral = True)
+    return
+  encounter.add(Combatant(char.name, char.get_modifier("dex"), ac = char.ac, char = char))
+  #the encounter and the cache share this object until the end, a push would otherwise swap in a second copy
+  dnd_cache.pin(char, interaction.channel_id)
+  await interaction.response.send_message(f"{char.name} joined the encounter.")
+
+@combat_group.command(name = "add", description = "Add monsters to the encounter (DM only)")
+@app_commands.describe(name = "Monster name", hp = "Hit points", ac = "Armor class", initiative_bonus = "Initiative modifier", count = "How many to add, numbered if more than one")
+async def combat_add(interaction: discord.Interaction, name: str, hp: int, ac: int = 10, initiative_bonus: int = 0, count: int = 1):
+  encounter = await encounter_for_command(interaction, dm_only = True)
+  if encounter is None:
+    return
+  if count < 1 or count > 200:
+    await interaction.response.send_message("Count must be between 1 and 200.", ephemeral = True)
+    return
+  names = [name] if count == 1 else [f"{name} {i}" for i in range(1, count + 1)]
+  taken = [n for n in names if encounter.get(n) is not None]
+  if taken:
+    await interaction.response.send_message(f"Already in the encounter: {', '.join(taken[:10])}", ephemeral = True)
+    return
+  for n in names:
+    encounter.add(Combatant(n, initiative_bonus, hp, ac))
+  await interaction.response.send_message(f"Added {count} x {name} ({hp} HP, AC {ac}).")
+
+@combat_group.command(name = "initiative", description = "Roll initiative for everyone and start round 1 (DM only)")
+async def combat_initiative(interaction: discord.Interaction):
+  encounter = await encounter_for_command(interaction, dm_only = True)
+  if encounter is None:
+    return
+  encounter.roll_initiative()
+  first = encounter.next_turn()
+  if first is None:
+    await interaction.response.send_message("Nobody is in the encounter yet.", ephemeral = True)
+    return
+  order = "\n".join(describe_combatant(c) for c in encounter.order(10))
+  await interaction.response.send_message(f"Initiative rolled for {len(encounter.heap) + 1} combatants.\n{order}\n**Round 1: {first.name}'s turn**")
+
+@combat_group.command(name = "next", description = "End the current turn")
+async def combat_next(interaction: discord.Interaction):
+  encounter = await encounter_for_command(interaction)
+  if encounter is None:
+    return
+  if not encounter.round:
+    await interaction.response.send_message("Roll initiative first with /combat initiative.", ephemeral = True)
+    return
+  combatant = encounter.next_turn()
+  if combatant is None:
+    await interaction.response.send_message("Nobody is left in the turn order.")
+    return
+  await interaction.response.send_message(f"**Round {encounter.round}: {combatant.name}'s turn**\n{describe_combatant(combatant)}")
+
+@combat_group.command(name = "damage", description = "Damage or heal a combatant (negative amounts heal)")
+@app_commands.describe(target = "Who takes the damage", amount = "Damage, negative to heal")
+@app_commands.autocomplete(target = combatant_autocomplete)
+async def combat_damage(interaction: discord.Interaction, target: str, amount: int):
+  encounter = await encounter_for_command(interaction)
+  if encounter is None:
+    return
+  combatant = await combatant_for_command(interaction, encounter, target)
+  if combatant is None:
+    return
+  encounter.damage(combatant, amount)
+  down = " and is defeated" if combatant.removed else ""
+  await interaction.response.send_message(f"{combatant.name} is at {combatant.hp[0]}/{combatant.hp[1]} HP{down}.")
+
+@combat_group.command(name = "condition", description = "Add or remove a condition on a combatant")
+@app_commands.describe(target = "Combatant", condition = "Condition, ie prone or poisoned", remove = "Remove the condition instead")
+@app_commands.autocomplete(target = combatant_autocomplete)
+async def combat_condition(interaction: discord.Interaction, target: str, condition: str, remove: bool = False):
+  encounter = await encounter_for_command(interaction)
+  if encounter is None:
+    return
+  combatant = await combatant_for_command(interaction, encounter, target)
+  if combatant is None:
+    return
+  condition = condition.strip().lower()
+  if remove:
+    combatant.conditions.discard(condition)
+  else:
+    combatant.conditions.add(condition)
+  await interaction.response.send_message(describe_combatant(combatant))
+
+@combat_group.command(name = "remove", description = "Take a combatant out of the encounter (DM only)")
+@app_commands.describe(target = "Combatant")
+@app_commands.autocomplete(target = combatant_autocomplete)
+async def combat_remove(interaction: discord.Interaction, target: str):
+  encounter = await encounter_for_command(interaction, dm_only = True)
+  if encounter is None:
+    return
+  combatant = encounter.remove(target)
+  if combatant is None:
+    await interaction.response.send_message(f"{target} is not in the encounter.", ephemeral = True)
+    return
+  await interaction.response.send_message(f"{combatant.name} left the encounter.")
+
+#the character that belongs to the user in this encounter, for spending resources
+async def own_combatant(interaction: discord.Interaction, encounter: Encounter):
+  for combatant in encounter.combatants.values():
+    if combatant.char is not None and combatant.char.owner == interaction.user.id and not combatant.removed:
+      return combatant
+  await interaction.response.send_message("You don't have a character in this encounter.", ephemeral = True)
+  return None
+
+@combat_group.command(name = "cast", description = "Spend a spell slot")
+@app_commands.describe(level = "Spell slot level")
+async def combat_cast(interaction: discord.Interaction, level: int):
+  encounter = await encounter_for_command(interaction)
+  if encounter is None:
+    return
+  combatant = await own_combatant(interaction, encounter)
+  if combatant is None:
+    return
+  char = combatant.char
+  slots = char.spell_slots.get(str(level))
+  before = slots[0] if slots is not None else 0
+  if not char.cast_spell(str(level)):
+    await interaction.response.send_message(f"{char.name} has no level {level} slots left.", ephemeral = True)
+    return
+  #one row update, the rest of the character is saved when the encounter ends
+  if not await save_resources_for_command(interaction, char, [("slot", str(level), before)]):
+    return
+  await interaction.response.send_message(f"{char.name} casts a level {level} spell. {slots[0]}/{slots[1]} level {level} slots left.")
+
+@combat_group.command(name = "use", description = "Spend class points, ie sorcery points or ki")
+@app_commands.describe(point = "Point type", amount = "How many to spend")
+async def combat_use(interaction: discord.Interaction, point: str, amount: int = 1):
+  encounter = await encounter_for_command(interaction)
+  if encounter is None:
+    return
+  combatant = await own_combatant(interaction, encounter)
+  if combatant is None:
+    return
+  char = combatant.char
+  points = char.points.get(point)
+  before = points[0] if points is not None else 0
+  if not char.use_points(point, amount):
+    await interaction.response.send_message(f"{char.name} doesn't have {amount} {point} to spend.", ephemeral = True)
+    return
+  if not await save_resources_for_command(interaction, char, [("points", point, before)]):
+    return
+  await interaction.response.send_message(f"{char.name} spends {amount} {point}. {points[0]}/{points[1]} left.")
+
+@combat_group.command(name = "status", description = "Show the turn order")
+async def combat_status(interaction: discord.Interaction):
+  encounter = await encounter_for_command(interaction)
+  if encounter is None:
+    return
+  order = "\n".join(describe_combatant(c) for c in encounter.order(20))
+  await interaction.response.send_message(f"Round {encounter.round}\n{order or 'Nobody has rolled initiative yet.'}", ephemeral = True)
+
+@combat_group.command(name = "end", description = "End the encounter and save every character's hp and resources (DM only)")
+async def combat_end(interaction: discord.Interaction):
+  encounter = await encounter_for_command(interaction, dm_only = True)
+  if encounter is None:
+    return
+  chars = encounter.characters()
+  #the write can wait on a cache push, answer discord before it starts
+  await interaction.response.defer()
+  try:
+    #one transaction for the whole fight instead of a write per hit
+    await asyncio.to_thread(persist_characters, chars)
+  except lite.Error as e:
+    logging.error(f"Saving the encounter in {interaction.channel_id} failed: {e}")
+    await interaction.followup.send("Couldn't save the characters, the encounter is still running. Try /combat end again.", ephemeral = True)
+    return
+  encounters.pop(interaction.channel_id, None)
+  for char in chars:
+    dnd_cache.unpin(char.Id, interaction.channel_id)
+  await interaction.followup.send(f"Encounter over after {encounter.round} rounds. Saved {len(chars)} characters.")
+
+bot.tree.add_command(combat_group)
+
+#encounter difficulty estimate for a party against a set of monsters
+@bot.tree.command(name = "simulate", description = "Estimate how a fight would go for a party (Monte Carlo)")
+@app_commands.describe(party = "Party name",
+                       monsters = "Monsters as count x name hp/ac/+hit/damage, separated by ; (ie 3x goblin 7/15/+4/1d6+2)",
+                       trials = "Number of simulated fights")
+async def simulate(interaction: discord.Interaction, party: str, monsters: str, trials: int = 20000):
+  if np is None:
+    await interaction.response.send_message("The simulator needs numpy installed on the bot's server.", ephemeral = True)
+    return
+  found = await party_for_command(interaction, party, dm_only = False)
+  if found is None:
+    return
+  try:
+    monster_rows = parse_monsters(monsters)
+  except ValueError as e:
+    await interaction.response.send_message(f"{e}. Use count x name hp/ac/+hit/damage, ie 3x goblin 7/15/+4/1d6+2", ephemeral = True)
+    return
+  chars = [char for char in await asyncio.to_thread(load_party_characters, found) if char.hp[0] > 0]
+  if not chars or not monster_rows:
+    await interaction.response.send_message("The simulation needs at least one conscious character and one monster.", ephemeral = True)
+    return
+  trials = min(max(trials, 100), 50000)
+  await interaction.response.defer()
+  loop = asyncio.get_running_loop()
+  result = await loop.run_in_executor(get_sim_pool(), simulate_encounter, [combat_profile(c) for c in chars], monster_rows, trials)
+  await interaction.followup.send(
+    f"**{found.name.title()}** vs {len(monster_rows)} monsters over {result['trials']} fights:\n"
+    f"Party wins: {result['win_rate']:.1%} | TPK: {result['tpk_rate']:.1%} | Still going after 50 rounds: {result['unfinished_rate']:.1%}\n"
+    f"Expected rounds: {result['mean_rounds']:.1f}\n"
+    f"Expected characters down: {result['mean_downed']:.2f} of {len(chars)} ({result['mean_downed_in_wins']:.2f} in wins)\n"
+    f"-# simulated in {result['seconds']:.2f}s"
+  )
 
 #Command to load a character from database to the runtime: Required before calling any other commands on a character
 @bot.tree.command(name = 'load_character', description = "Load one or more saved characters")
 async def load_character(interaction: discord.Interaction):
   user_id = interaction.user.id
   await interaction.response.send_message("Checking for characters in your account...", ephemeral = True)
-  chars = get_characters_by_user(user_id)
-  if not chars:
+  first_page, has_next = await asyncio.to_thread(get_character_page, user_id)
+  if not first_page:
     await interaction.followup.send("You don't have any saved characters", ephemeral = True)
     return
-  view = CharacterSelect(chars)
-  await interaction.followup.send("Choose character from the list to load.", ephemeral = True)
+  view = CharacterSelect(user_id, first_page, has_next)
+  await interaction.followup.send("Choose character from the list to load.", view = view, ephemeral = True)
+  #the menu can stay open for minutes, it shouldn't hold one of the user's command slots
+  command_scheduler.release_early(interaction.id)
   await view.wait()
   if view.cancelled:
     return
   if view.selected_id is not None:
-    char = pull_character_from_db(view.selected_id)
-    dnd_cache[char.Id] = char
+    #the cache (and its snapshot) is much cheaper than the five table load
+    char = dnd_cache.get_character(view.selected_id)
+    if char is None:
+      char = await asyncio.to_thread(pull_character_from_db, view.selected_id)
+      dnd_cache.add_char(char)
+    dnd_cache.set_active(user_id, char.Id)
     await interaction.followup.send(f"Character '{char.name}' (ID {char.Id}) loaded to runtime cache", ephemeral = True)
 
-#Command to update stats
-@bot.tree.command(name = 'stat_update', description = "Update D&D character stat scores")
-                          
+#rename a character, the autocomplete index is updated in place
+@bot.tree.command(name = "rename_character", description = "Rename one of your characters")
+@app_commands.describe(new_name = "New character name", character = "Character to rename, defaults to your loaded one")
+@app_commands.autocomplete(character = character_autocomplete)
+async def rename_character(interaction: discord.Interaction, new_name: str, character: str = None):
+  char, missing = await character_for_command(interaction.user.id, character)
+  if char is None:
+    await interaction.response.send_message(missing, ephemeral = True)
+    return
+  old_name = char.name
+  char.rename(new_name.strip())
+  character_names.set_name(char.owner, char.Id, char.name)
+  await interaction.response.send_message(f"{old_name} is now called {char.name}.", ephemeral = True)
+
+#character sheet embed, only ever called through sheet_cache
+def render_sheet(char: DnD_Char):
+  classes = ", ".join(
+    f"{cls.title()} {lvl}" + (f" ({char.subclasses[cls].title()})" if char.subclasses.get(cls) else "")
+    for cls, lvl in char.classes.items()
+  )
+  embed = discord.Embed(title = char.name, description = f"Level {char.get_level()} {char.race.title()} {char.background.title()}\n{classes}")
+  embed.add_field(name = "HP", value = f"{char.hp[0]}/{char.hp[1]}")
+  embed.add_field(name = "AC", value = str(char.ac))
+  embed.add_field(name = "Speed", value = f"{char.ms} ft")
+  embed.add_field(name = "Proficiency", value = f"{char.proficiency_bonus():+d}")
+  embed.add_field(name = "XP", value = str(char.xp))
+  embed.add_field(name = "Exhaustion", value = str(char.exhaustion))
+  scores = "  ".join(f"**{stat.upper()}** {score} ({char.get_modifier(stat):+d})" for stat, score in char.stats.items())
+  embed.add_field(name = "Ability Scores", value = scores, inline = False)
+  skills = ", ".join(f"{name.title()} {bonus:+d}" for name, bonus in char.check_bonuses().items() if name in char.proficiencies)
+  if skills:
+    embed.add_field(name = "Proficient", value = skills[:1024], inline = False)
+  resources = "\n".join(f"{resource_label(kind, name)}: {pair[0]}/{pair[1]}" for kind, name, pair in char.resources())
+  if resources:
+    embed.add_field(name = "Resources", value = resources[:1024], inline = False)
+  for key in ("known", "prepared"):
+    spells = char.spells.get(key) or {}
+    text = "\n".join(f"{'Cantrips' if lvl == 'cantrip' else f'Level {lvl}'}: {', '.join(s.title() for s in names)}" for lvl, names in spells.items() if names)
+    if text:
+      embed.add_field(name = f"Spells {key.title()}", value = text[:1024], inline = False)
+  for label, values in (("Feats", char.feats), ("Abilities", char.abilities), ("Languages", char.languages)):
+    if values:
+      embed.add_field(name = label, value = ", ".join(v.title() for v in values)[:1024], inline = False)
+  if char.equipment:
+    embed.add_field(name = "Equipment", value = ", ".join(f"{item.title()} x{num}" for item, num in char.equipment.items())[:1024], inline = False)
+  embed.set_footer(text = f"ID {char.Id}")
+  return embed
+
+#character sheet for your own character, or the loaded character of another player at the table
+@bot.tree.command(name = "sheet", description = "Show a character sheet")
+@app_commands.describe(character = "Character to show, defaults to your loaded one", player = "Show this player's loaded character instead")
+@app_commands.autocomplete(character = character_autocomplete)
+async def sheet(interaction: discord.Interaction, character: str = None, player: discord.Member = None):
+  if player is not None:
+    char = await asyncio.to_thread(get_active_character, player.id)
+    missing = f"{player.display_name} has no character loaded."
+  else:
+    char, missing = await character_for_command(interaction.user.id, character)
+  if char is None:
+    await interaction.response.send_message(missing, ephemeral = True)
+    return
+  await interaction.response.send_message(embed = sheet_cache.get(char, render_sheet))
+
+#bulk import from a JSON or CSV file in the format /export_characters writes. The characters belong to whoever uploads it
+import_file_limit = 2 * 1024 * 1024
+
+@bot.tree.command(name = "import_characters", description = "Add characters from a JSON or CSV file (the format /export_characters makes)")
+@app_commands.describe(file = "A .json or .csv character file")
+async def import_characters(interaction: discord.Interaction, file: discord.Attachment):
+  file_format = os.path.splitext(file.filename)[1].lower().lstrip(".")
+  if file_format not in ("json", "csv"):
+    await interaction.response.send_message("Please upload a .json or .csv file.", ephemeral = True)
+    return
+  if file.size > import_file_limit:
+    await interaction.response.send_message(f"That file is too big, the limit is {import_file_limit // 1024 // 1024} MB.", ephemeral = True)
+    return
+  await interaction.response.defer(ephemeral = True)
+  owner = interaction.user.id
+  try:
+    text = (await file.read()).decode("utf-8-sig")
+    records = await asyncio.to_thread(read_character_records, text, file_format)
+  except (UnicodeDecodeError, ValueError, csv.Error) as e:
+    await interaction.followup.send(f"Couldn't read {file.filename}: {e}", ephemeral = True)
+    return
+  chars, errors = await asyncio.to_thread(build_imported_characters, records, owner)
+  if errors:
+    await interaction.followup.send(("Nothing was imported, please fix these and try again:\n" + "\n".join(errors))[:2000], ephemeral = True)
+    return
+  if not chars:
+    await interaction.followup.send(f"There are no characters in {file.filename}.", ephemeral = True)
+    return
+  await asyncio.to_thread(insert_characters, chars)
+  for char in chars:
+    character_names.set_name(owner, char.Id, char.name)
+  names = ", ".join(char.name for char in chars[:20]) + (f" and {len(chars) - 20} more" if len(chars) > 20 else "")
+  await interaction.followup.send(f"Imported {len(chars)} characters: {names}"[:2000], ephemeral = True)
+
+@bot.tree.command(name = "export_characters", description = "Download your characters as a JSON or CSV file")
+@app_commands.describe(file_format = "File format, JSON keeps everything readable, CSV opens in a spreadsheet")
+@app_commands.choices(file_format = [
+  app_commands.Choice(name = "JSON", value = "json"),
+  app_commands.Choice(name = "CSV", value = "csv")
+])
+async def export_characters(interaction: discord.Interaction, file_format: str = "json"):
+  await interaction.response.defer(ephemeral = True)
+  records = await asyncio.to_thread(export_character_records, interaction.user.id, dnd_cache)
+  if not records:
+    await interaction.followup.send("You don't have any saved characters", ephemeral = True)
+    return
+  text = await asyncio.to_thread(write_character_records, records, file_format)
+  file = discord.File(io.BytesIO(text.encode("utf-8")), filename = f"characters.{file_format}")
+  await interaction.followup.send(f"{len(records)} characters.", file = file, ephemeral = True)
+
+#find characters by what they carry, know or have written down
+@bot.tree.command(name = "search", description = "Search this server's characters by name, notes, abilities and equipment")
+@app_commands.describe(text = "Words to look for, ie cursed amulet")
+@app_commands.guild_only()
+async def search(interaction: discord.Interaction, text: str):
+  #members the bot has seen (the members intent is off) plus whoever is asking, party members are found by guild
+  member_ids = {member.id for member in interaction.guild.members} | {interaction.user.id}
+  try:
+    results = await asyncio.to_thread(search_characters, text, interaction.guild_id, member_ids)
+  except lite.OperationalError as e:
+    logging.error(f"Character search failed: {e}")
+    await interaction.response.send_message("Character search isn't available right now.", ephemeral = True)
+    return
+  if not results:
+    await interaction.response.send_message(f"No characters here match '{text}'.", ephemeral = True)
+    return
+  lines = [f"**{name}** (<@{owner}>): {snippet}" for _, owner, name, snippet in results]
+  await interaction.response.send_message("\n".join(lines)[:2000], ephemeral = True)
+
 #slot machine command (Needed for my campaign so I made it here)
 @bot.tree.command(name = 'slot', description = "Play a slot machine")
 @app_commands.describe(machine_type = "The type of machine to play", wager = "Amount to wager")
@@ -1460,8 +4896,10 @@ async def slot(interaction: discord.Interaction, machine_type: str = "basic", wa
   input_json = json.dumps(input_data).encode('utf-8')
 
   #Call the function from the slot machine backend
-  result_ptr = slot_lib.play_machine(input_json)
+  start = time.perf_counter()
+  result_ptr = get_slot_lib().play_machine(input_json)
   result_json = ctypes.string_at(result_ptr).decode('utf-8')
+  slot_engine_seconds.labels().observe(time.perf_counter() - start)
 
   try:
     result = json.loads(result_json)
@@ -1473,8 +4911,78 @@ async def slot(interaction: discord.Interaction, machine_type: str = "basic", wa
     payout = result['payout']
     wager = result['wager']
 
-    await interaction.followup.send(f"{symbols}\nWagered: {wager}\nWinnings Multiplier: {multiplier}\nPayout: {payout:.2f}")
+    await interaction.response.send_message(f"{symbols}\nWagered: {wager}\nWinnings Multiplier: {multiplier}\nPayout: {payout:.2f}")
   except Exception as e:
     await interaction.response.send_message(f"Failed to parse result: {e}")
 
-bot.run(TOKEN)
+startup_profile.mark("module setup")
+
+#Bulk import and export from the command line on the server, without going through discord:
+#  python main.py import <file.json|file.csv> [owner]   (owner replaces the owner in every record)
+#  python main.py export <file.json|file.csv> [owner]   (everyone's characters without an owner)
+#Stop the bot first for an import: it keeps the next free character id in memory
+def character_file_cli(args):
+  if len(args) not in (2, 3) or args[0] not in ("import", "export"):
+    print("Usage: python main.py import|export <file.json|file.csv> [owner]")
+    return 2
+  command, path = args[0], args[1]
+  owner = int(args[2]) if len(args) == 3 else None
+  file_format = os.path.splitext(path)[1].lower().lstrip(".")
+  if file_format not in ("json", "csv"):
+    print("The file must be .json or .csv")
+    return 2
+  init_db()
+  if command == "export":
+    records = export_character_records(owner)
+    with open(path, "w", encoding = "utf-8", newline = "") as f:
+      f.write(write_character_records(records, file_format))
+    print(f"Exported {len(records)} characters to {path}")
+    return 0
+  update_max_id()
+  with open(path, encoding = "utf-8-sig", newline = "") as f:
+    records = read_character_records(f.read(), file_format)
+  start = time.perf_counter()
+  chars, errors = build_imported_characters(records, owner, max_errors = 50)
+  if errors:
+    print("Nothing was imported:\n" + "\n".join(errors))
+    return 1
+  insert_characters(chars)
+  print(f"Imported {len(chars)} characters (ids {chars[0].Id}-{chars[-1].Id}) in {time.perf_counter() - start:.2f}s" if chars else "No characters to import")
+  return 0
+
+#Backups from the command line:
+#  python main.py backup             take a backup now
+#  python main.py backups            list backups
+#  python main.py restore <file>     replace the database with a backup (stop the bot first)
+def backup_cli(args):
+  if args[0] == "backup" and len(args) == 1:
+    print(f"Backed up to {backup_db()}")
+    return 0
+  if args[0] == "backups" and len(args) == 1:
+    for path in list_backups():
+      print(f"{path}  {os.path.getsize(path) / 2**20:.1f} MiB")
+    return 0
+  if args[0] == "restore" and len(args) == 2:
+    try:
+      previous, removed = restore_db(args[1])
+    except lite.Error as e:
+      print(f"Not restored: {e}")
+      return 1
+    print(f"Restored {db_path} from {args[1]}" + (f", the old database is saved as {previous}" if previous else ""))
+    if removed:
+      print(f"Removed the cache snapshot {snapshot_path}, it was newer than the restored database")
+    return 0
+  print("Usage: python main.py backup | backups | restore <backup file>")
+  return 2
+
+if __name__ == "__main__":
+  if len(sys.argv) > 1 and sys.argv[1] in ("import", "export"):
+    sys.exit(character_file_cli(sys.argv[1:]))
+  if len(sys.argv) > 1 and sys.argv[1] in ("backup", "backups", "restore"):
+    sys.exit(backup_cli(sys.argv[1:]))
+  bot.run(TOKEN)
+  #bot.run only returns once the bot has been closed
+  shutdown_cache(dnd_cache)
+  flush_roll_log(roll_log)
+  if sim_pool is not None:
+    sim_pool.shutdown()